@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts import suggestions
+
+
+class Command(BaseCommand):
+    help = "フォローの関係を配列に読み込み、共通のフォロー数の多い順にユーザーごとのおすすめを作り直します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=suggestions.SIZE, help="1人あたりのおすすめの人数")
+        parser.add_argument(
+            "--max-followees",
+            type=int,
+            default=suggestions.MAX_FOLLOWEES,
+            help="候補を集めるフォロー中のユーザーの上限",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        users, edges, created = suggestions.rebuild(options["size"], options["max_followees"])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{users}人のユーザーと{edges}件のフォローから{created}件のおすすめを作りました ({elapsed:.1f}秒)"
+            )
+        )
@@ -0,0 +1,51 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from accounts.models import FriendShip
+from mysite import cache
+
+User = get_user_model()
+
+
+def count_subquery(field):
+    counts = FriendShip.objects.filter(**{field: OuterRef("pk")}).order_by().values(field)
+    return Coalesce(Subquery(counts.annotate(n=Count("pk")).values("n")), 0)
+
+
+class Command(BaseCommand):
+    help = "User.follower_count / following_count をFriendShipの実件数と突き合わせて修正します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        checked = fixed = 0
+        last_pk = 0
+        while True:
+            batch = (
+                User.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .annotate(actual_followers=count_subquery("followee"), actual_followings=count_subquery("follower"))
+                .values_list("pk", "follower_count", "actual_followers", "following_count", "actual_followings")
+            )
+            rows = list(batch[:batch_size])
+            if not rows:
+                break
+            with transaction.atomic():
+                # 集計中に増減した分を上書きしないよう、差分だけをF()で反映する
+                for pk, followers, actual_followers, followings, actual_followings in rows:
+                    if (followers, followings) == (actual_followers, actual_followings):
+                        continue
+                    User.objects.filter(pk=pk).update(
+                        follower_count=F("follower_count") + actual_followers - followers,
+                        following_count=F("following_count") + actual_followings - followings,
+                    )
+                    cache.invalidate("user", pk)
+                    fixed += 1
+            checked += len(rows)
+            last_pk = rows[-1][0]
+        self.stdout.write(self.style.SUCCESS(f"{checked}人のユーザーを確認し、{fixed}人のフォロー数を修正しました"))
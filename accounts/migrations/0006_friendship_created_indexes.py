@@ -0,0 +1,20 @@
+# Generated by Django 4.1.13 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("accounts", "0005_remove_friendship_unique_follow_user_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["followee", "-created_at"], name="friendship_followee_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["follower", "-created_at"], name="friendship_follower_idx"),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1.13 on 2026-10-18 08:30
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_follow_counts(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    followers = FriendShip.objects.filter(followee=OuterRef("pk")).order_by().values("followee")
+    followings = FriendShip.objects.filter(follower=OuterRef("pk")).order_by().values("follower")
+    User.objects.update(
+        follower_count=Coalesce(Subquery(followers.annotate(n=Count("pk")).values("n")), 0),
+        following_count=Coalesce(Subquery(followings.annotate(n=Count("pk")).values("n")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("accounts", "0006_friendship_created_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="follower_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="following_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_follow_counts, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,42 @@
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 from mysite import settings
 
 
 class User(AbstractUser):
     email = models.EmailField()
+    follower_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+
+
+class FriendShipManager(models.Manager):
+    # フォロー数はシグナルで更新されるので、FriendShipの作成・削除と同じトランザクションで行う
+    # SQLiteのロックの昇格を避けるため、トランザクションは書き込みから始める
+    def follow(self, follower, followee):
+        if self.filter(follower=follower, followee=followee).exists():
+            return False
+        try:
+            with transaction.atomic():
+                self.create(follower=follower, followee=followee)
+        except IntegrityError:
+            return False
+        return True
+
+    def unfollow(self, follower, followee):
+        friendship = self.filter(follower=follower, followee=followee).first()
+        if friendship is None:
+            return False
+        with transaction.atomic():
+            deleted, _ = friendship.delete()
+        return bool(deleted)
+
+    async def afollow(self, follower, followee):
+        return await sync_to_async(self.follow)(follower, followee)
+
+    async def aunfollow(self, follower, followee):
+        return await sync_to_async(self.unfollow)(follower, followee)
 
 
 class FriendShip(models.Model):
@@ -17,7 +48,25 @@ class FriendShip(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FriendShipManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=["follower", "followee"], name="unique_follow_user"),
         ]
+        indexes = [
+            # 一覧は (created_at, id) の降順でページ分けするので、idまで含めて並べ替えを避ける
+            models.Index(fields=["followee", "-created_at", "-id"], name="friendship_followee_idx"),
+            models.Index(fields=["follower", "-created_at", "-id"], name="friendship_follower_idx"),
+        ]
+
+
+class FollowSuggestion(models.Model):
+    # build_follow_suggestions がまとめて作り直す。mutual_count は user のフォロー中で suggested をフォローしている人数
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="follow_suggestions", on_delete=models.CASCADE)
+    suggested = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", on_delete=models.CASCADE)
+    mutual_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "suggested"], name="unique_follow_suggestion")]
+        indexes = [models.Index(fields=["user", "-mutual_count"], name="follow_suggestion_user_idx")]
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from mysite import cache
+
+from .models import FriendShip
+
+User = get_user_model()
+
+
+def update_follow_counts(friendship, diff):
+    User.objects.filter(pk=friendship.follower_id).update(following_count=F("following_count") + diff)
+    User.objects.filter(pk=friendship.followee_id).update(follower_count=F("follower_count") + diff)
+    cache.invalidate("user", friendship.follower_id)
+    cache.invalidate("user", friendship.followee_id)
+    cache.invalidate("following", friendship.follower_id)
+
+
+@receiver(post_save, sender=FriendShip)
+def increment_follow_counts(sender, instance, created, **kwargs):
+    if created:
+        update_follow_counts(instance, 1)
+
+
+@receiver(post_delete, sender=FriendShip)
+def decrement_follow_counts(sender, instance, **kwargs):
+    update_follow_counts(instance, -1)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    cache.invalidate("user", instance.pk)
+    cache.invalidate("username", instance.username)
@@ -0,0 +1,93 @@
+import heapq
+from array import array
+from collections import Counter
+from itertools import chain, islice
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .models import FollowSuggestion, FriendShip
+
+User = get_user_model()
+
+BATCH_SIZE = 10000
+SIZE = 20
+# フォロー中のユーザーが多い人は、この人数分だけから候補を集める
+MAX_FOLLOWEES = 1000
+
+
+class FollowGraph:
+    # フォローの辺をCSR形式の配列で持つ。ユーザーは pk の順に0からの連番に詰め、
+    # 連番 i のユーザーのフォロー先は targets[offsets[i]:offsets[i + 1]]
+    def __init__(self, user_ids, offsets, targets):
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def followees(self, i, limit=None):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.targets[start:end]
+
+
+def load_graph(using=None):
+    user_ids = array("q", User.objects.using(using).order_by("pk").values_list("pk", flat=True).iterator(BATCH_SIZE))
+    index = {pk: i for i, pk in enumerate(user_ids)}
+    offsets = array("q", bytes(8 * (len(user_ids) + 1)))
+    targets = array("l")
+    edges = (
+        FriendShip.objects.using(using)
+        .order_by("follower_id", "followee_id")
+        .values_list("follower_id", "followee_id")
+        .iterator(BATCH_SIZE)
+    )
+    # follower の順に読むので、フォロー先はそのまま targets に並べ、人数だけ数えてから offsets にする
+    for follower_id, followee_id in edges:
+        offsets[index[follower_id] + 1] += 1
+        targets.append(index[followee_id])
+    for i in range(len(user_ids)):
+        offsets[i + 1] += offsets[i]
+    return FollowGraph(user_ids, offsets, targets)
+
+
+def suggest(graph, size=SIZE, max_followees=MAX_FOLLOWEES):
+    # フォロー中のユーザーがフォローしている人を、その人数 (共通のフォロー数) の多い順に size 人まで返す
+    for i in range(len(graph)):
+        followees = graph.followees(i, max_followees)
+        if not followees:
+            continue
+        counts = Counter(chain.from_iterable(graph.followees(followee) for followee in followees))
+        counts.pop(i, None)
+        for followee in graph.followees(i):
+            counts.pop(followee, None)
+        # 同数のときは古いユーザーを先にする
+        top = heapq.nsmallest(size, counts.items(), key=lambda item: (-item[1], item[0]))
+        yield graph.user_ids[i], [(graph.user_ids[j], count) for j, count in top]
+
+
+def rebuild(size=SIZE, max_followees=MAX_FOLLOWEES, using=None):
+    graph = load_graph(using)
+    # 計算に時間がかかっても書き込みのロックを長く持たないよう、結果を配列に貯めてから入れ替える
+    user_ids, suggested_ids, counts = array("q"), array("q"), array("l")
+    for user_id, top in suggest(graph, size, max_followees):
+        for suggested_id, count in top:
+            user_ids.append(user_id)
+            suggested_ids.append(suggested_id)
+            counts.append(count)
+    rows = (
+        FollowSuggestion(user_id=user_id, suggested_id=suggested_id, mutual_count=count)
+        for user_id, suggested_id, count in zip(user_ids, suggested_ids, counts)
+    )
+    suggestions = FollowSuggestion.objects.using(using)
+    with transaction.atomic(using=using):
+        suggestions.all().delete()
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            suggestions.bulk_create(batch)
+    return len(graph), len(graph.targets), len(counts)
@@ -1,11 +1,19 @@
+import json
+from io import StringIO
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY, get_user_model
+from django.contrib.messages import get_messages
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from tweets.models import Tweet
+from tweets.models import Like, Tweet
 
-from .models import FriendShip
+from .models import FollowSuggestion, FriendShip
 
 User = get_user_model()
 
@@ -215,7 +223,10 @@ class TestLoginView(TestCase):
         form = response.context["form"]
         self.assertEqual(response.status_code, 200)
         self.assertFalse(form.is_valid())
-        self.assertIn("正しいユーザー名とパスワードを入力してください。どちらのフィールドも大文字と小文字は区別されます。", form.errors["__all__"])
+        self.assertIn(
+            "正しいユーザー名とパスワードを入力してください。どちらのフィールドも大文字と小文字は区別されます。",
+            form.errors["__all__"],
+        )
         self.assertNotIn(SESSION_KEY, self.client.session)
 
     def test_failure_post_with_empty_password(self):
@@ -269,6 +280,32 @@ class TestUserProfileView(TestCase):
         self.assertEqual(follower_number, FriendShip.objects.filter(followee=self.user2).count())
         self.assertQuerysetEqual(test_list, Tweet.objects.all(), ordered=False)
 
+    def test_success_get_after_follow(self):
+        self.client.get(self.url)
+        FriendShip.objects.create(followee=self.user2, follower=self.user3)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["follower_number"], 2)
+
+    def test_failure_get_with_not_exist_user(self):
+        response = self.client.get(reverse("accounts:user_profile", kwargs=dict(username="tester4")))
+        self.assertEqual(response.status_code, 404)
+
+    def test_success_get_with_cursor(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user2, content=f"paged{i}") for i in range(20)])
+        Tweet.objects.create(user=self.user1, content="othercontent")
+        response = self.client.get(self.url)
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(response.context["tweet_list"]), 20)
+        self.assertTrue(page_obj.has_next())
+
+        more_url = reverse("accounts:user_profile_more", kwargs=dict(username=self.user2))
+        response = self.client.get(more_url, {"before": page_obj.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "accounts/user_profile_tweets.html")
+        self.assertNotIn("follower_number", response.context)
+        self.assertEqual(len(response.context["tweet_list"]), 2)
+        self.assertFalse(response.context["page_obj"].has_next())
+
 
 # class TestUserProfileEditView(TestCase):
 #     def test_success_get(self):
@@ -291,6 +328,22 @@ class TestFollowView(TestCase):
         response = self.client.post(self.url)
         self.assertRedirects(response, reverse("tweets:home"), status_code=302, target_status_code=200)
         self.assertTrue(FriendShip.objects.filter(followee=self.user2, follower=self.user1).exists())
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+
+    async def test_success_post_with_async_client(self):
+        await sync_to_async(self.async_client.force_login)(self.user1)
+        response = await self.async_client.post(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await FriendShip.objects.filter(followee=self.user2, follower=self.user1).aexists())
+
+    def test_success_post_with_followed_user(self):
+        FriendShip.objects.follow(self.user1, self.user2)
+        response = self.client.post(self.url)
+        self.assertRedirects(response, reverse("tweets:home"), status_code=302, target_status_code=200)
+        self.assertEqual(FriendShip.objects.filter(follower=self.user1).count(), 1)
 
     def test_failure_post_with_not_exist_user(self):
         self.url = reverse("accounts:follow", kwargs={"username": "tester3"})
@@ -319,6 +372,23 @@ class TestUnfollowView(TestCase):
         response = self.client.post(self.url)
         self.assertRedirects(response, reverse("tweets:home"), status_code=302, target_status_code=200)
         self.assertEqual(FriendShip.objects.filter(follower=self.user1).count(), 0)
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 0)
+        self.assertEqual(self.user1.follower_count, 1)
+        self.assertEqual(self.user2.follower_count, 0)
+        self.assertEqual(
+            [str(message) for message in get_messages(response.wsgi_request)], ["tester2のフォローを外しました"]
+        )
+
+    def test_failure_post_with_not_followed_user(self):
+        self.url = reverse("accounts:unfollow", kwargs=dict(username=self.user3))
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [str(message) for message in get_messages(response.wsgi_request)],
+            ["あなたはtester3をフォローしていません"],
+        )
 
     def test_failure_post_with_not_exist_tweet(self):
         self.url = reverse("accounts:unfollow", kwargs={"username": "tester4"})
@@ -344,16 +414,210 @@ class TestFollowingListView(TestCase):
     def test_success_get(self):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual([follow.followee for follow in response.context["following_list"]], [self.user2])
+        self.assertTrue(response.context["following_list"][0].is_followed_by_me)
+
+    def test_success_export(self):
+        response = self.client.get(reverse("accounts:following_export", kwargs=dict(username=self.user1)))
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "username,created_at")
+        self.assertTrue(lines[1].startswith("tester2,"))
 
 
 class TestFollowerListView(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"tester{i}", password=f"testpassword{i}") for i in range(25)]
+        for user in self.users[1:]:
+            FriendShip.objects.create(followee=self.users[0], follower=user)
+        FriendShip.objects.create(followee=self.users[24], follower=self.users[0])
+        self.client.force_login(self.users[0])
+        self.url = reverse("accounts:follower_list", kwargs=dict(username=self.users[0]))
+        self.export_url = reverse("accounts:follower_export", kwargs=dict(username=self.users[0]))
+
+    def test_success_get(self):
+        # セッション・ユーザー・一覧のユーザー (ユーザー名とpkで2件)・フォロワー
+        with self.assertNumQueries(5):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        first_page = response.context["follower_list"]
+        self.assertEqual(len(first_page), 20)
+        self.assertEqual([follower.is_followed_by_me for follower in first_page], [True] + [False] * 19)
+        self.assertContains(response, "フォロー中", count=1)
+        self.assertContains(response, "?before=")
+
+        response = self.client.get(self.url, {"before": response.context["page_obj"].next_cursor})
+        second_page = response.context["follower_list"]
+        self.assertFalse(response.context["page_obj"].has_next())
+        followers = [follower.follower for follower in [*first_page, *second_page]]
+        self.assertEqual(followers, list(reversed(self.users[1:])))
+
+    def test_success_export_jsonl(self):
+        response = self.client.get(self.export_url, {"format": "jsonl"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson; charset=utf-8")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([row["username"] for row in rows], [user.username for user in reversed(self.users[1:])])
+
+    def test_failure_export_by_other_user(self):
+        self.client.force_login(self.users[1])
+        response = self.client.get(self.export_url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_failure_export_with_invalid_format(self):
+        response = self.client.get(self.export_url, {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestUserAPI(TestCase):
     def setUp(self):
         self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
         self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
-        self.client.force_login(self.user2)
-        FriendShip.objects.create(followee=self.user2, follower=self.user1)
-        self.url = reverse("accounts:follower_list", kwargs=dict(username=self.user2))
+        self.client.force_login(self.user1)
+        Tweet.objects.create(user=self.user2, content="testcontent")
+        self.url = reverse("accounts:api_user", kwargs=dict(username=self.user2))
 
     def test_success_get(self):
         response = self.client.get(self.url)
+        self.assertEqual(
+            response.json()["user"],
+            {"username": "tester2", "follower_count": 0, "following_count": 0, "is_follow": False},
+        )
+        self.assertEqual([tweet["content"] for tweet in response.json()["tweets"]], ["testcontent"])
+        # セッション・ユーザー・ページのツイートのid (プロフィールのユーザーはキャッシュから)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_success_get_after_delete_and_like(self):
+        old_tweet = Tweet.objects.get()
+        Tweet.objects.create(user=self.user2, content="newcontent")
+        etag = self.client.get(self.url)["ETag"]
+        Like.objects.like(self.user2, old_tweet)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["tweets"][1]["like_count"], 1)
+        old_tweet.delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([tweet["content"] for tweet in response.json()["tweets"]], ["newcontent"])
+
+    def test_success_get_after_follow(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.post(reverse("accounts:follow", kwargs=dict(username=self.user2)))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["user"]["is_follow"])
+
+    def test_failure_get_with_nonexistent_user(self):
+        response = self.client.get(reverse("accounts:api_user", kwargs=dict(username="nobody")))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestFriendShipAPI(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"tester{i}", password=f"testpassword{i}") for i in range(25)]
+        for user in self.users[1:]:
+            FriendShip.objects.create(follower=user, followee=self.users[0])
+        self.client.force_login(self.users[0])
+
+    def test_success_get_followers(self):
+        url = reverse("accounts:api_followers", kwargs=dict(username=self.users[0]))
+        first_page = self.client.get(url).json()
+        second_page = self.client.get(url, {"before": first_page["next"]}).json()
+        usernames = [user["username"] for user in [*first_page["users"], *second_page["users"]]]
+        self.assertEqual(usernames, [user.username for user in reversed(self.users[1:])])
+        self.assertIsNone(second_page["next"])
+
+    def test_success_get_following_not_modified(self):
+        url = reverse("accounts:api_following", kwargs=dict(username=self.users[1]))
+        response = self.client.get(url)
+        self.assertEqual(response.json()["users"][0]["username"], "tester0")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.has_header("Last-Modified"))
+        FriendShip.objects.filter(follower=self.users[1]).delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.json()["users"], [])
+
+
+class TestReconcileFollowCountsCommand(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        User.objects.update(follower_count=5, following_count=5)
+
+    def test_success_reconcile(self):
+        out = StringIO()
+        call_command("reconcile_follow_counts", stdout=out)
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual((self.user1.follower_count, self.user1.following_count), (0, 1))
+        self.assertEqual((self.user2.follower_count, self.user2.following_count), (1, 0))
+        self.assertIn("2人のフォロー数を修正しました", out.getvalue())
+
+    def test_success_reconcile_invalidates_profile_cache(self):
+        url = reverse("accounts:api_user", kwargs=dict(username=self.user2))
+        self.client.force_login(self.user1)
+        self.assertEqual(self.client.get(url).json()["user"]["follower_count"], 5)
+        call_command("reconcile_follow_counts", stdout=StringIO())
+        self.assertEqual(self.client.get(url).json()["user"]["follower_count"], 1)
+
+
+class TestFollowSuggestion(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"tester{i}", password=f"testpassword{i}") for i in range(6)]
+        follows = [(0, 1), (0, 2), (1, 3), (2, 3), (1, 4), (2, 0), (3, 5)]
+        for follower, followee in follows:
+            FriendShip.objects.create(follower=self.users[follower], followee=self.users[followee])
+        self.url = reverse("accounts:follow_suggestions")
+        self.client.force_login(self.users[0])
+
+    def test_success_build(self):
+        out = StringIO()
+        call_command("build_follow_suggestions", stdout=out)
+        self.assertIn("6人のユーザーと7件のフォローから", out.getvalue())
+        self.assertEqual(
+            list(
+                FollowSuggestion.objects.filter(user=self.users[0])
+                .order_by("-mutual_count", "suggested")
+                .values_list("suggested__username", "mutual_count")
+            ),
+            [("tester3", 2), ("tester4", 1)],
+        )
+        self.assertFalse(FollowSuggestion.objects.filter(user=self.users[5]).exists())
+
+    def test_success_get(self):
+        call_command("build_follow_suggestions", stdout=StringIO())
+        FriendShip.objects.create(follower=self.users[0], followee=self.users[4])
+        # セッション・ユーザー・おすすめの3件
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual([suggestion.suggested for suggestion in response.context["suggestion_list"]], [self.users[3]])
+        self.assertContains(response, "共通のフォロー：2人")
+
+
+class TestFriendShipQueryPlan(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.client.force_login(self.user1)
+        FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        FriendShip.objects.create(followee=self.user1, follower=self.user2)
+
+    def assertListUsesIndex(self, url_name, index_name):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse(url_name, kwargs=dict(username=self.user1)))
+        sql = next(q["sql"] for q in context.captured_queries if q["sql"].startswith('SELECT "accounts_friendship"'))
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(any(index_name in detail for detail in plan), plan)
+        self.assertFalse(any("TEMP B-TREE" in detail for detail in plan), plan)
+
+    def test_following_list_uses_follower_index(self):
+        self.assertListUsesIndex("accounts:following_list", "friendship_follower_idx")
+
+    def test_follower_list_uses_followee_index(self):
+        self.assertListUsesIndex("accounts:follower_list", "friendship_followee_idx")
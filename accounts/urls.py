@@ -8,9 +8,16 @@ urlpatterns = [
     path("signup/", views.SignupView.as_view(), name="signup"),
     path("login/", auth_views.LoginView.as_view(template_name="accounts/login.html"), name="login"),
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
+    path("api/users/<str:username>/", views.UserAPIView.as_view(), name="api_user"),
+    path("api/users/<str:username>/following/", views.FollowingAPIView.as_view(), name="api_following"),
+    path("api/users/<str:username>/followers/", views.FollowerAPIView.as_view(), name="api_followers"),
+    path("suggestions/", views.FollowSuggestionView.as_view(), name="follow_suggestions"),
     path("<str:username>/", views.UserProfileView.as_view(), name="user_profile"),
-    path("<str:username>/follow/", views.FollowView.as_view(), name="follow"),
-    path("<str:username>/unfollow/", views.UnFollowView.as_view(), name="unfollow"),
+    path("<str:username>/more/", views.UserProfileMoreView.as_view(), name="user_profile_more"),
+    path("<str:username>/follow/", views.AsyncFollowView.as_view(), name="follow"),
+    path("<str:username>/unfollow/", views.AsyncUnFollowView.as_view(), name="unfollow"),
     path("<str:username>/following_list/", views.FollowingListView.as_view(), name="following_list"),
     path("<str:username>/follower_list/", views.FollowerListView.as_view(), name="follower_list"),
+    path("<str:username>/following_list/export/", views.FollowingExportView.as_view(), name="following_export"),
+    path("<str:username>/follower_list/export/", views.FollowerExportView.as_view(), name="follower_export"),
 ]
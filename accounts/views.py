@@ -1,20 +1,45 @@
+import csv
+import json
+from itertools import chain
+
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, get_user_model, login
-from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseBadRequest, HttpResponseNotFound
-from django.shortcuts import get_object_or_404
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.db.models import Exists, OuterRef
+from django.http import Http404, HttpResponseBadRequest, HttpResponseNotFound, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
-from django.views.generic import CreateView, ListView, RedirectView
+from django.views import View
+from django.views.generic import CreateView, ListView
 
-from tweets.models import Like, Tweet
+from mysite import cache, sharding
+from mysite.mixins import AsyncLoginRequiredMixin, ConditionalGetMixin, JSONResponseMixin, ReplicaReadMixin
+from mysite.pagination import KeysetPaginationMixin, keyset_slice
+from tweets.fragments import TweetFragmentMixin
+from tweets.models import Tweet
+from tweets.serializers import get_tweet_versions, serialize_tweet
 
 from .forms import SignupForm
-from .models import FriendShip
+from .models import FollowSuggestion, FriendShip
 
 User = get_user_model()
 
 
+def get_profile_user(username):
+    # ユーザー名→pk と pk→ユーザー を分けてキャッシュし、フォロー数の更新はpkのバージョンで無効化する
+    user_pk = cache.cached(
+        "username", username, lambda: User.objects.filter(username=username).values_list("pk", flat=True).first()
+    )
+    if user_pk is None:
+        raise Http404("that user doesn't exist")
+    return cache.cached(
+        "user",
+        user_pk,
+        lambda: get_object_or_404(User.objects.only("username", "follower_count", "following_count"), pk=user_pk),
+    )
+
+
 class SignupView(CreateView):
     form_class = SignupForm
     template_name = "accounts/signup.html"
@@ -29,35 +54,48 @@ class SignupView(CreateView):
         return response
 
 
-class UserProfileView(LoginRequiredMixin, ListView):
+class UserProfileView(LoginRequiredMixin, ReplicaReadMixin, TweetFragmentMixin, KeysetPaginationMixin, ListView):
     template_name = "accounts/user_profile.html"
+    fragment_variant = "profile"
     model = Tweet
     context_object_name = "tweet_list"
 
     def get_queryset(self):
-        user = get_object_or_404(User, username=self.kwargs["username"])
+        user = get_profile_user(self.kwargs["username"])
         self.user = user
-        return Tweet.objects.select_related("user").prefetch_related("like_tweet").filter(user=user)
+        tweets = sharding.for_user(Tweet.objects.select_related("user"), user.pk)
+        return tweets.filter(user=user).with_like_state(self.request.user)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["user"] = self.user
+        context.update(self.get_profile_context())
+        return context
+
+    def get_profile_context(self):
+        context = {}
         if FriendShip.objects.filter(followee=self.user, follower=self.request.user).exists():
             context["is_follow"] = True
         else:
             context["is_follow"] = False
-        context["follow_number"] = FriendShip.objects.filter(follower=self.user).count()
-        context["follower_number"] = FriendShip.objects.filter(followee=self.user).count()
-        context["like_list"] = Like.objects.filter(user=self.request.user).values_list("tweet__pk", flat=True)
+        context["follow_number"] = self.user.following_count
+        context["follower_number"] = self.user.follower_count
         return context
 
 
-class FollowView(LoginRequiredMixin, RedirectView):
-    url = reverse_lazy("tweets:home")
+class UserProfileMoreView(UserProfileView):
+    template_name = "accounts/user_profile_tweets.html"
 
+    def get_profile_context(self):
+        # 追加読み込みではプロフィールのヘッダーを描画しない
+        return {}
+
+
+# 同期版は benchmarks の sync/ で非同期版と比べるためのもの。比べられるよう、非同期版と同じ処理にそろえる
+class FollowView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
+        follower = request.user
         try:
-            follower = User.objects.get(username=self.request.user)
             followee = User.objects.get(username=self.kwargs["username"])
         except User.DoesNotExist:
             messages.error(request, "そのユーザーは存在しません")
@@ -65,20 +103,17 @@ class FollowView(LoginRequiredMixin, RedirectView):
         if follower == followee:
             messages.error(request, "自分自身をフォローできません")
             return HttpResponseBadRequest("you can't follow yourself")
-        if FriendShip.objects.filter(followee=followee, follower=follower):
-            messages.info(request, "既にフォローしています")
-        else:
-            FriendShip.objects.create(followee=followee, follower=follower)
+        if FriendShip.objects.follow(follower, followee):
             messages.success(request, "フォローしました")
-        return super().post(request, *args, **kwargs)
-
+        else:
+            messages.info(request, "既にフォローしています")
+        return redirect("tweets:home")
 
-class UnFollowView(LoginRequiredMixin, RedirectView):
-    url = reverse_lazy("tweets:home")
 
+class UnFollowView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
+        follower = request.user
         try:
-            follower = User.objects.get(username=self.request.user)
             followee = User.objects.get(username=self.kwargs["username"])
         except User.DoesNotExist:
             messages.error(request, "そのユーザーは存在しません")
@@ -86,29 +121,226 @@ class UnFollowView(LoginRequiredMixin, RedirectView):
         if follower == followee:
             messages.error(request, "自分自身はアンフォローできません")
             return HttpResponseBadRequest("you can't unfollow yourself")
-        elif FriendShip.objects.filter(followee=followee, follower=follower).exists():
-            unfollow = FriendShip.objects.get(followee=followee, follower=follower)
-            unfollow.delete()
-            messages.success(request, "{}のフォローを外しました", kwargs["username"])
-            return super().post(request, *args, **kwargs)
+        if FriendShip.objects.unfollow(follower, followee):
+            messages.success(request, f"{kwargs['username']}のフォローを外しました")
+            return redirect("tweets:home")
         else:
-            messages.info(request, "あなたは{}をフォローしていません", kwargs["username"])
+            messages.info(request, f"あなたは{kwargs['username']}をフォローしていません")
             return HttpResponseBadRequest("you don't follow that username")
 
 
-class FollowingListView(LoginRequiredMixin, ListView):
-    template_name = "accounts/following_list.html"
-    context_object_name = "following_list"
+class AsyncFollowView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
+        follower = request.user
+        try:
+            followee = await User.objects.aget(username=self.kwargs["username"])
+        except User.DoesNotExist:
+            messages.error(request, "そのユーザーは存在しません")
+            return HttpResponseNotFound("that user doesn't exist")
+        if follower == followee:
+            messages.error(request, "自分自身をフォローできません")
+            return HttpResponseBadRequest("you can't follow yourself")
+        if await FriendShip.objects.afollow(follower, followee):
+            messages.success(request, "フォローしました")
+        else:
+            messages.info(request, "既にフォローしています")
+        return redirect("tweets:home")
+
+
+class AsyncUnFollowView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
+        follower = request.user
+        try:
+            followee = await User.objects.aget(username=self.kwargs["username"])
+        except User.DoesNotExist:
+            messages.error(request, "そのユーザーは存在しません")
+            return HttpResponseNotFound("that user doesn't exist")
+        if follower == followee:
+            messages.error(request, "自分自身はアンフォローできません")
+            return HttpResponseBadRequest("you can't unfollow yourself")
+        if await FriendShip.objects.aunfollow(follower, followee):
+            messages.success(request, f"{kwargs['username']}のフォローを外しました")
+            return redirect("tweets:home")
+        else:
+            messages.info(request, f"あなたは{kwargs['username']}をフォローしていません")
+            return HttpResponseBadRequest("you don't follow that username")
+
+
+class FriendShipListMixin(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin):
+    # user_field のユーザーの一覧を新しい順にページごとに表示する。相手は other_field
+    user_field = None
+    other_field = None
 
     def get_queryset(self):
-        following_user = get_object_or_404(User, username=self.kwargs["username"])
-        return FriendShip.objects.filter(follower=following_user).select_related("followee").order_by("-created_at")
+        self.user = get_profile_user(self.kwargs["username"])
+        # 表示するページの相手を閲覧者がフォローしているかは、一覧と同じクエリで求める
+        followed_by_me = FriendShip.objects.filter(follower=self.request.user, followee=OuterRef(self.other_field))
+        return (
+            FriendShip.objects.filter(**{self.user_field: self.user})
+            .select_related(self.other_field)
+            .only("created_at", self.other_field, f"{self.other_field}__username")
+            .annotate(is_followed_by_me=Exists(followed_by_me))
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["user"] = self.user
+        return context
+
+
+class FollowingListView(FriendShipListMixin, ListView):
+    template_name = "accounts/following_list.html"
+    context_object_name = "following_list"
+    user_field = "follower"
+    other_field = "followee"
 
 
-class FollowerListView(LoginRequiredMixin, ListView):
+class FollowerListView(FriendShipListMixin, ListView):
     template_name = "accounts/follower_list.html"
     context_object_name = "follower_list"
+    user_field = "followee"
+    other_field = "follower"
+
+
+class Echo:
+    # csv.writer の書き込み先。書いた行をそのまま返してStreamingHttpResponseに渡す
+    def write(self, value):
+        return value
+
+
+class FriendShipExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    # 一覧の全件をCSVかJSON Linesで少しずつ返す。行はiterator()で chunk_size 件ずつ読むので、件数によらずメモリは一定
+    user_field = None
+    other_field = None
+    chunk_size = 2000
+
+    def test_func(self):
+        # フォロワーが多いユーザーの一覧を他人がまとめて取得できないよう、本人だけに許可する
+        return self.request.user.username == self.kwargs["username"]
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get("format", "csv")
+        if export_format not in ("csv", "jsonl"):
+            return HttpResponseBadRequest("format must be csv or jsonl")
+        rows = (
+            FriendShip.objects.filter(**{self.user_field: request.user})
+            .order_by("-created_at", "-pk")
+            .values_list(f"{self.other_field}__username", "created_at")
+            .iterator(chunk_size=self.chunk_size)
+        )
+        if export_format == "csv":
+            writer = csv.writer(Echo())
+            lines = chain([writer.writerow(["username", "created_at"])], (writer.writerow(row) for row in rows))
+            content_type = "text/csv"
+        else:
+            lines = (
+                json.dumps({"username": username, "created_at": created_at.isoformat()}, ensure_ascii=False) + "\n"
+                for username, created_at in rows
+            )
+            content_type = "application/x-ndjson"
+        response = StreamingHttpResponse(lines, content_type=f"{content_type}; charset=utf-8")
+        filename = f"{request.user.username}_{self.export_name}.{export_format}"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+
+class FollowingExportView(FriendShipExportView):
+    user_field = "follower"
+    other_field = "followee"
+    export_name = "following"
+
+
+class FollowerExportView(FriendShipExportView):
+    user_field = "followee"
+    other_field = "follower"
+    export_name = "followers"
+
+
+class UserAPIView(
+    LoginRequiredMixin, ReplicaReadMixin, ConditionalGetMixin, JSONResponseMixin, KeysetPaginationMixin, View
+):
+    def get_validators(self):
+        self.user = get_profile_user(self.kwargs["username"])
+        tweets = sharding.for_user(Tweet.objects.filter(user=self.user), self.user.pk)
+        tweet_ids = list(keyset_slice(tweets, self.get_position(), self.paginate_by + 1).values_list("pk", flat=True))
+        # 閲覧者がフォロー・アンフォローすると双方のフォロー数が変わるので、is_followの変化もETagに入る
+        # ツイートの削除・いいねはページに出るツイートのキャッシュのバージョンで表す
+        parts = (
+            self.user.follower_count,
+            self.user.following_count,
+            self.request.user.following_count,
+            get_tweet_versions(tweet_ids),
+        )
+        return parts, None
+
+    def get(self, request, *args, **kwargs):
+        tweets = sharding.for_user(Tweet.objects.select_related("user"), self.user.pk)
+        queryset = tweets.filter(user=self.user).with_like_state(request.user)
+        _, page, tweets, _ = self.paginate_queryset(queryset, self.paginate_by)
+        context = {
+            "user": {
+                "username": self.user.username,
+                "follower_count": self.user.follower_count,
+                "following_count": self.user.following_count,
+                "is_follow": FriendShip.objects.filter(followee=self.user, follower=request.user).exists(),
+            },
+            "tweets": [serialize_tweet(tweet) for tweet in tweets],
+            "next": page.next_cursor,
+        }
+        return self.render_to_json_response(context)
+
+
+class FriendShipAPIView(
+    LoginRequiredMixin, ReplicaReadMixin, ConditionalGetMixin, JSONResponseMixin, KeysetPaginationMixin, View
+):
+    # user_field のユーザーの一覧で、相手は other_field。count_field のフォロー数が増減するとETagが変わる
+    user_field = None
+    other_field = None
+    count_field = None
+
+    def get_validators(self):
+        self.user = get_profile_user(self.kwargs["username"])
+        self.friendships = FriendShip.objects.filter(**{self.user_field: self.user})
+        latest = self.friendships.order_by("-created_at").values_list("created_at", flat=True).first()
+        # フォローを外しても一番新しい日時は変わらないので、Last-Modifiedは付けない
+        return (getattr(self.user, self.count_field), latest), None
+
+    def get(self, request, *args, **kwargs):
+        fields = ["created_at", self.other_field, f"{self.other_field}__username"]
+        queryset = self.friendships.select_related(self.other_field).only(*fields)
+        _, page, friendships, _ = self.paginate_queryset(queryset, self.paginate_by)
+        context = {
+            "users": [
+                {"username": getattr(friendship, self.other_field).username, "created_at": friendship.created_at}
+                for friendship in friendships
+            ],
+            "next": page.next_cursor,
+        }
+        return self.render_to_json_response(context)
+
+
+class FollowingAPIView(FriendShipAPIView):
+    user_field = "follower"
+    other_field = "followee"
+    count_field = "following_count"
+
+
+class FollowerAPIView(FriendShipAPIView):
+    user_field = "followee"
+    other_field = "follower"
+    count_field = "follower_count"
+
+
+class FollowSuggestionView(LoginRequiredMixin, ReplicaReadMixin, ListView):
+    template_name = "accounts/follow_suggestions.html"
+    context_object_name = "suggestion_list"
 
     def get_queryset(self):
-        follower_user = get_object_or_404(User, username=self.kwargs["username"])
-        return FriendShip.objects.filter(followee=follower_user).select_related("follower").order_by("-created_at")
+        # おすすめは build_follow_suggestions でまとめて作るので、その後にフォローした人はここで除く
+        following = FriendShip.objects.filter(follower=self.request.user).values("followee")
+        return (
+            FollowSuggestion.objects.filter(user=self.request.user)
+            .exclude(suggested__in=following)
+            .select_related("suggested")
+            .order_by("-mutual_count", "suggested")
+        )
@@ -0,0 +1,79 @@
+import itertools
+import random
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.utils import timezone
+
+from accounts.models import FriendShip
+from tweets.models import Like, Tweet
+
+User = get_user_model()
+
+PASSWORD = "benchmarkpassword"
+BATCH_SIZE = 1000
+
+
+def power_law_sampler(rng, population, alpha):
+    # 先頭の要素ほど選ばれやすい (Zipf風の) 分布で選ぶ
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** alpha for rank in range(len(population))))
+    return lambda k: rng.choices(population, cum_weights=cum_weights, k=k)
+
+
+def seed(users=100, tweets=1000, follows=20, likes=5, alpha=1.2, seed=0):
+    rng = random.Random(seed)
+    now = timezone.now()
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [User(username=f"bench{i}", email=f"bench{i}@example.com", password=password) for i in range(users)],
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.filter(username__startswith="bench").order_by("pk").values_list("pk", flat=True))
+    popular_users = power_law_sampler(rng, user_ids, alpha)
+
+    Tweet.objects.bulk_create(
+        (
+            Tweet(
+                user_id=user_id,
+                content=f"benchmark tweet {i}",
+                created_at=now - timedelta(seconds=rng.randrange(30 * 86400)),
+            )
+            for i, user_id in enumerate(popular_users(tweets))
+        ),
+        batch_size=BATCH_SIZE,
+    )
+    tweet_ids = list(Tweet.objects.filter(user_id__in=user_ids).order_by("pk").values_list("pk", flat=True))
+    rng.shuffle(tweet_ids)
+    popular_tweets = power_law_sampler(rng, tweet_ids, alpha)
+
+    friendships = set()
+    for follower_id in user_ids:
+        degree = min(users - 1, int(rng.expovariate(1 / follows)) + 1)
+        for followee_id in popular_users(degree):
+            if followee_id != follower_id:
+                friendships.add((follower_id, followee_id))
+    FriendShip.objects.bulk_create(
+        (FriendShip(follower_id=follower_id, followee_id=followee_id) for follower_id, followee_id in friendships),
+        batch_size=BATCH_SIZE,
+    )
+
+    like_pairs = set(zip((rng.choice(user_ids) for _ in range(tweets * likes)), popular_tweets(tweets * likes)))
+    Like.objects.bulk_create(
+        (Like(user_id=user_id, tweet_id=tweet_id) for user_id, tweet_id in like_pairs),
+        batch_size=BATCH_SIZE,
+    )
+
+    # bulk_createではシグナルが飛ばないので、非正規化したデータはまとめて作り直す
+    commands = (
+        "reconcile_like_counts",
+        "reconcile_follow_counts",
+        "rebuild_timelines",
+        "rebuild_search_index",
+        "rebuild_tags",
+    )
+    for command in commands:
+        call_command(command, stdout=StringIO())
+    return user_ids
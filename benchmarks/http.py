@@ -0,0 +1,135 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.middleware.csrf import CSRF_ALLOWED_CHARS
+from django.test import Client
+from django.utils.crypto import get_random_string
+
+from benchmarks.runner import percentile
+
+HOST = "127.0.0.1"
+OK_STATUSES = (200, 302)
+
+
+class HTTPClient:
+    # 計測にクライアント側の処理が混ざらないよう、1本の接続をkeep-aliveで使い回す最小限のHTTP/1.1クライアント
+    # user を渡さなければログインしていない状態から始め、Set-Cookieで受け取ったセッションを使う
+    def __init__(self, port, user=None):
+        self.port = port
+        self.cookies = {settings.CSRF_COOKIE_NAME: get_random_string(32, CSRF_ALLOWED_CHARS)}
+        if user is not None:
+            client = Client()
+            client.force_login(user)
+            self.cookies[settings.SESSION_COOKIE_NAME] = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def post(self, path, data=None):
+        status, _ = await self.request("POST", path, data)
+        return status
+
+    async def request(self, method, path, data=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+        body = urlencode(data or {}).encode()
+        cookie = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        request = f"{method} {path} HTTP/1.1\r\nHost: {HOST}:{self.port}\r\nCookie: {cookie}\r\n"
+        if method != "GET":
+            # ログインするとCSRFトークンが変わるので、毎回Cookieの値を送る
+            request += (
+                f"X-CSRFToken: {self.cookies[settings.CSRF_COOKIE_NAME]}\r\n"
+                "Content-Type: application/x-www-form-urlencoded\r\n"
+                f"Content-Length: {len(body)}\r\n"
+            )
+        self.writer.write(request.encode() + b"\r\n" + body)
+        await self.writer.drain()
+        return await self._read_response()
+
+    async def _read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+            if key.lower() == "set-cookie":
+                name, _, value = value.strip().split(";", 1)[0].partition("=")
+                self.cookies[name] = value
+        if "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding") == "chunked":
+            while size := int((await self.reader.readline()).strip(), 16):
+                await self.reader.readexactly(size + 2)
+            await self.reader.readline()
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, headers
+
+
+def start_server(port, workers, write_behind=False):
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": "benchmarks.settings"}
+    env["BENCHMARK_LIKE_WRITE_BEHIND"] = "1" if write_behind else "0"
+    command = [sys.executable, "-m", "uvicorn", "mysite.asgi:application", "--host", HOST, "--port", str(port)]
+    command += ["--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start within 30 seconds")
+
+
+async def _drive(client, paths, count, latencies):
+    errors = 0
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            status = await client.post(paths[i % len(paths)])
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            await client.close()
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+        if status not in OK_STATUSES:
+            errors += 1
+    return errors
+
+
+async def run_scenario(clients, paths_by_client, requests):
+    # 各クライアントは like→unlike のように組で送り、終了時に元の状態へ戻す
+    per_client = max(2, requests // len(clients) // 2 * 2)
+    await asyncio.gather(*(_drive(client, paths_by_client[client], 2, []) for client in clients))
+    latencies = []
+    start = time.perf_counter()
+    errors = await asyncio.gather(
+        *(_drive(client, paths_by_client[client], per_client, latencies) for client in clients)
+    )
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in clients))
+    total = per_client * len(clients)
+    return {
+        "requests": total,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+        "errors": sum(errors),
+    }
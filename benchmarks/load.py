@@ -0,0 +1,155 @@
+import asyncio
+import random
+import statistics
+import time
+from bisect import bisect_right
+from collections import defaultdict
+
+from django.urls import reverse
+
+from benchmarks import dataset
+from benchmarks.http import OK_STATUSES, HTTPClient
+from benchmarks.runner import percentile
+
+# ログインしたあとに繰り返す操作の割合。like・follow はすでにしていれば一定の確率で取り消す
+MIX = {"home": 55, "like": 25, "create": 10, "follow": 10}
+UNDO_RATIO = 0.4
+HISTOGRAM_MS = (5, 10, 25, 50, 100, 250, 500, 1000)
+HISTOGRAM_LABELS = tuple(f"<{bound}" for bound in HISTOGRAM_MS) + (f">={HISTOGRAM_MS[-1]}",)
+
+
+class Population:
+    # 仮想ユーザーが操作する対象。人気のあるツイート・ユーザーほど選ばれやすくする
+    def __init__(self, rng, usernames, tweet_ids, alpha=1.2):
+        self.rng = rng
+        self.usernames = usernames
+        self.popular_users = dataset.power_law_sampler(rng, usernames, alpha)
+        self.popular_tweets = dataset.power_law_sampler(rng, tweet_ids, alpha)
+
+
+def parse_server_timing(value):
+    timings = {}
+    for metric in filter(None, (part.strip() for part in value.split(","))):
+        name, *params = metric.split(";")
+        for param in params:
+            key, _, duration = param.partition("=")
+            if key.strip() == "dur":
+                timings[name] = float(duration)
+    return timings
+
+
+class VirtualUser:
+    def __init__(self, port, index, population, samples, think_time, signup_ratio):
+        self.client = HTTPClient(port)
+        self.index = index
+        self.population = population
+        self.rng = random.Random(f"{population.rng.random()}:{index}")
+        self.samples = samples
+        self.think_time = think_time
+        self.signup_ratio = signup_ratio
+        self.username = None
+        self.liked = set()
+        self.followed = set()
+
+    async def send(self, name, method, path, data=None):
+        start = time.perf_counter()
+        try:
+            status, headers = await self.client.request(method, path, data)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            await self.client.close()
+            self.samples[name].append(((time.perf_counter() - start) * 1000, False, 0.0, 0.0))
+            return None
+        elapsed = (time.perf_counter() - start) * 1000
+        timings = parse_server_timing(headers.get("server-timing", ""))
+        self.samples[name].append((elapsed, status in OK_STATUSES, timings.get("db", 0.0), timings.get("lock", 0.0)))
+        return status
+
+    async def run(self, deadline, delay=0):
+        await asyncio.sleep(delay)
+        try:
+            if not await self.sign_in():
+                return
+            while True:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think_time) if self.think_time else 0)
+                if time.monotonic() >= deadline:
+                    break
+                action = self.rng.choices(list(MIX), weights=list(MIX.values()))[0]
+                await getattr(self, action)()
+        finally:
+            await self.client.close()
+
+    async def sign_in(self):
+        if self.rng.random() < self.signup_ratio:
+            self.username = f"load{self.index}x{self.rng.randrange(10**9)}"
+            data = {
+                "username": self.username,
+                "email": f"{self.username}@example.com",
+                "password1": dataset.PASSWORD,
+                "password2": dataset.PASSWORD,
+            }
+            return await self.send("signup", "POST", reverse("accounts:signup"), data) == 302
+        self.username = self.rng.choice(self.population.usernames)
+        data = {"username": self.username, "password": dataset.PASSWORD}
+        return await self.send("login", "POST", reverse("accounts:login"), data) == 302
+
+    async def home(self):
+        await self.send("home", "GET", reverse("tweets:home"))
+
+    async def create(self):
+        content = f"load test {self.rng.randrange(10**6)} #load{self.rng.randrange(20)}"
+        await self.send("create", "POST", reverse("tweets:create"), {"content": content})
+
+    async def like(self):
+        tweet_id = self.population.popular_tweets(1)[0]
+        if self.liked and (tweet_id in self.liked or self.rng.random() < UNDO_RATIO):
+            tweet_id = self.rng.choice(sorted(self.liked))
+            self.liked.discard(tweet_id)
+            await self.send("unlike", "POST", reverse("tweets:unlike", kwargs=dict(pk=tweet_id)))
+            return
+        self.liked.add(tweet_id)
+        await self.send("like", "POST", reverse("tweets:like", kwargs=dict(pk=tweet_id)))
+
+    async def follow(self):
+        username = self.population.popular_users(1)[0]
+        if username == self.username:
+            return
+        if self.followed and (username in self.followed or self.rng.random() < UNDO_RATIO):
+            username = self.rng.choice(sorted(self.followed))
+            self.followed.discard(username)
+            await self.send("unfollow", "POST", reverse("accounts:unfollow", kwargs=dict(username=username)))
+            return
+        self.followed.add(username)
+        await self.send("follow", "POST", reverse("accounts:follow", kwargs=dict(username=username)))
+
+
+async def run(port, population, concurrency, duration, think_time=1.0, signup_ratio=0.1, ramp_up=0):
+    # concurrency 人の仮想ユーザーを ramp_up 秒かけて順に始め、duration 秒たったら止める
+    samples = defaultdict(list)
+    start = time.perf_counter()
+    deadline = time.monotonic() + duration
+    users = [VirtualUser(port, i, population, samples, think_time, signup_ratio) for i in range(concurrency)]
+    await asyncio.gather(*(user.run(deadline, ramp_up * i / concurrency) for i, user in enumerate(users)))
+    return summarize(samples, time.perf_counter() - start)
+
+
+def summarize(samples, elapsed):
+    results = {}
+    for name, rows in sorted(samples.items()):
+        latencies = [ms for ms, _, _, _ in rows]
+        locks = [lock for _, _, _, lock in rows]
+        histogram = dict.fromkeys(HISTOGRAM_LABELS, 0)
+        for ms in latencies:
+            histogram[HISTOGRAM_LABELS[bisect_right(HISTOGRAM_MS, ms)]] += 1
+        results[name] = {
+            "requests": len(rows),
+            "rps": round(len(rows) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "db_ms": round(statistics.fmean(db for _, _, db, _ in rows), 2),
+            "lock_ms": round(statistics.fmean(locks), 2),
+            "lock_max_ms": round(max(locks), 2),
+            "errors": sum(1 for _, ok, _, _ in rows if not ok),
+            "histogram": histogram,
+        }
+    return results
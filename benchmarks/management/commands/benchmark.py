@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from benchmarks import dataset, runner
+
+
+class Command(BaseCommand):
+    help = "テスト用DBに合成データを投入して各URLのクエリ数・レイテンシ・メモリを計測し、予算と比較します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--tweets", type=int, default=5000)
+        parser.add_argument("--follows", type=int, default=30, help="1ユーザーあたりの平均フォロー数")
+        parser.add_argument("--likes", type=int, default=5, help="1ツイートあたりの平均いいね数")
+        parser.add_argument("--alpha", type=float, default=1.2, help="べき分布の偏り")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--budgets", default=str(runner.BUDGETS_PATH))
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            user_ids = dataset.seed(
+                users=options["users"],
+                tweets=options["tweets"],
+                follows=options["follows"],
+                likes=options["likes"],
+                alpha=options["alpha"],
+                seed=options["seed"],
+            )
+            results = runner.run(user_ids, repeat=options["repeat"])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write(
+                f"{'url':<26}{'status':>7}{'queries':>9}{'p50 ms':>10}{'p95 ms':>10}{'peak KB':>10}{'body KB':>10}"
+            )
+            for name, result in results.items():
+                self.stdout.write(
+                    f"{name:<26}{result['status']:>7}{result['queries']:>9}"
+                    f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['peak_kb']:>10}{result['body_kb']:>10}"
+                )
+
+        violations = runner.check_budgets(results, runner.load_budgets(options["budgets"]))
+        if violations:
+            raise CommandError("予算を超えたURLがあります:\n" + "\n".join(violations))
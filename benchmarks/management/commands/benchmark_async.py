@@ -0,0 +1,100 @@
+import asyncio
+import importlib.util
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+
+from accounts.models import FriendShip
+from benchmarks import dataset, http
+from tweets.models import Like, Tweet
+
+User = get_user_model()
+
+# シナリオごとに (アプリの名前空間, 交互に送るURL名)
+SCENARIOS = {
+    "like": ("tweets", ("like", "unlike")),
+    "follow": ("accounts", ("follow", "unfollow")),
+}
+
+
+class Command(BaseCommand):
+    help = "uvicorn上でいいね・フォローの同期版と非同期版のビューに同時接続で負荷をかけ、スループットとレイテンシを比較します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=300)
+        parser.add_argument("--tweets", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--concurrency", type=int, default=50, help="同時接続数")
+        parser.add_argument("--requests", type=int, default=2000, help="シナリオごとのリクエスト数")
+        parser.add_argument("--workers", type=int, default=1, help="uvicornのワーカー数")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument(
+            "--write-behind", action="store_true", help="いいねをバッファ経由で書き込むモードで計測します"
+        )
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+
+    def handle(self, *args, **options):
+        if settings.ROOT_URLCONF != "benchmarks.urls":
+            raise CommandError("--settings=benchmarks.settings を指定して実行してください")
+        if importlib.util.find_spec("uvicorn") is None:
+            raise CommandError("uvicornがインストールされていません (pip install -r requirements.txt)")
+        if options["users"] <= options["concurrency"]:
+            raise CommandError("--users は --concurrency より大きくしてください")
+
+        # 毎回まっさらなDBから始める
+        connection.close()
+        Path(settings.DATABASES["default"]["NAME"]).unlink(missing_ok=True)
+        call_command("migrate", verbosity=0)
+        user_ids = dataset.seed(users=options["users"], tweets=options["tweets"], seed=options["seed"])
+
+        # 全員が同じ人気ツイートにいいねし、同じ人気ユーザーをフォローする (一番競合する書き込み)
+        celebrity = User.objects.get(pk=user_ids[0])
+        tweet = Tweet.objects.filter(user=celebrity).first()
+        users = list(User.objects.filter(pk__in=user_ids[-options["concurrency"] :]))
+        for user in users:
+            Like.objects.unlike(user, tweet)
+            FriendShip.objects.unfollow(user, celebrity)
+        clients = [http.HTTPClient(options["port"], user) for user in users]
+
+        results = {}
+        server = http.start_server(options["port"], options["workers"], options["write_behind"])
+        try:
+            for mode in ("sync", "async"):
+                for scenario, (app_namespace, names) in SCENARIOS.items():
+                    namespace = "sync" if mode == "sync" else app_namespace
+                    paths = [self.get_path(f"{namespace}:{name}", tweet, celebrity) for name in names]
+                    paths_by_client = {client: paths for client in clients}
+                    results[f"{mode}:{scenario}"] = asyncio.run(
+                        http.run_scenario(clients, paths_by_client, options["requests"])
+                    )
+        finally:
+            server.terminate()
+            server.wait()
+
+        # バッファ経由で書き込んだ場合も、終了時には実件数といいね数が一致しているはず
+        tweet.refresh_from_db()
+        if tweet.like_count != Like.objects.filter(tweet=tweet).count():
+            raise CommandError(f"いいね数がLikeの件数と一致しません: {tweet.like_count}")
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write(
+                f"{'scenario':<16}{'requests':>9}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+            )
+            for name, result in results.items():
+                self.stdout.write(
+                    f"{name:<16}{result['requests']:>9}{result['rps']:>10}{result['p50_ms']!s:>10}"
+                    f"{result['p95_ms']!s:>10}{result['p99_ms']!s:>10}{result['errors']:>8}"
+                )
+
+    def get_path(self, url_name, tweet, celebrity):
+        if url_name.endswith("like"):
+            return reverse(url_name, kwargs=dict(pk=tweet.pk))
+        return reverse(url_name, kwargs=dict(username=celebrity.username))
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection, connections
+from django.test import Client
+from django.urls import reverse
+
+from benchmarks import dataset
+from benchmarks.runner import percentile
+from tweets.models import Tweet
+
+User = get_user_model()
+
+OK_STATUSES = {"like": 200, "unlike": 200, "create": 302}
+
+
+def _write(user, tweet, deadline, samples):
+    client = Client(raise_request_exception=False, HTTP_HOST="localhost")
+    client.force_login(user)
+    operations = [
+        ("like", reverse("tweets:like", kwargs=dict(pk=tweet.pk)), None),
+        ("unlike", reverse("tweets:unlike", kwargs=dict(pk=tweet.pk)), None),
+        ("create", reverse("tweets:create"), {"content": f"contention by {user.username}"}),
+    ]
+    i = 0
+    try:
+        while time.monotonic() < deadline:
+            name, url, data = operations[i % len(operations)]
+            i += 1
+            start = time.perf_counter()
+            response = client.post(url, data)
+            elapsed = (time.perf_counter() - start) * 1000
+            # テスト用のClientはリクエストの終わりに接続を閉じないので、request_finishedと同じ処理をする
+            close_old_connections()
+            samples[name].append((elapsed, response.status_code == OK_STATUSES[name]))
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "いいね・いいね解除・ツイート投稿を複数スレッドから同時に行い、SQLiteの書き込みの競合を計測します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--tweets", type=int, default=500)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--threads", type=int, default=16, help="同時に書き込むスレッド数")
+        parser.add_argument("--duration", type=float, default=10, help="計測する秒数")
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+
+    def handle(self, *args, **options):
+        if settings.ROOT_URLCONF != "benchmarks.urls":
+            raise CommandError("--settings=benchmarks.settings を指定して実行してください")
+        if options["users"] <= options["threads"]:
+            raise CommandError("--users は --threads より大きくしてください")
+
+        connection.close()
+        database = Path(settings.DATABASES["default"]["NAME"])
+        for path in (database, Path(f"{database}-wal"), Path(f"{database}-shm")):
+            path.unlink(missing_ok=True)
+        call_command("migrate", verbosity=0)
+        user_ids = dataset.seed(users=options["users"], tweets=options["tweets"], seed=options["seed"])
+        tweet = Tweet.objects.filter(user_id=user_ids[0]).first()
+        users = list(User.objects.filter(pk__in=user_ids[-options["threads"] :]))
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            journal_mode = cursor.fetchone()[0]
+        connection.close()
+
+        deadline = time.monotonic() + options["duration"]
+        samples = [defaultdict(list) for _ in users]
+        threads = [threading.Thread(target=_write, args=(user, tweet, deadline, s)) for user, s in zip(users, samples)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results = {}
+        for name in OK_STATUSES:
+            merged = [sample for s in samples for sample in s[name]]
+            latencies = [ms for ms, _ in merged]
+            results[name] = {
+                "requests": len(merged),
+                "rps": round(len(merged) / elapsed, 1),
+                "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+                "p95_ms": round(percentile(latencies, 95), 2) if latencies else None,
+                "errors": sum(1 for _, ok in merged if not ok),
+            }
+
+        profile = os.environ.get("DJANGO_DB_PROFILE", "development")
+        if options["json"]:
+            self.stdout.write(json.dumps({"profile": profile, "journal_mode": journal_mode, "results": results}))
+            return
+        self.stdout.write(f"profile={profile} journal_mode={journal_mode} threads={options['threads']}")
+        self.stdout.write(f"{'operation':<10}{'requests':>9}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<10}{result['requests']:>9}{result['rps']:>10}{result['p50_ms']!s:>10}"
+                f"{result['p95_ms']!s:>10}{result['errors']:>8}"
+            )
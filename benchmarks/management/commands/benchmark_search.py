@@ -0,0 +1,115 @@
+import itertools
+import json
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.utils import timezone
+
+from benchmarks import dataset
+from benchmarks.runner import percentile
+from tweets import search
+from tweets.models import Tweet
+
+User = get_user_model()
+
+WORDS = [
+    "東京", "ラーメン", "仕事", "天気", "会議", "電車", "猫", "コーヒー", "週末", "映画",
+    "大阪", "カレー", "旅行", "音楽", "ゲーム", "Django", "Python", "雨", "桜", "読書",
+    "散歩", "寿司", "温泉", "新幹線", "筋トレ", "締め切り", "リリース", "富士山", "たこ焼き", "プログラミング",
+]  # fmt: skip
+RARE_WORD = "オーロラ"
+TEMPLATES = ["{0}で{1}", "{0}と{1}が好き", "今日は{0}、明日は{1}", "{0}の{1}について", "{0} {1}"]
+QUERIES = {
+    "common": "東京",
+    "tail": "プログラミング",
+    "rare": RARE_WORD,
+    "phrase": "東京 ラーメン",
+    "single_char": "猫",
+    "ascii": "django",
+    "no_hit": "存在しない言葉",
+}
+
+
+def generate_contents(rng, count):
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(WORDS))))
+    for _ in range(count):
+        first, second = rng.choices(WORDS, cum_weights=cum_weights, k=2)
+        # 1万件に1件くらいしか出てこない語も混ぜる
+        if rng.random() < 0.0001:
+            second = RARE_WORD
+        yield rng.choice(TEMPLATES).format(first, second)
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": round(percentile(samples, 50), 2), "p95_ms": round(percentile(samples, 95), 2)}
+
+
+class Command(BaseCommand):
+    help = "テスト用DBに大量のツイートを投入し、全文検索インデックスとicontainsの検索レイテンシを比較します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tweets", type=int, default=1000000)
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--scan-repeat", type=int, default=3, help="icontainsで検索する回数")
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{options['tweets']}件のツイートのインデックス作成: {results['index_seconds']}秒")
+        self.stdout.write(f"{'query':<14}{'hits':>9}{'fts p50':>10}{'fts p95':>10}{'scan p50':>10}{'scan p95':>10}")
+        for name, result in results["queries"].items():
+            self.stdout.write(
+                f"{name:<14}{result['hits']:>9}{result['fts']['p50_ms']:>10}{result['fts']['p95_ms']:>10}"
+                f"{result['scan']['p50_ms']:>10}{result['scan']['p95_ms']:>10}"
+            )
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        now = timezone.now()
+        User.objects.bulk_create([User(username=f"bench{i}") for i in range(options["users"])])
+        user_ids = list(User.objects.values_list("pk", flat=True))
+        Tweet.objects.bulk_create(
+            (
+                Tweet(
+                    user_id=rng.choice(user_ids),
+                    content=content,
+                    created_at=now - timedelta(seconds=rng.randrange(365 * 86400)),
+                )
+                for content in generate_contents(rng, options["tweets"])
+            ),
+            batch_size=dataset.BATCH_SIZE,
+        )
+
+        start = time.perf_counter()
+        search.rebuild("default")
+        results = {"index_seconds": round(time.perf_counter() - start, 1), "queries": {}}
+
+        for name, query in QUERIES.items():
+            scan = Tweet.objects.filter(content__icontains=query).order_by("-created_at", "-id").values_list("pk")
+            results["queries"][name] = {
+                "hits": len(search.search(query, 0, search.MAX_RESULTS)),
+                "fts": measure(lambda: search.search(query, 0, 20), options["repeat"]),
+                "scan": measure(lambda: list(scan[:20]), options["scan_repeat"]),
+            }
+        return results
@@ -0,0 +1,103 @@
+import asyncio
+import importlib.util
+import json
+import random
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from benchmarks import dataset, http, load
+from tweets.models import Tweet
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "合成データを投入したuvicornに仮想ユーザーで登録・ログイン・ホーム・投稿・いいね・フォローの操作を混ぜて送り、"
+        "エンドポイントごとのスループット・レイテンシの分布・DBのロック待ちを計測します"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--tweets", type=int, default=20000)
+        parser.add_argument("--follows", type=int, default=30, help="1ユーザーあたりの平均フォロー数")
+        parser.add_argument("--likes", type=int, default=5, help="1ツイートあたりの平均いいね数")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--concurrency", type=int, default=50, help="同時に操作する仮想ユーザーの数")
+        parser.add_argument("--duration", type=float, default=30, help="計測する秒数")
+        parser.add_argument("--think-time", type=float, default=1.0, help="操作の間隔の平均秒数 (指数分布)")
+        parser.add_argument("--signup-ratio", type=float, default=0.1, help="新規登録から始める仮想ユーザーの割合")
+        parser.add_argument("--ramp-up", type=float, default=5, help="仮想ユーザーを全員始めるまでの秒数")
+        parser.add_argument("--workers", type=int, default=1, help="uvicornのワーカー数")
+        parser.add_argument("--port", type=int, default=8766)
+        parser.add_argument(
+            "--write-behind", action="store_true", help="いいねをバッファ経由で書き込むモードで計測します"
+        )
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+
+    def handle(self, *args, **options):
+        if settings.ROOT_URLCONF != "benchmarks.urls":
+            raise CommandError("--settings=benchmarks.settings を指定して実行してください")
+        if importlib.util.find_spec("uvicorn") is None:
+            raise CommandError("uvicornがインストールされていません (pip install -r requirements.txt)")
+
+        connection.close()
+        database = Path(settings.DATABASES["default"]["NAME"])
+        for path in (database, Path(f"{database}-wal"), Path(f"{database}-shm")):
+            path.unlink(missing_ok=True)
+        call_command("migrate", verbosity=0)
+        user_ids = dataset.seed(
+            users=options["users"],
+            tweets=options["tweets"],
+            follows=options["follows"],
+            likes=options["likes"],
+            seed=options["seed"],
+        )
+        usernames = list(User.objects.filter(pk__in=user_ids).order_by("pk").values_list("username", flat=True))
+        tweet_ids = list(Tweet.objects.order_by("pk").values_list("pk", flat=True))
+        connection.close()
+        population = load.Population(random.Random(options["seed"]), usernames, tweet_ids)
+
+        server = http.start_server(options["port"], options["workers"], options["write_behind"])
+        try:
+            results = asyncio.run(
+                load.run(
+                    options["port"],
+                    population,
+                    options["concurrency"],
+                    options["duration"],
+                    think_time=options["think_time"],
+                    signup_ratio=options["signup_ratio"],
+                    ramp_up=options["ramp_up"],
+                )
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"concurrency={options['concurrency']} workers={options['workers']} duration={options['duration']}s"
+            f" think_time={options['think_time']}s"
+        )
+        self.stdout.write(
+            f"{'endpoint':<10}{'requests':>9}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+            f"{'db ms':>8}{'lock ms':>9}{'lock max':>10}{'errors':>8}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<10}{result['requests']:>9}{result['rps']:>8}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+                f"{result['p99_ms']:>9}{result['db_ms']:>8}{result['lock_ms']:>9}{result['lock_max_ms']:>10}"
+                f"{result['errors']:>8}"
+            )
+        self.stdout.write("")
+        self.stdout.write(f"{'endpoint':<10}" + "".join(f"{label:>8}" for label in load.HISTOGRAM_LABELS))
+        for name, result in results.items():
+            self.stdout.write(f"{name:<10}" + "".join(f"{count:>8}" for count in result["histogram"].values()))
@@ -0,0 +1,132 @@
+import json
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import FriendShip
+from tweets.models import Tweet
+
+User = get_user_model()
+
+BUDGETS_PATH = Path(__file__).resolve().parent / "budgets.json"
+
+# 直前に測ったURLのETagを付けて、変わっていないときの304を測る
+CONDITIONAL_TARGETS = {
+    "tweets:api_home:304": "tweets:api_home",
+    "accounts:api_user:304": "accounts:api_user",
+}
+
+
+def load_budgets(path=BUDGETS_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_targets(user_ids):
+    # 一番フォローしているユーザーを閲覧者に、一番人気のユーザーをプロフィールの対象にする
+    viewer = User.objects.filter(pk__in=user_ids).annotate(n=Count("friendships_as_follower")).latest("n")
+    celebrity = User.objects.get(pk=user_ids[0])
+    stranger = User.objects.filter(pk__in=user_ids).exclude(pk=viewer.pk).order_by("-pk").first()
+    FriendShip.objects.filter(follower=viewer, followee=stranger).delete()
+    tweet = Tweet.objects.filter(user=celebrity).first() or Tweet.objects.first()
+
+    # like/unlike, follow/unfollowは組にして、1周ごとに元の状態に戻す
+    targets = [
+        ("tweets:home", "get", reverse("tweets:home")),
+        ("tweets:detail", "get", reverse("tweets:detail", kwargs=dict(pk=tweet.pk))),
+        ("tweets:search", "get", reverse("tweets:search") + "?q=benchmark"),
+        ("accounts:user_profile", "get", reverse("accounts:user_profile", kwargs=dict(username=celebrity))),
+        ("accounts:following_list", "get", reverse("accounts:following_list", kwargs=dict(username=viewer))),
+        ("accounts:follower_list", "get", reverse("accounts:follower_list", kwargs=dict(username=celebrity))),
+        ("tweets:api_home", "get", reverse("tweets:api_home")),
+        ("tweets:api_home:304", "get", reverse("tweets:api_home")),
+        ("tweets:api_detail", "get", reverse("tweets:api_detail", kwargs=dict(pk=tweet.pk))),
+        ("accounts:api_user", "get", reverse("accounts:api_user", kwargs=dict(username=celebrity))),
+        ("accounts:api_user:304", "get", reverse("accounts:api_user", kwargs=dict(username=celebrity))),
+        ("accounts:api_following", "get", reverse("accounts:api_following", kwargs=dict(username=viewer))),
+        ("accounts:api_followers", "get", reverse("accounts:api_followers", kwargs=dict(username=celebrity))),
+        ("tweets:like", "post", reverse("tweets:like", kwargs=dict(pk=tweet.pk))),
+        ("tweets:unlike", "post", reverse("tweets:unlike", kwargs=dict(pk=tweet.pk))),
+        ("accounts:follow", "post", reverse("accounts:follow", kwargs=dict(username=stranger))),
+        ("accounts:unfollow", "post", reverse("accounts:unfollow", kwargs=dict(username=stranger))),
+    ]
+    return viewer, targets
+
+
+def count_queries(captured_queries):
+    # テストのトランザクション内かどうかで増減しないよう、セーブポイントは数えない
+    return sum(1 for query in captured_queries if "SAVEPOINT" not in query["sql"])
+
+
+def percentile(samples, p):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[p - 1]
+
+
+def run(user_ids, repeat=20):
+    viewer, targets = build_targets(user_ids)
+    client = Client()
+    client.force_login(viewer)
+    timings = {name: [] for name, _, _ in targets}
+    results = {name: {"queries": 0, "peak_kb": 0, "status": None} for name, _, _ in targets}
+    etags = {}
+
+    for _ in range(repeat):
+        for name, method, url in targets:
+            headers = {}
+            if name in CONDITIONAL_TARGETS:
+                headers["HTTP_IF_NONE_MATCH"] = etags.get(CONDITIONAL_TARGETS[name], "")
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = getattr(client, method)(url, **headers)
+                timings[name].append((time.perf_counter() - start) * 1000)
+            results[name]["queries"] = max(results[name]["queries"], count_queries(context.captured_queries))
+            results[name]["status"] = response.status_code
+            results[name]["body_kb"] = round(len(response.content) / 1024, 1)
+            if response.has_header("ETag"):
+                etags[name] = response["ETag"]
+
+    # tracemallocは遅くなるので、計時とは別の周回でメモリだけ測る
+    tracemalloc.start()
+    try:
+        for name, method, url in targets:
+            headers = {}
+            if name in CONDITIONAL_TARGETS:
+                headers["HTTP_IF_NONE_MATCH"] = etags.get(CONDITIONAL_TARGETS[name], "")
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            getattr(client, method)(url, **headers)
+            _, peak = tracemalloc.get_traced_memory()
+            results[name]["peak_kb"] = round((peak - before) / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+    for name, samples in timings.items():
+        results[name]["p50_ms"] = round(percentile(samples, 50), 2)
+        results[name]["p95_ms"] = round(percentile(samples, 95), 2)
+    return results
+
+
+def check_budgets(results, budgets, metrics=None):
+    # metrics を渡すとその項目だけを見る (テストでは実行環境で揺れる時間・メモリを見ない)
+    violations = []
+    for name, budget in budgets.items():
+        result = results.get(name)
+        if result is None:
+            violations.append(f"{name}: not measured")
+            continue
+        for metric, limit in budget.items():
+            if metrics is not None and metric not in metrics:
+                continue
+            if result[metric] > limit:
+                violations.append(f"{name}: {metric}={result[metric]} exceeds budget {limit}")
+    return violations
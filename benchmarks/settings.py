@@ -0,0 +1,29 @@
+import os
+
+from mysite.settings import *  # noqa: F401, F403
+from mysite.settings import BASE_DIR, DATABASES, TWEET_SHARD_COUNT
+
+# uvicornのワーカーとベンチマークのコマンドで同じファイルのDBを使う
+# DJANGO_DB_PROFILE=production を指定すると本番と同じ接続の設定になる
+DATABASES = {
+    "default": {
+        "OPTIONS": {"timeout": 20},
+        **DATABASES["default"],
+        "NAME": os.environ.get("BENCHMARK_DATABASE", BASE_DIR / "benchmark.sqlite3"),
+    }
+}
+for i in range(TWEET_SHARD_COUNT):
+    DATABASES[f"shard{i}"] = {**DATABASES["default"], "NAME": BASE_DIR / f"benchmark_shard{i}.sqlite3"}
+
+ROOT_URLCONF = "benchmarks.urls"
+LIKE_WRITE_BEHIND = os.environ.get("BENCHMARK_LIKE_WRITE_BEHIND") == "1"
+DEBUG = False
+ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
+
+# 失敗したリクエストの原因がわかるよう、500エラーはコンソールに出す
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {"django.request": {"handlers": ["console"], "level": "ERROR"}},
+}
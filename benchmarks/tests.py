@@ -0,0 +1,79 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from tweets.models import Tweet
+
+from . import dataset, load, runner
+
+User = get_user_model()
+
+
+class TestViewBudgets(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_ids = dataset.seed(users=50, tweets=500, follows=10, likes=3)
+
+    def test_success_within_budgets(self):
+        results = runner.run(self.user_ids, repeat=5)
+        budgets = runner.load_budgets()
+        self.assertEqual(set(results), set(budgets))
+        for name, result in results.items():
+            self.assertIn(result["status"], (304,) if name in runner.CONDITIONAL_TARGETS else (200, 302), name)
+        # 時間・メモリはマシンの負荷で揺れるので、予算はbenchmarkコマンドでだけ見る
+        self.assertEqual(runner.check_budgets(results, budgets, metrics=("queries",)), [])
+
+    def test_failure_over_budget(self):
+        results = {"tweets:home": {"queries": 100, "p95_ms": 1.0}}
+        violations = runner.check_budgets(results, {"tweets:home": {"queries": 6, "p95_ms": 80}})
+        self.assertEqual(violations, ["tweets:home: queries=100 exceeds budget 6"])
+
+    def test_failure_over_budget_only_checked_metrics(self):
+        results = {"tweets:home": {"queries": 3, "p95_ms": 200.0}}
+        budgets = {"tweets:home": {"queries": 6, "p95_ms": 80}}
+        self.assertEqual(runner.check_budgets(results, budgets, metrics=("queries",)), [])
+        self.assertEqual(runner.check_budgets(results, budgets), ["tweets:home: p95_ms=200.0 exceeds budget 80"])
+
+
+class TestLoadSummary(TestCase):
+    def test_success_summarize(self):
+        samples = {"home": [(3.0, True, 1.0, 0.0), (30.0, True, 2.0, 0.0), (2000.0, False, 3.0, 0.0)]}
+        result = load.summarize(samples, elapsed=1.5)["home"]
+        self.assertEqual(result["requests"], 3)
+        self.assertEqual(result["rps"], 2.0)
+        self.assertEqual(result["errors"], 1)
+        self.assertEqual(result["db_ms"], 2.0)
+        self.assertEqual(result["histogram"]["<5"], 1)
+        self.assertEqual(result["histogram"]["<50"], 1)
+        self.assertEqual(result["histogram"][">=1000"], 1)
+        self.assertEqual(sum(result["histogram"].values()), 3)
+
+    def test_failure_ignores_unknown_server_timing(self):
+        self.assertEqual(
+            load.parse_server_timing("db;dur=1.5, cache;desc=miss, , lock;dur=0"), {"db": 1.5, "lock": 0.0}
+        )
+
+
+@override_settings(ROOT_URLCONF="benchmarks.urls")
+class TestSyncViews(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester1", password="testpassword1")
+        User.objects.create_user(username="tester2", password="testpassword2")
+        self.tweet = Tweet.objects.create(user=self.user, content="testcontent")
+        self.client.force_login(self.user)
+
+    def post(self, name, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse(name, kwargs=kwargs))
+        return response.status_code, response.content, len(context.captured_queries)
+
+    def test_success_same_as_async_views(self):
+        # 同期版と非同期版で、同じ応答を同じ数のクエリで返す
+        for app, do, undo, kwargs in (
+            ("tweets", "like", "unlike", dict(pk=self.tweet.pk)),
+            ("accounts", "follow", "unfollow", dict(username="tester2")),
+        ):
+            sync = [self.post(f"sync:{do}", **kwargs), self.post(f"sync:{undo}", **kwargs)]
+            self.assertEqual([self.post(f"{app}:{do}", **kwargs), self.post(f"{app}:{undo}", **kwargs)], sync, do)
@@ -0,0 +1,17 @@
+from django.urls import include, path
+
+from accounts import views as accounts_views
+from tweets import views as tweets_views
+
+# 同じサーバーで同期版と比べられるよう、同期版のビューを sync/ 以下に置く
+sync_patterns = [
+    path("tweets/<int:pk>/like/", tweets_views.LikeView.as_view(), name="like"),
+    path("tweets/<int:pk>/unlike/", tweets_views.UnlikeView.as_view(), name="unlike"),
+    path("accounts/<str:username>/follow/", accounts_views.FollowView.as_view(), name="follow"),
+    path("accounts/<str:username>/unfollow/", accounts_views.UnFollowView.as_view(), name="unfollow"),
+]
+
+urlpatterns = [
+    path("sync/", include((sync_patterns, "sync"))),
+    path("", include("mysite.urls")),
+]
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class MysiteConfig(AppConfig):
+    name = "mysite"
+
+    def ready(self):
+        from .db import configure_sqlite
+        from .metrics import install_query_timer
+
+        connection_created.connect(configure_sqlite, dispatch_uid="mysite.db.configure_sqlite")
+        connection_created.connect(install_query_timer, dispatch_uid="mysite.metrics.install_query_timer")
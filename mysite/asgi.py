@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 
 application = get_asgi_application()
+
+# アプリの読み込みが終わってからでないとimportできない
+from tweets.events import EventStreamMiddleware  # noqa: E402
+
+application = EventStreamMiddleware(application)
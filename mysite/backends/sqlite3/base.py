@@ -0,0 +1,8 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    # 読み込みから始まったトランザクションは書き込みに昇格するときにbusy timeoutを待たずにロックエラーになるので、
+    # 最初から書き込みロックを取る
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
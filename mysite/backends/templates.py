@@ -0,0 +1,26 @@
+import time
+
+from django.template.backends import django
+
+from mysite import metrics
+
+
+class Template(django.Template):
+    def render(self, context=None, request=None):
+        request_metrics = metrics.current.get()
+        if request_metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            request_metrics.template += time.perf_counter() - start
+
+
+class DjangoTemplates(django.DjangoTemplates):
+    # 描画した時間を計測中のリクエストに足すテンプレートを返す
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name).template, self)
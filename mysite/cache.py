@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+MISSING = object()
+
+_lock = threading.Lock()
+_hits = Counter()
+_misses = Counter()
+
+
+def get_cache():
+    return caches[settings.VIEW_CACHE_ALIAS]
+
+
+def _version_key(namespace, ident):
+    return f"version:{namespace}:{ident}"
+
+
+def _new_version():
+    # バージョンのキーが追い出されても古いデータのキーと重ならないよう、時刻から作る
+    return time.time_ns()
+
+
+def get_version(namespace, ident):
+    return get_cache().get_or_set(_version_key(namespace, ident), _new_version, timeout=None)
+
+
+def get_versions(namespace, idents):
+    cache = get_cache()
+    keys = {_version_key(namespace, ident): ident for ident in idents}
+    found = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+    return {ident: found.get(key) or missing[key] for key, ident in keys.items()}
+
+
+def _bump(namespace, ident):
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(namespace, ident))
+    except ValueError:
+        cache.set(_version_key(namespace, ident), _new_version(), timeout=None)
+
+
+def invalidate(namespace, ident):
+    # コミット前に別のリクエストが古い値を新しいバージョンで保存することがあるので、コミット後にもう一度上げる
+    _bump(namespace, ident)
+    transaction.on_commit(lambda: _bump(namespace, ident))
+
+
+def make_key(namespace, ident, version, *parts):
+    return ":".join(str(part) for part in (namespace, ident, version, *parts))
+
+
+def record(namespace, hit, count=1):
+    with _lock:
+        (_hits if hit else _misses)[namespace] += count
+
+
+def cached(namespace, ident, compute, *parts, timeout=None):
+    cache = get_cache()
+    key = make_key(namespace, ident, get_version(namespace, ident), *parts)
+    value = cache.get(key, MISSING)
+    record(namespace, value is not MISSING)
+    if value is MISSING:
+        value = compute()
+        cache.set(key, value, settings.VIEW_CACHE_TIMEOUT if timeout is None else timeout)
+    return value
+
+
+def get_stats():
+    with _lock:
+        namespaces = sorted(set(_hits) | set(_misses))
+        return {namespace: {"hits": _hits[namespace], "misses": _misses[namespace]} for namespace in namespaces}
+
+
+def render_stats():
+    lines = [
+        "# HELP mysite_cache_hits_total Cache hits per namespace.",
+        "# TYPE mysite_cache_hits_total counter",
+    ]
+    stats = get_stats()
+    lines += [f'mysite_cache_hits_total{{namespace="{ns}"}} {value["hits"]}' for ns, value in stats.items()]
+    lines += [
+        "# HELP mysite_cache_misses_total Cache misses per namespace.",
+        "# TYPE mysite_cache_misses_total counter",
+    ]
+    lines += [f'mysite_cache_misses_total{{namespace="{ns}"}} {value["misses"]}' for ns, value in stats.items()]
+    return "\n".join(lines) + "\n"
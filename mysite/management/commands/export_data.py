@@ -0,0 +1,26 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from mysite import transfer
+
+
+class Command(BaseCommand):
+    help = "ユーザー・フォロー・ツイート・いいねを、gzipしたJSON Linesにモデルごとに少しずつ書き出します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--batch-size", type=int, default=transfer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        directory = Path(options["directory"])
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in transfer.MODELS:
+            start = time.perf_counter()
+            count = transfer.export_model(name, directory, options["batch_size"])
+            if count is None:
+                self.stdout.write(f"{name}: 書き出し済みなので飛ばしました")
+                continue
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(f"{name}: {count}件を書き出しました ({elapsed:.1f}秒)"))
@@ -0,0 +1,52 @@
+import time
+from io import StringIO
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite import transfer
+
+# bulk_createではシグナルが飛ばないので、非正規化したデータはまとめて作り直す
+REBUILD_COMMANDS = (
+    "reconcile_like_counts",
+    "reconcile_follow_counts",
+    "rebuild_timelines",
+    "rebuild_search_index",
+    "rebuild_tags",
+)
+
+
+class Command(BaseCommand):
+    help = "export_data で書き出したファイルを読み込みます。途中で止まっても、同じコマンドで続きから読み込めます"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--batch-size", type=int, default=transfer.BATCH_SIZE)
+        parser.add_argument(
+            "--state", help="進み具合とidの対応表を残すファイル (既定は directory/import_state.sqlite3)"
+        )
+        parser.add_argument("--skip-rebuild", action="store_true", help="いいね数・タイムラインなどを作り直しません")
+
+    def handle(self, *args, **options):
+        directory = Path(options["directory"])
+        for name in transfer.MODELS:
+            if not (directory / f"{name}.jsonl.gz").exists():
+                raise CommandError(f"{directory / f'{name}.jsonl.gz'} がありません")
+        state = transfer.ImportState(options["state"] or directory / "import_state.sqlite3")
+        try:
+            importer = transfer.Importer(directory, state, options["batch_size"])
+            for name in transfer.MODELS:
+                start = time.perf_counter()
+                try:
+                    count = importer.run(name)
+                except transfer.ImportConflict as e:
+                    raise CommandError(e)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(self.style.SUCCESS(f"{name}: {count}行を読み込みました ({elapsed:.1f}秒)"))
+        finally:
+            state.close()
+        if not options["skip_rebuild"]:
+            for command in REBUILD_COMMANDS:
+                call_command(command, stdout=StringIO())
+            self.stdout.write(self.style.SUCCESS("いいね数・フォロー数・タイムライン・検索・タグを作り直しました"))
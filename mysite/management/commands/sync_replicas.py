@@ -0,0 +1,42 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = "SQLiteのバックアップAPIでプライマリの内容をDATABASE_REPLICASのファイルにコピーします"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0, help="指定した秒数ごとにコピーし続けます")
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError("DATABASE_REPLICASが設定されていません")
+        for alias in ["default", *settings.DATABASE_REPLICAS]:
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(f"{alias}はSQLiteではありません")
+        while True:
+            self.sync()
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
+
+    def sync(self):
+        start = time.perf_counter()
+        source = sqlite3.connect(connections["default"].settings_dict["NAME"])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                target = sqlite3.connect(connections[alias].settings_dict["NAME"])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stdout.write(
+            self.style.SUCCESS(f"{len(settings.DATABASE_REPLICAS)}個のレプリカにコピーしました ({elapsed:.0f} ms)")
+        )
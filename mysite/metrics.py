@@ -0,0 +1,118 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+
+# ヒストグラムごとの説明とバケットの上限
+HISTOGRAMS = {
+    "mysite_request_duration_seconds": (
+        "Wall time per request.",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    ),
+    "mysite_db_queries": ("DB queries per request.", (0, 1, 2, 3, 5, 10, 20, 50, 100)),
+    "mysite_db_duration_seconds": ("DB time per request.", (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)),
+    "mysite_db_lock_seconds": (
+        "Time per request in statements that take the write lock.",
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    ),
+    "mysite_template_render_seconds": (
+        "Template render time per request.",
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+    ),
+    "mysite_response_size_bytes": ("Response body size.", (256, 1024, 4096, 16384, 65536, 262144, 1048576)),
+}
+# SQLiteでは書き込みロックが空くまでこれらの文の中で待つ (本番の設定ではBEGIN IMMEDIATEで待つ)
+LOCKING_STATEMENTS = ("BEGIN IMMEDIATE", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_lock = threading.Lock()
+# (ヒストグラム名, URL名) ごとの [バケットごとの件数, 合計]
+_histograms = {}
+_n_plus_one = Counter()
+
+# 計測中のリクエストの値。非同期ビューはsync_to_asyncの別スレッドでクエリを実行するので、contextvarで渡す
+current = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.lock = 0.0
+        self.template = 0.0
+        self.shapes = Counter()
+
+    def repeated_query(self):
+        # パラメータを除いたSQLが同じクエリを一番多く実行した回数と、そのSQL
+        if not self.shapes:
+            return 0, None
+        sql, count = self.shapes.most_common(1)[0]
+        return count, sql
+
+
+def time_query(execute, sql, params, many, context):
+    request_metrics = current.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        request_metrics.queries += 1
+        request_metrics.db += elapsed
+        request_metrics.shapes[sql] += 1
+        # 長いSQLを丸ごとコピーしないよう、先頭だけを見る
+        if sql[:16].lstrip().upper().startswith(LOCKING_STATEMENTS):
+            request_metrics.lock += elapsed
+
+
+def install_query_timer(sender, connection, **kwargs):
+    # 接続を作り直しても同じDatabaseWrapperが使われるので、二重に入れない
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def observe(view, values):
+    with _lock:
+        for name, value in values.items():
+            buckets = HISTOGRAMS[name][1]
+            histogram = _histograms.get((name, view))
+            if histogram is None:
+                histogram = _histograms[(name, view)] = [[0] * (len(buckets) + 1), 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+
+def record_n_plus_one(view):
+    with _lock:
+        _n_plus_one[view] += 1
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _n_plus_one.clear()
+
+
+def render():
+    with _lock:
+        histograms = {key: ([*counts], total) for key, (counts, total) in _histograms.items()}
+        n_plus_one = dict(_n_plus_one)
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for view in sorted(view for metric, view in histograms if metric == name):
+            counts, total = histograms[(name, view)]
+            cumulative = 0
+            for bound, count in zip([*buckets, "+Inf"], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{view="{view}"}} {total:g}')
+            lines.append(f'{name}_count{{view="{view}"}} {cumulative}')
+    lines += [
+        "# HELP mysite_n_plus_one_total Requests that ran the same SQL at least PERF_N_PLUS_ONE_THRESHOLD times.",
+        "# TYPE mysite_n_plus_one_total counter",
+    ]
+    lines += [f'mysite_n_plus_one_total{{view="{view}"}} {count}' for view, count in sorted(n_plus_one.items())]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PerformanceMiddleware:
+    # URL名ごとに処理時間・クエリ数とDBの時間・テンプレートの描画時間・レスポンスのサイズを記録し、
+    # Server-Timingヘッダーで返す。同じSQLを何度も実行したリクエストはN+1としてログに出す
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        token = metrics.current.set(metrics.RequestMetrics())
+        try:
+            response = self.get_response(request)
+            return self.finish(request, response, metrics.current.get(), start)
+        finally:
+            metrics.current.reset(token)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        token = metrics.current.set(metrics.RequestMetrics())
+        try:
+            response = await self.get_response(request)
+            return self.finish(request, response, metrics.current.get(), start)
+        finally:
+            metrics.current.reset(token)
+
+    def finish(self, request, response, request_metrics, start):
+        elapsed = time.perf_counter() - start
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unresolved"
+        values = {
+            "mysite_request_duration_seconds": elapsed,
+            "mysite_db_queries": request_metrics.queries,
+            "mysite_db_duration_seconds": request_metrics.db,
+            "mysite_db_lock_seconds": request_metrics.lock,
+            "mysite_template_render_seconds": request_metrics.template,
+        }
+        if not response.streaming:
+            values["mysite_response_size_bytes"] = len(response.content)
+        metrics.observe(view, values)
+
+        repeated, sql = request_metrics.repeated_query()
+        if repeated >= settings.PERF_N_PLUS_ONE_THRESHOLD:
+            metrics.record_n_plus_one(view)
+            logger.warning("possible N+1 query in %s: %d times %s", view, repeated, sql)
+
+        if settings.PERF_SERVER_TIMING:
+            response["Server-Timing"] = (
+                f"app;dur={elapsed * 1000:.2f}, "
+                f'db;dur={request_metrics.db * 1000:.2f};desc="{request_metrics.queries} queries", '
+                f"lock;dur={request_metrics.lock * 1000:.2f}, "
+                f"tpl;dur={request_metrics.template * 1000:.2f}"
+            )
+        return response
+
+
+class ReadYourWritesMiddleware:
+    # 書き込んだ直後は、レプリカに反映される前の古いデータを見せないようプライマリから読む
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if (
+            settings.DATABASE_REPLICAS
+            and request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 500
+        ):
+            response.set_cookie(
+                settings.READ_YOUR_WRITES_COOKIE,
+                "1",
+                max_age=settings.READ_YOUR_WRITES_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
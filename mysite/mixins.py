@@ -0,0 +1,60 @@
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import routers
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    # request.userの解決はDBアクセスを伴うので、イベントループを塞がないようスレッドで行う
+    async def dispatch(self, request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
+class ReplicaReadMixin:
+    # 一覧・詳細の読み込みをレプリカから行う。LoginRequiredMixinより後ろに置き、認証はプライマリで行う
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or routers.is_pinned(request):
+            return super().dispatch(request, *args, **kwargs)
+        with routers.use_replica():
+            response = super().dispatch(request, *args, **kwargs)
+            # テンプレートの中で評価されるクエリもレプリカに送るよう、ここでレンダリングする
+            if hasattr(response, "render"):
+                response.render()
+        return response
+
+
+class ConditionalGetMixin:
+    # get_validators() の (ETagの元になる値, 最終更新日時) が変わっていなければ、本文を作らずに304を返す
+    # 検証は本文より安いクエリで行う。ReplicaReadMixinより後ろに置く
+    def get_validators(self):
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+        parts, last_modified = self.get_validators()
+        etag = quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        response.headers.setdefault("ETag", etag)
+        if timestamp is not None:
+            response.headers.setdefault("Last-Modified", http_date(timestamp))
+        # 閲覧者ごとに内容が変わるので共有キャッシュには置かせず、毎回検証させる
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class JSONResponseMixin:
+    def render_to_json_response(self, context):
+        # 空白を省き、日本語はエスケープせずにUTF-8のまま返す
+        return JsonResponse(context, json_dumps_params={"separators": (",", ":"), "ensure_ascii": False})
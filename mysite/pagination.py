@@ -0,0 +1,74 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+# BigAutoField (SQLiteのINTEGER) に入る最大の値。これより大きい値はクエリでOverflowErrorになる
+MAX_ID = 2**63 - 1
+
+
+def encode_cursor(created_at, pk):
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split("|")
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise Http404("invalid cursor")
+    if created_at is None or not 0 < pk <= MAX_ID:
+        raise Http404("invalid cursor")
+    return created_at, pk
+
+
+def keyset_slice(queryset, position, limit, time_field="created_at", pk_field="pk"):
+    if position is not None:
+        created_at, pk = position
+        queryset = queryset.filter(
+            Q(**{f"{time_field}__lte": created_at})
+            & (Q(**{f"{time_field}__lt": created_at}) | Q(**{f"{pk_field}__lt": pk}))
+        )
+    return queryset.order_by(f"-{time_field}", f"-{pk_field}")[:limit]
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginationMixin:
+    # OFFSETを使わず (created_at, pk) の位置から続きを取得する
+    paginate_by = 20
+    cursor_kwarg = "before"
+    cursor_fields = ("created_at", "pk")
+
+    def get_position(self):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        return decode_cursor(cursor) if cursor else None
+
+    def paginate_queryset(self, queryset, page_size):
+        rows = list(self.get_page_rows(queryset, self.get_position(), page_size + 1))
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(*self.get_cursor_position(rows[-1]))
+        page = KeysetPage(rows, next_cursor)
+        return (None, page, page.object_list, page.has_next())
+
+    def get_page_rows(self, queryset, position, limit):
+        time_field, pk_field = self.cursor_fields
+        return keyset_slice(queryset, position, limit, time_field, pk_field)
+
+    def get_cursor_position(self, obj):
+        time_field, pk_field = self.cursor_fields
+        return getattr(obj, time_field), getattr(obj, pk_field)
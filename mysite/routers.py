@@ -0,0 +1,50 @@
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+_use_replica = ContextVar("use_replica", default=False)
+_counter = itertools.count()
+
+
+@contextmanager
+def use_replica():
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def is_pinned(request):
+    return settings.READ_YOUR_WRITES_COOKIE in request.COOKIES
+
+
+class ReplicaRouter:
+    # use_replica()の中の読み込みだけをレプリカに振り分け、それ以外と書き込みはすべてプライマリに送る
+    # セッションなどはレプリカの遅れでログアウトしたように見えないよう、REPLICA_APP_LABELSのモデルに限る
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if replicas and _use_replica.get() and model._meta.app_label in settings.REPLICA_APP_LABELS:
+            return replicas[next(_counter) % len(replicas)]
+        return None
+
+    def db_for_write(self, model, **hints):
+        # レプリカから読んだインスタンスも、書き込みはプライマリに送る。レプリカ以外のDBのインスタンスはそのDBに書く
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db and instance._state.db not in settings.DATABASE_REPLICAS:
+            return instance._state.db
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {"default", *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカはプライマリのコピーなので、直接マイグレーションしない
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -40,9 +41,12 @@ INSTALLED_APPS = [
     "accounts.apps.AccountsConfig",
     "tweets.apps.TweetsConfig",
     "welcome.apps.WelcomeConfig",
+    "benchmarks.apps.BenchmarksConfig",
+    "mysite.apps.MysiteConfig",
 ]
 
 MIDDLEWARE = [
+    "mysite.middleware.PerformanceMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -50,13 +54,15 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "mysite.middleware.ReadYourWritesMiddleware",
 ]
 
 ROOT_URLCONF = "mysite.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # 描画時間を計測する (mysite/backends/templates.py)
+        "BACKEND": "mysite.backends.templates.DjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -83,6 +89,105 @@ DATABASES = {
     }
 }
 
+# 読み込み用のレプリカ (mysite/routers.py)
+# DJANGO_DB_REPLICA にファイルを指定するとローカルで試せる。中身は sync_replicas コマンドでプライマリからコピーする
+DATABASE_ROUTERS = ["mysite.sharding.ShardRouter", "mysite.routers.ReplicaRouter"]
+DATABASE_REPLICAS = []
+REPLICA_APP_LABELS = {"accounts", "tweets"}
+READ_YOUR_WRITES_COOKIE = "read_primary"
+READ_YOUR_WRITES_SECONDS = 10
+
+if os.environ.get("DJANGO_DB_REPLICA"):
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ["DJANGO_DB_REPLICA"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS = ["replica"]
+
+# Tweet・Likeを投稿者のユーザーidで分けて保存するシャード (mysite/sharding.py)
+# DJANGO_TWEET_SHARDS=2 のように数を指定すると有効になる。既存のデータは rebalance_shards コマンドで移す
+TWEET_SHARD_COUNT = int(os.environ.get("DJANGO_TWEET_SHARDS", "0"))
+for i in range(TWEET_SHARD_COUNT):
+    DATABASES[f"shard{i}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"shard{i}.sqlite3",
+    }
+TWEET_SHARDS = [f"shard{i}" for i in range(TWEET_SHARD_COUNT)]
+# シャーディング中のツイートidに入れるワーカーの番号 (0〜63)。DJANGO_TWEET_ID_NODE で指定する
+# 指定しなければ、TWEET_ID_LOCK_DIR のロックファイルで同じマシンの他のワーカーが使っていない番号を取る
+# 指定した番号も同じロックファイルで確かめ、他のワーカーが使っていれば起動時のidの生成でエラーにする
+TWEET_ID_NODE = int(os.environ["DJANGO_TWEET_ID_NODE"]) if os.environ.get("DJANGO_TWEET_ID_NODE") else None
+TWEET_ID_LOCK_DIR = BASE_DIR
+
+# 接続ごとに実行するPRAGMA (mysite/db.py)
+SQLITE_PRAGMAS = {}
+
+# 本番 (エッジ上のSQLite) では DJANGO_DB_PROFILE=production で起動する
+# WALで読み込みと書き込みを並行させ、トランザクションは最初から書き込みロックを取り、接続は使い回す
+if os.environ.get("DJANGO_DB_PROFILE") == "production":
+    for database in DATABASES.values():
+        database.update(
+            {
+                "ENGINE": "mysite.backends.sqlite3",
+                "CONN_MAX_AGE": 600,
+                "CONN_HEALTH_CHECKS": True,
+                "OPTIONS": {"timeout": 20},
+            }
+        )
+    SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "memory",
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "mysite",
+    },
+    # gunicornなど複数プロセスで動かすときはVIEW_CACHE_ALIASをこちらにする
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache",
+    },
+}
+
+VIEW_CACHE_ALIAS = "default"
+VIEW_CACHE_TIMEOUT = 300
+
+# Live events
+# 複数ワーカーで動かすときは "tweets.events.FileBroker" にする
+
+EVENT_BROKER = "tweets.events.InProcessBroker"
+EVENT_BROKER_PATH = BASE_DIR / "events.jsonl"
+EVENT_KEEPALIVE = 15
+
+# Like write-behind
+# Trueにするといいね・いいね解除をバッファに貯め、まとめてDBに書き込む
+# LIKE_BUFFER_PATHを指定すると (例: BASE_DIR / "likes.buffer") ファイルに追記し、複数プロセスや flush_like_buffer コマンドから書き込める
+LIKE_WRITE_BEHIND = False
+LIKE_BUFFER_PATH = None
+LIKE_BUFFER_FLUSH_INTERVAL = 1.0
+LIKE_BUFFER_MAX_SIZE = 1000
+
+# Trending (tweets/trending.py)
+# いいね・投稿をプロセス内で1分ごとに数え、TRENDING_FLUSH_INTERVAL 秒ごとにTrendBucketへ書き込む
+# 古いバケットは compact_trends コマンドで1時間単位にまとめる
+TRENDING_BUCKET_SECONDS = 60
+TRENDING_CAPACITY = 200
+TRENDING_FLUSH_INTERVAL = 10
+TRENDING_HALF_LIFE = 3600
+TRENDING_WINDOW = 24 * 3600
+TRENDING_SIZE = 10
+TRENDING_CACHE_TIMEOUT = 30
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -131,6 +236,18 @@ LOGOUT_URL = "accounts:logout"
 LOGIN_REDIRECT_URL = "tweets:home"
 LOGOUT_REDIRECT_URL = "accounts:login"
 
+# Home timeline
+# フォロワー数がこの値を超えるユーザーの投稿は書き込み時に配信せず、読み込み時に合流させる
+TIMELINE_FANOUT_THRESHOLD = 1000
+TIMELINE_BACKFILL_SIZE = 200
+TIMELINE_MAX_LENGTH = 800
+
+# Performance
+# リクエストごとの処理時間・DBの時間をServer-Timingヘッダーで返す (/metrics/ には常に記録する)
+PERF_SERVER_TIMING = True
+# 1回のリクエストで同じSQLをこの回数以上実行したらN+1としてログに出す
+PERF_N_PLUS_ONE_THRESHOLD = 10
+
 SQL_DEBUG = False
 
 if SQL_DEBUG:
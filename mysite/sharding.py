@@ -0,0 +1,193 @@
+import fcntl
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .pagination import keyset_slice
+
+SHARDED_MODELS = {"tweets.tweet", "tweets.like", "tweets.hashtag", "tweets.tweethashtag", "tweets.mention"}
+
+# 2020-01-01 からのミリ秒 (41ビット)・ワーカーの番号・ミリ秒ごとの連番。JavaScriptの数値でも正確に扱えるよう53ビットに収める
+ID_EPOCH_MS = 1577836800000
+ID_NODE_BITS = 6
+ID_SEQUENCE_BITS = 6
+_id_lock = threading.Lock()
+_id_node = None
+_id_node_file = None
+_id_last_ms = -1
+_id_sequence = 0
+
+
+def get_shards():
+    return settings.TWEET_SHARDS
+
+
+def is_enabled():
+    return bool(settings.TWEET_SHARDS)
+
+
+def get_databases():
+    return get_shards() or ["default"]
+
+
+def jump_hash(key, buckets):
+    # Jump Consistent Hash。シャードを増やしたときに移動するユーザーが最小限になる
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for_user(user_id):
+    shards = get_shards()
+    return shards[jump_hash(user_id, len(shards))]
+
+
+def for_user(queryset, user_id):
+    if not is_enabled():
+        return queryset
+    return queryset.using(shard_for_user(user_id))
+
+
+def _reset_id_node():
+    global _id_node, _id_node_file, _id_last_ms, _id_sequence
+    _id_node = _id_node_file = None
+    _id_last_ms, _id_sequence = -1, 0
+
+
+# forkした子プロセスは親と同じ番号を使わないよう、番号を取り直す
+os.register_at_fork(after_in_child=_reset_id_node)
+
+
+def _lock_id_node(node):
+    # ロックファイルを開いている間はこのプロセスが番号を使っている。プロセスが終わればロックは外れる
+    f = open(Path(settings.TWEET_ID_LOCK_DIR) / f"tweet_id_node{node}.lock", "wb")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def get_id_node():
+    global _id_node, _id_node_file
+    if _id_node is not None:
+        return _id_node
+    with _id_lock:
+        if _id_node is not None:
+            return _id_node
+        node = settings.TWEET_ID_NODE
+        if node is not None:
+            if not 0 <= node < 1 << ID_NODE_BITS:
+                raise ImproperlyConfigured(f"TWEET_ID_NODE は0〜{(1 << ID_NODE_BITS) - 1}で指定してください")
+            nodes = [node]
+        else:
+            nodes = range(1 << ID_NODE_BITS)
+        for candidate in nodes:
+            f = _lock_id_node(candidate)
+            if f is not None:
+                _id_node, _id_node_file = candidate, f
+                return candidate
+        if node is not None:
+            raise ImproperlyConfigured(f"TWEET_ID_NODE={node} は他のプロセスが使っています")
+        raise ImproperlyConfigured("ツイートidのワーカーの番号が残っていません")
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def next_id():
+    # シャードごとの連番は重なるので、時刻・ワーカーの番号・連番からどのシャードでも一意なidを作る
+    global _id_last_ms, _id_sequence
+    node = get_id_node()
+    with _id_lock:
+        # 時計が戻っても前のidより小さくしない
+        now = max(_now_ms(), _id_last_ms)
+        if now == _id_last_ms:
+            sequence = (_id_sequence + 1) & ((1 << ID_SEQUENCE_BITS) - 1)
+            if sequence == 0:
+                # 同じミリ秒の連番を使い切ったら、連番を使い回さずに次のミリ秒まで待つ
+                while now <= _id_last_ms:
+                    time.sleep(0.0001)
+                    now = _now_ms()
+        else:
+            sequence = 0
+        _id_last_ms, _id_sequence = now, sequence
+    return ((now - ID_EPOCH_MS) << (ID_NODE_BITS + ID_SEQUENCE_BITS)) | (node << ID_SEQUENCE_BITS) | sequence
+
+
+def find(queryset, pks):
+    # どのシャードにあるかわからないpkを全シャードから探す
+    if not is_enabled():
+        return queryset.in_bulk(pks)
+    found = {}
+    for db in get_shards():
+        found.update(queryset.using(db).in_bulk(pks))
+    return found
+
+
+def group_by_shard(user_ids):
+    groups = defaultdict(list)
+    for user_id in user_ids:
+        groups[shard_for_user(user_id)].append(user_id)
+    return groups
+
+
+def scatter_gather(querysets, position, limit, time_field="created_at"):
+    # 各シャードから (created_at, pk) の降順で limit 件ずつ取り、マージして先頭の limit 件を返す
+    rows = [keyset_slice(queryset, position, limit, time_field) for queryset in querysets]
+    merged = heapq.merge(*rows, key=lambda obj: (getattr(obj, time_field), obj.pk), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
+def replicate_users(users):
+    # Tweet・LikeからUserへの外部キーをシャード内で張れるよう、ユーザーは全シャードに複製する
+    if not is_enabled() or not users:
+        return
+    model = type(users[0])
+    fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    copies = [model(pk=user.pk, **{name: getattr(user, name) for name in fields}) for user in users]
+    for db in get_shards():
+        model.objects.using(db).bulk_create(copies, update_conflicts=True, unique_fields=["id"], update_fields=fields)
+
+
+class ShardRouter:
+    # Tweet・Likeを投稿者のユーザーidでシャードに振り分ける。Likeはいいねされたツイートと同じシャードに置く
+    def _db_for_instance(self, model, instance):
+        if not is_enabled() or model._meta.label_lower not in SHARDED_MODELS or instance is None:
+            return None
+        label = instance._meta.label_lower
+        if label in SHARDED_MODELS and instance._state.db:
+            return instance._state.db
+        if label == "tweets.tweet" and instance.user_id is not None:
+            return shard_for_user(instance.user_id)
+        if label == "tweets.like":
+            tweet = instance._meta.get_field("tweet").get_cached_value(instance, None)
+            return tweet._state.db if tweet is not None else None
+        if label == settings.AUTH_USER_MODEL.lower() and model._meta.label_lower == "tweets.tweet":
+            # tweet.user = user や user.tweet_set では、そのユーザーのシャードを使う
+            return shard_for_user(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_instance(model, hints.get("instance"))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # ユーザーは全シャードに複製しているので、シャードをまたいだ関連を許す
+        if is_enabled():
+            return True
+        return None
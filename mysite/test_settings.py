@@ -0,0 +1,19 @@
+import tempfile
+from pathlib import Path
+
+from .settings import *  # noqa: F401, F403
+from .settings import BASE_DIR, DATABASES
+
+# シャーディングのテストは override_settings(TWEET_SHARDS=[...]) で有効にするので、DBの宣言だけをしておく
+# テスト用のDBはメモリ上に作られ、NAMEのファイルは作られない
+for i in range(2):
+    DATABASES.setdefault(
+        f"shard{i}",
+        {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / f"shard{i}.sqlite3",
+        },
+    )
+
+# ツイートidのワーカーの番号のロックファイルはリポジトリに残さない
+TWEET_ID_LOCK_DIR = Path(tempfile.gettempdir())
@@ -0,0 +1,375 @@
+import itertools
+import sqlite3
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.utils import ConnectionHandler
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import FriendShip
+from tweets.models import Like, Tweet
+
+from . import cache, metrics, routers, sharding, transfer
+from .db import configure_sqlite
+
+User = get_user_model()
+
+
+class TestCache(TestCase):
+    def test_success_cached_and_invalidate(self):
+        values = iter(["first", "second"])
+        self.assertEqual(cache.cached("test", 1, lambda: next(values)), "first")
+        self.assertEqual(cache.cached("test", 1, lambda: next(values)), "first")
+        cache.invalidate("test", 1)
+        self.assertEqual(cache.cached("test", 1, lambda: next(values)), "second")
+
+    def test_success_get_versions(self):
+        versions = cache.get_versions("test", [1, 2])
+        cache.invalidate("test", 1)
+        new_versions = cache.get_versions("test", [1, 2])
+        self.assertNotEqual(versions[1], new_versions[1])
+        self.assertEqual(versions[2], new_versions[2])
+
+    def test_success_stats(self):
+        before = cache.get_stats().get("stats", {"hits": 0, "misses": 0})
+        cache.cached("stats", 1, lambda: "value")
+        cache.cached("stats", 1, lambda: "value")
+        self.assertEqual(cache.get_stats()["stats"], {"hits": before["hits"] + 1, "misses": before["misses"] + 1})
+
+
+class TestCacheStatsView(TestCase):
+    def setUp(self):
+        self.url = reverse("cache_stats")
+
+    def test_success_get(self):
+        staff = User.objects.create_user(username="staff", password="testpassword", is_staff=True)
+        self.client.force_login(staff)
+        cache.cached("view", 1, lambda: "value")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('mysite_cache_misses_total{namespace="view"}', response.content.decode())
+
+    def test_failure_get_with_not_staff_user(self):
+        user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+
+class TestPerformanceMiddleware(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.tweet = Tweet.objects.create(user=self.user, content="hello")
+        self.client.force_login(self.user)
+
+    def get_timings(self, response):
+        timings = {}
+        for metric in response["Server-Timing"].split(", "):
+            name, duration = metric.split(";")[:2]
+            timings[name] = float(duration.removeprefix("dur="))
+        return timings
+
+    def test_success_server_timing(self):
+        response = self.client.get(reverse("tweets:home"))
+        timings = self.get_timings(response)
+        self.assertEqual(set(timings), {"app", "db", "lock", "tpl"})
+        self.assertGreater(timings["db"], 0)
+        self.assertGreater(timings["tpl"], 0)
+        self.assertEqual(timings["lock"], 0)
+        self.assertGreaterEqual(timings["app"], timings["db"])
+
+    def test_success_async_view_write_is_timed(self):
+        response = self.client.post(reverse("tweets:like", kwargs=dict(pk=self.tweet.pk)))
+        timings = self.get_timings(response)
+        self.assertGreater(timings["lock"], 0)
+        self.assertGreaterEqual(timings["db"], timings["lock"])
+
+    def test_success_histograms(self):
+        self.client.get(reverse("tweets:home"))
+        self.client.get(reverse("tweets:home"))
+        output = metrics.render()
+        self.assertIn('mysite_request_duration_seconds_count{view="tweets:home"} 2', output)
+        self.assertIn('mysite_db_queries_bucket{view="tweets:home",le="+Inf"} 2', output)
+        self.assertIn('mysite_response_size_bytes_count{view="tweets:home"} 2', output)
+
+    @override_settings(PERF_N_PLUS_ONE_THRESHOLD=3)
+    def test_success_n_plus_one(self):
+        tweets = [Tweet.objects.create(user=self.user, content=f"tweet {i}") for i in range(3)]
+        request_metrics = metrics.RequestMetrics()
+        token = metrics.current.set(request_metrics)
+        try:
+            for tweet in Tweet.objects.filter(pk__in=[tweet.pk for tweet in tweets]):
+                tweet.user.username
+        finally:
+            metrics.current.reset(token)
+        self.assertEqual(request_metrics.repeated_query()[0], 3)
+
+        with mock.patch.object(metrics.RequestMetrics, "repeated_query", return_value=(3, "SELECT 1")):
+            with self.assertLogs("mysite.middleware", level="WARNING") as logs:
+                self.client.get(reverse("tweets:home"))
+        self.assertIn("tweets:home", logs.output[0])
+        self.assertIn('mysite_n_plus_one_total{view="tweets:home"} 1', metrics.render())
+
+    def test_failure_no_n_plus_one_under_threshold(self):
+        with self.assertNoLogs("mysite.middleware", level="WARNING"):
+            self.client.get(reverse("tweets:home"))
+        self.assertNotIn("mysite_n_plus_one_total{", metrics.render())
+
+    @override_settings(PERF_SERVER_TIMING=False)
+    def test_success_without_server_timing(self):
+        response = self.client.get(reverse("tweets:home"))
+        self.assertFalse(response.has_header("Server-Timing"))
+        self.assertIn('mysite_request_duration_seconds_count{view="tweets:home"} 1', metrics.render())
+
+
+class TestMetricsView(TestCase):
+    def setUp(self):
+        self.url = reverse("metrics")
+
+    def test_success_get(self):
+        staff = User.objects.create_user(username="staff", password="testpassword", is_staff=True)
+        self.client.force_login(staff)
+        self.client.get(reverse("tweets:home"))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn("# TYPE mysite_request_duration_seconds histogram", content)
+        self.assertIn('mysite_request_duration_seconds_count{view="tweets:home"}', content)
+        self.assertIn("# TYPE mysite_cache_hits_total counter", content)
+
+    def test_failure_get_with_not_staff_user(self):
+        user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+
+class TestSqliteConfiguration(TestCase):
+    def test_success_configure_sqlite(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA cache_size")
+            default = cursor.fetchone()[0]
+            with override_settings(SQLITE_PRAGMAS={"cache_size": -1234}):
+                configure_sqlite(sender=None, connection=connection)
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(cursor.fetchone()[0], -1234)
+            cursor.execute(f"PRAGMA cache_size = {default}")
+
+    def test_success_begin_immediate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "test.sqlite3"
+            handler = ConnectionHandler({"default": {"ENGINE": "mysite.backends.sqlite3", "NAME": path}})
+            wrapper = handler["default"]
+            wrapper.ensure_connection()
+            wrapper._start_transaction_under_autocommit()
+            # 読み込みしかしていなくても、他の接続は書き込めない
+            other = sqlite3.connect(path, timeout=0)
+            with self.assertRaisesMessage(sqlite3.OperationalError, "database is locked"):
+                other.execute("BEGIN IMMEDIATE")
+            other.close()
+            wrapper.close()
+
+
+@override_settings(DATABASE_REPLICAS=["replica1", "replica2"])
+class TestReplicaRouter(TestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+
+    def test_success_db_for_read(self):
+        self.assertIsNone(self.router.db_for_read(Tweet))
+        with routers.use_replica():
+            replicas = {self.router.db_for_read(Tweet), self.router.db_for_read(Tweet)}
+            self.assertEqual(replicas, {"replica1", "replica2"})
+            self.assertIsNone(self.router.db_for_read(Session))
+            self.assertEqual(self.router.db_for_write(Tweet), "default")
+
+    def test_success_allow_migrate(self):
+        self.assertIsNone(self.router.allow_migrate("default", "tweets"))
+        self.assertFalse(self.router.allow_migrate("replica1", "tweets"))
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class TestReadYourWrites(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+
+    def get_replica_flags(self, url):
+        # 実際のレプリカはないので、レプリカに振り分けようとしたかだけを記録する
+        flags = []
+        with mock.patch.object(
+            routers.ReplicaRouter,
+            "db_for_read",
+            autospec=True,
+            side_effect=lambda *args, **kwargs: flags.append(routers._use_replica.get()),
+        ):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return flags
+
+    def test_success_read_from_replica(self):
+        self.assertTrue(any(self.get_replica_flags(reverse("tweets:home"))))
+
+    def test_success_read_from_primary_after_write(self):
+        response = self.client.post(reverse("tweets:create"), {"content": "testcontent"})
+        self.assertEqual(
+            response.cookies[settings.READ_YOUR_WRITES_COOKIE]["max-age"], settings.READ_YOUR_WRITES_SECONDS
+        )
+        self.assertFalse(any(self.get_replica_flags(reverse("tweets:home"))))
+
+
+class TestTransfer(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.friendship = FriendShip.objects.create(follower=self.user1, followee=self.user2)
+        self.tweets = [Tweet.objects.create(user=self.user2, content=f"テスト{i}") for i in range(3)]
+        Like.objects.like(self.user1, self.tweets[0])
+        Like.objects.like(self.user2, self.tweets[0])
+        self.directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def export_and_clear(self):
+        call_command("export_data", self.directory, stdout=StringIO())
+        # tester1 は読み込み先に残しておき、同じユーザー名のユーザーに対応づけられることを確かめる
+        User.objects.exclude(pk=self.user1.pk).delete()
+
+    def import_data(self):
+        out = StringIO()
+        call_command("import_data", self.directory, batch_size=2, stdout=out)
+        return out.getvalue()
+
+    def test_success_export_import(self):
+        self.export_and_clear()
+        out = self.import_data()
+        self.assertIn("likes: 2行を読み込みました", out)
+        user2 = User.objects.get(username="tester2")
+        self.assertNotEqual(user2.pk, self.user2.pk)
+        self.assertTrue(user2.check_password("testpassword2"))
+        self.assertEqual(FriendShip.objects.get().created_at, self.friendship.created_at)
+        self.assertEqual(list(Tweet.objects.values_list("content", flat=True)), ["テスト2", "テスト1", "テスト0"])
+        tweet = Tweet.objects.get(content="テスト0")
+        self.assertEqual(tweet.like_count, 2)
+        self.assertEqual(
+            set(Like.objects.values_list("user", "tweet")), {(self.user1.pk, tweet.pk), (user2.pk, tweet.pk)}
+        )
+        self.assertEqual((user2.follower_count, User.objects.get(pk=self.user1.pk).following_count), (1, 1))
+
+    def test_success_resume(self):
+        self.export_and_clear()
+        with mock.patch.object(transfer.Importer, "load_likes", side_effect=RuntimeError("stopped")):
+            with self.assertRaises(RuntimeError):
+                self.import_data()
+        out = self.import_data()
+        self.assertIn("tweets: 0行を読み込みました", out)
+        self.assertIn("likes: 2行を読み込みました", out)
+        self.assertEqual(Tweet.objects.count(), 3)
+        self.assertEqual(Like.objects.count(), 2)
+        out = self.import_data()
+        self.assertIn("likes: 0行を読み込みました", out)
+
+    def test_success_reserve_ids(self):
+        self.export_and_clear()
+        load_tweets = transfer.Importer.load_tweets
+
+        def load_tweets_with_new_tweet(importer, *args):
+            # 読み込みの途中で投稿されたツイートは、予約した範囲の後ろのidになる
+            Tweet.objects.create(user=self.user1, content="読み込み中の投稿")
+            return load_tweets(importer, *args)
+
+        with mock.patch.object(transfer.Importer, "load_tweets", load_tweets_with_new_tweet):
+            self.import_data()
+        self.assertEqual(Tweet.objects.filter(content="読み込み中の投稿").count(), 2)
+        self.assertEqual(Tweet.objects.filter(content__startswith="テスト").count(), 3)
+        self.assertEqual(Tweet.objects.get(content="テスト0").like_count, 2)
+
+    def test_failure_resume_with_conflicting_row(self):
+        self.export_and_clear()
+        with mock.patch.object(transfer.Importer, "load_tweets", side_effect=RuntimeError("stopped")):
+            with self.assertRaises(RuntimeError):
+                self.import_data()
+        state = transfer.ImportState(self.directory / "import_state.sqlite3")
+        _, base = state.get_progress("tweets")
+        state.close()
+        Tweet.objects.create(pk=base, user=self.user1, content="別のツイート")
+        with self.assertRaisesMessage(
+            CommandError, f"tweets.Tweet のid {base} は読み込む行とは別の行に使われています"
+        ):
+            self.import_data()
+        self.assertEqual(Tweet.objects.get(pk=base).content, "別のツイート")
+
+    def test_success_export_skips_finished_files(self):
+        call_command("export_data", self.directory, stdout=StringIO())
+        out = StringIO()
+        call_command("export_data", self.directory, stdout=out)
+        self.assertIn("users: 書き出し済みなので飛ばしました", out.getvalue())
+
+
+class TestTweetId(TestCase):
+    def setUp(self):
+        self.lock_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(TWEET_ID_LOCK_DIR=self.lock_dir, TWEET_ID_NODE=None))
+        # 他のテストで取った番号を捨て、このテストのロックファイルで取り直す
+        sharding._reset_id_node()
+        self.addCleanup(sharding._reset_id_node)
+
+    def lock_node(self, node):
+        f = sharding._lock_id_node(node)
+        self.addCleanup(f.close)
+
+    def test_success_next_id_waits_for_next_millisecond(self):
+        now = sharding.ID_EPOCH_MS + 1000
+        limit = 1 << sharding.ID_SEQUENCE_BITS
+        # 連番を使い切ったあとは、時計が進むまで同じミリ秒を返す
+        ticks = itertools.chain([now] * (limit + 3), itertools.repeat(now + 1))
+        with mock.patch.object(sharding, "_now_ms", side_effect=lambda: next(ticks)), mock.patch("time.sleep"):
+            ids = [sharding.next_id() for _ in range(limit + 1)]
+        self.assertEqual(len(set(ids)), limit + 1)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(ids[-1] >> (sharding.ID_NODE_BITS + sharding.ID_SEQUENCE_BITS), 1001)
+
+    def test_success_skip_node_used_by_other_process(self):
+        self.lock_node(0)
+        self.assertEqual(sharding.get_id_node(), 1)
+        self.assertEqual(sharding.next_id() >> sharding.ID_SEQUENCE_BITS & ((1 << sharding.ID_NODE_BITS) - 1), 1)
+
+    def test_failure_configured_node_used_by_other_process(self):
+        self.lock_node(5)
+        with override_settings(TWEET_ID_NODE=5):
+            with self.assertRaisesMessage(ImproperlyConfigured, "TWEET_ID_NODE=5 は他のプロセスが使っています"):
+                sharding.get_id_node()
+        with override_settings(TWEET_ID_NODE=64):
+            with self.assertRaises(ImproperlyConfigured):
+                sharding.get_id_node()
+
+
+@override_settings(TWEET_SHARDS=["shard0", "shard1"])
+class TestShardedTransfer(TestCase):
+    databases = {"default", "shard0", "shard1"}
+
+    def test_success_export_import(self):
+        users = [User.objects.create_user(username=f"tester{i}", password="testpassword") for i in range(4)]
+        for user in users:
+            tweet = Tweet.objects.create(user=user, content=f"{user.username}のツイート")
+            Like.objects.like(users[0], tweet)
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        call_command("export_data", directory, stdout=StringIO())
+        for user in users:
+            sharding.for_user(Tweet.objects, user.pk).filter(user=user).delete()
+        out = StringIO()
+        call_command("import_data", directory, stdout=out)
+        self.assertIn("tweets: 4行を読み込みました", out.getvalue())
+        for user in users:
+            tweet = sharding.for_user(Tweet.objects, user.pk).get(user=user)
+            self.assertEqual((tweet.content, tweet.like_count), (f"{user.username}のツイート", 1))
+            self.assertTrue(Like.objects.using(tweet._state.db).filter(user=users[0], tweet=tweet).exists())
@@ -0,0 +1,327 @@
+import gzip
+import json
+import os
+import sqlite3
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.db import connections, router, transaction
+
+from accounts.models import FriendShip
+from tweets.models import Like, Tweet
+
+from . import sharding
+
+User = get_user_model()
+
+BATCH_SIZE = 5000
+# 外部キーの参照先が先に入るよう、この順に書き出して読み込む
+MODELS = {
+    "users": User,
+    "follows": FriendShip,
+    "tweets": Tweet,
+    "likes": Like,
+}
+
+
+class ImportConflict(Exception):
+    pass
+
+
+def get_fields(model):
+    return [field for field in model._meta.concrete_fields if not field.primary_key]
+
+
+def _encode(value):
+    # DjangoJSONEncoder はミリ秒で切り捨てるので、マイクロ秒まで残す
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def get_databases(model):
+    # シャーディングしている Tweet・Like は全シャードから、それ以外は default から読む
+    if sharding.is_enabled() and model in (Tweet, Like):
+        return sharding.get_shards()
+    return [router.db_for_read(model)]
+
+
+def export_model(name, directory, batch_size=BATCH_SIZE):
+    # 1行目にフィールド名、2行目からは [pk, 値...] の配列を gzip した JSON Lines に書く
+    # 書き終わってから名前を変えるので、途中で止まったファイルは次の実行で書き直される
+    model = MODELS[name]
+    path = Path(directory) / f"{name}.jsonl.gz"
+    if path.exists():
+        return None
+    fields = get_fields(model)
+    columns = [field.attname for field in fields]
+    encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=_encode)
+    count = 0
+    tmp_path = path.with_suffix(".gz.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write(encoder.encode({"model": model._meta.label_lower, "fields": columns}) + "\n")
+        for using in get_databases(model):
+            rows = model.objects.using(using).order_by("pk").values_list("pk", *columns).iterator(batch_size)
+            for row in rows:
+                f.write(encoder.encode(row) + "\n")
+                count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+class ImportState:
+    # 読み込みの進み具合 (ファイルごとの行数) と、元のpkから読み込み先のpkへの対応をSQLiteのファイルに残す
+    # 対応表をメモリに持たないので、件数が多くてもメモリは一定
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS progress (name TEXT PRIMARY KEY, line INTEGER, base INTEGER);
+            CREATE TABLE IF NOT EXISTS idmap (
+                name TEXT, old INTEGER, new INTEGER, db TEXT, PRIMARY KEY (name, old)
+            ) WITHOUT ROWID;
+            """)
+
+    def close(self):
+        self.connection.close()
+
+    def get_progress(self, name):
+        row = self.connection.execute("SELECT line, base FROM progress WHERE name = ?", [name]).fetchone()
+        return row or (None, None)
+
+    def start(self, name, base):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO progress VALUES (?, 0, ?)", [name, base])
+        return self.get_progress(name)
+
+    def record(self, name, mapping):
+        # mapping は (元のpk, 新しいpk, DB) の列
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO idmap VALUES (?, ?, ?, ?)", [(name, *row) for row in mapping]
+            )
+
+    def commit(self, name, line, mapping):
+        self.record(name, mapping)
+        with self.connection:
+            self.connection.execute("UPDATE progress SET line = ? WHERE name = ?", [line, name])
+
+    def lookup(self, name, old_ids):
+        old_ids = list(set(old_ids))
+        found = {}
+        # SQLiteの変数の上限を超えないよう分けて引く
+        for start in range(0, len(old_ids), 500):
+            chunk = old_ids[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                (old, (new, db))
+                for old, new, db in self.connection.execute(
+                    f"SELECT old, new, db FROM idmap WHERE name = ? AND old IN ({placeholders})", [name, *chunk]
+                )
+            )
+        return found
+
+
+def read_batches(path, skip, batch_size):
+    # 前回までに読み込んだ skip 行は読み飛ばし、(読み終わった行数, 行の配列) を batch_size 行ずつ返す
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        lines = islice(f, skip, None)
+        line = skip
+        while True:
+            batch = [json.loads(row) for row in islice(lines, batch_size)]
+            if not batch:
+                return
+            yield header, line, batch
+            line += len(batch)
+
+
+def count_rows(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return sum(1 for _ in f) - 1
+
+
+def reserve_ids(model, count):
+    # 読み込む行数分のidをAUTOINCREMENTの連番から先に取っておき、その先頭のidを返す
+    # 読み込み中の新規登録・投稿は取っておいた範囲の後ろのidになるので、読み込む行とidが重ならない
+    using = router.db_for_write(model) or "default"
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        raise ImportConflict(f"{connection.vendor} のidの予約には対応していません")
+    table = model._meta.db_table
+    quoted = connection.ops.quote_name(table)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # 書き込みから始めて書き込みロックを取り、最大のidを読んでから予約するまでに割り込まれないようにする
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT %s, 0"
+            " WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)",
+            [table, table],
+        )
+        cursor.execute(
+            f"UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT COALESCE(MAX(id), 0) FROM {quoted})) + %s"
+            " WHERE name = %s",
+            [count, table],
+        )
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        return cursor.fetchone()[0] - count + 1
+
+
+def check_existing(model, using, objs, same):
+    # 読み込もうとしているpkがすでにあれば、前回読み込んだ同じ行のときだけ飛ばし、別の行なら止める
+    existing = model.objects.using(using).in_bulk([obj.pk for obj in objs])
+    for obj in objs:
+        if obj.pk in existing and not same(existing[obj.pk], obj):
+            raise ImportConflict(f"{model._meta.label} のid {obj.pk} は読み込む行とは別の行に使われています")
+    return [obj for obj in objs if obj.pk not in existing]
+
+
+def _same_tweet(existing, tweet):
+    return (existing.user_id, existing.content, existing.created_at) == (
+        tweet.user_id,
+        tweet.content,
+        tweet.created_at,
+    )
+
+
+def _converter(model, columns):
+    to_python = [model._meta.get_field(name).to_python for name in columns]
+    return lambda values: {name: convert(value) for name, convert, value in zip(columns, to_python, values)}
+
+
+class Importer:
+    # 読み込み先のpkは「開始時に予約したidの先頭 + 行番号」で決めるので、途中で止まってやり直しても同じpkになる
+    # シャーディング中のツイートのidは時刻から作るので、1行ずつ作って書き込む前に対応表に残す
+    # やり直しで同じ行を入れ直すときは、すでにある行が同じ内容かを確かめてから飛ばす
+    def __init__(self, directory, state, batch_size=BATCH_SIZE):
+        self.directory = Path(directory)
+        self.state = state
+        self.batch_size = batch_size
+
+    def run(self, name):
+        path = self.directory / f"{name}.jsonl.gz"
+        line, base = self.state.get_progress(name)
+        if line is None:
+            base = self.get_base(name, path)
+            line, base = self.state.start(name, base)
+        loader = getattr(self, f"load_{name}")
+        imported = 0
+        for header, line, batch in read_batches(path, line, self.batch_size):
+            columns = header["fields"]
+            mapping = loader(columns, base + line, batch)
+            self.state.commit(name, line + len(batch), mapping)
+            imported += len(batch)
+        return imported
+
+    def get_base(self, name, path):
+        model = MODELS[name]
+        # フォロー・いいねのpkは読み込み先で振る
+        if model in (FriendShip, Like) or (model is Tweet and sharding.is_enabled()):
+            return 0
+        return reserve_ids(model, count_rows(path))
+
+    def load_users(self, columns, first_pk, batch):
+        # 同じユーザー名のユーザーがいればそのユーザーに合わせる
+        username = columns.index("username") + 1
+        usernames = [row[username] for row in batch]
+        existing = dict(User.objects.filter(username__in=usernames).values_list("username", "pk"))
+        to_python = _converter(User, columns)
+        users, mapping = [], []
+        for offset, (old_pk, *values) in enumerate(batch):
+            user = User(pk=first_pk + offset, **to_python(values))
+            if user.username in existing:
+                mapping.append((old_pk, existing[user.username], None))
+                continue
+            users.append(user)
+            mapping.append((old_pk, user.pk, None))
+        using = router.db_for_write(User) or "default"
+        with transaction.atomic(using=using):
+            # 同じユーザー名のユーザーは上で対応づけているので、pkが使われていれば別のユーザー
+            User.objects.bulk_create(check_existing(User, using, users, lambda existing, user: False))
+        sharding.replicate_users(users)
+        return mapping
+
+    def load_follows(self, columns, first_pk, batch):
+        # auto_now_add の created_at を上書きしないよう、bulk_create ではなくINSERTで入れる
+        follower, followee, created_at = (
+            columns.index(name) + 1 for name in ("follower_id", "followee_id", "created_at")
+        )
+        user_ids = self.state.lookup("users", [row[index] for row in batch for index in (follower, followee)])
+        using = router.db_for_write(FriendShip) or "default"
+        connection = connections[using]
+        to_datetime = FriendShip._meta.get_field("created_at").to_python
+        rows = [
+            (
+                user_ids[row[follower]][0],
+                user_ids[row[followee]][0],
+                connection.ops.adapt_datetimefield_value(to_datetime(row[created_at])),
+            )
+            for row in batch
+            if row[follower] in user_ids and row[followee] in user_ids
+        ]
+        table = connection.ops.quote_name(FriendShip._meta.db_table)
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            # 同じフォローは前回読み込んだフォローなので飛ばす
+            existing = set(
+                FriendShip.objects.using(using)
+                .filter(follower_id__in={row[0] for row in rows}, followee_id__in={row[1] for row in rows})
+                .values_list("follower_id", "followee_id")
+            )
+            cursor.executemany(
+                f"INSERT INTO {table} (follower_id, followee_id, created_at) VALUES (%s, %s, %s)",
+                [row for row in rows if row[:2] not in existing],
+            )
+        return []
+
+    def load_tweets(self, columns, first_pk, batch):
+        user_index = columns.index("user_id")
+        user_ids = self.state.lookup("users", [values[user_index] for _, *values in batch])
+        to_python = _converter(Tweet, columns)
+        allocated = {}
+        if sharding.is_enabled():
+            allocated = {old: new for old, (new, _) in self.state.lookup("tweets", [row[0] for row in batch]).items()}
+        by_db = {}
+        mapping = []
+        for offset, (old_pk, *values) in enumerate(batch):
+            if values[user_index] not in user_ids:
+                continue
+            if sharding.is_enabled():
+                pk = allocated.get(old_pk) or sharding.next_id()
+            else:
+                pk = first_pk + offset
+            tweet = Tweet(pk=pk, **to_python(values))
+            tweet.user_id = user_ids[values[user_index]][0]
+            using = router.db_for_write(Tweet, instance=tweet)
+            by_db.setdefault(using, []).append(tweet)
+            mapping.append((old_pk, tweet.pk, using))
+        if sharding.is_enabled():
+            # やり直したときに同じidで入れ直せるよう、書き込む前に対応表に残す
+            self.state.record("tweets", mapping)
+        for using, tweets in by_db.items():
+            with transaction.atomic(using=using):
+                Tweet.objects.using(using).bulk_create(check_existing(Tweet, using, tweets, _same_tweet))
+        return mapping
+
+    def load_likes(self, columns, first_pk, batch):
+        user_index, tweet_index = columns.index("user_id") + 1, columns.index("tweet_id") + 1
+        user_ids = self.state.lookup("users", [row[user_index] for row in batch])
+        tweet_ids = self.state.lookup("tweets", [row[tweet_index] for row in batch])
+        by_db = {}
+        for row in batch:
+            if row[user_index] in user_ids and row[tweet_index] in tweet_ids:
+                tweet_id, using = tweet_ids[row[tweet_index]]
+                by_db.setdefault(using, []).append(Like(user_id=user_ids[row[user_index]][0], tweet_id=tweet_id))
+        for using, likes in by_db.items():
+            with transaction.atomic(using=using):
+                # 同じユーザーの同じツイートへのいいねは、前回読み込んだいいねなので飛ばす
+                existing = set(
+                    Like.objects.using(using)
+                    .filter(
+                        user_id__in={like.user_id for like in likes}, tweet_id__in={like.tweet_id for like in likes}
+                    )
+                    .values_list("user_id", "tweet_id")
+                )
+                Like.objects.using(using).bulk_create(
+                    [like for like in likes if (like.user_id, like.tweet_id) not in existing]
+                )
+        return []
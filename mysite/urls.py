@@ -17,8 +17,12 @@ from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 
+from .views import CacheStatsView, MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("cache-stats/", CacheStatsView.as_view(), name="cache_stats"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
     path("accounts/", include("accounts.urls")),
     path("tweets/", include("tweets.urls")),
     path("", include("welcome.urls")),
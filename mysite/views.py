@@ -0,0 +1,21 @@
+from django.contrib.auth.mixins import UserPassesTestMixin
+from django.http import HttpResponse
+from django.views import View
+
+from . import cache, metrics
+
+
+class CacheStatsView(UserPassesTestMixin, View):
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(cache.render_stats(), content_type="text/plain; version=0.0.4")
+
+
+class MetricsView(UserPassesTestMixin, View):
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render() + cache.render_stats(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import threading
+from functools import lru_cache
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import transaction
+from django.http import QueryDict, parse_cookie
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from accounts.models import FriendShip
+
+MAX_TWEETS = 200
+
+
+class Subscription:
+    max_size = 100
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_size)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 読み出しが追いつかない接続の分は捨てる
+            pass
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    # publishは同期ビューのスレッドから呼ばれるので、各接続のイベントループに渡して配る
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def subscribe(self):
+        subscription = Subscription(self)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # イベントループが既に閉じている
+                self.unsubscribe(subscription)
+
+
+class FileBroker(InProcessBroker):
+    # 複数ワーカーの開発環境向けの代替。イベントを1行ずつファイルに追記し、各ワーカーが末尾を読んで配る
+    poll_interval = 0.2
+    max_bytes = 1024 * 1024
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = Path(path or settings.EVENT_BROKER_PATH)
+        self._reader = None
+
+    def publish(self, event):
+        line = (json.dumps(event) + "\n").encode()
+        with open(self.path, "ab") as f:
+            # 大きくなりすぎたら切り詰める。読み手はサイズが縮んだのを見て先頭から読み直す
+            if f.tell() > self.max_bytes:
+                f.truncate(0)
+            f.write(line)
+
+    def subscribe(self):
+        subscription = super().subscribe()
+        if self._reader is None or self._reader.done():
+            offset = self.path.stat().st_size if self.path.exists() else 0
+            self._reader = subscription.loop.create_task(self._tail(offset))
+        return subscription
+
+    async def _tail(self, offset):
+        while self._subscriptions:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                size = self.path.stat().st_size
+            except FileNotFoundError:
+                offset = 0
+                continue
+            if size < offset:
+                offset = 0
+            if size == offset:
+                continue
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            # 書き込み途中の行は次の周回で読む
+            complete = data.rfind(b"\n") + 1
+            offset += complete
+            for line in data[:complete].splitlines():
+                super().publish(json.loads(line))
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(settings.EVENT_BROKER)()
+
+
+def publish(event, using=None):
+    # ロールバックされた変更を流さないよう、コミット後に配る
+    transaction.on_commit(lambda: get_broker().publish(event), using=using)
+
+
+@sync_to_async
+def _get_viewer(session_key):
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = get_user(SimpleNamespace(session=session))
+    if not user.is_authenticated:
+        return None, set()
+    followee_ids = set(FriendShip.objects.filter(follower=user).values_list("followee_id", flat=True))
+    return user, followee_ids
+
+
+def _parse_tweet_ids(query_string):
+    tweet_ids = set()
+    for value in QueryDict(query_string).get("tweets", "").split(",")[:MAX_TWEETS]:
+        if value.isdigit():
+            tweet_ids.add(int(value))
+    return tweet_ids
+
+
+def format_event(event, user, tweet_ids, followee_ids):
+    # 自分の操作は画面に反映済みなので送らない。まとめて書き込んだいいねは、自分の分だけを除いて送る
+    if event["type"] == "like":
+        if event["tweet"] not in tweet_ids:
+            return None
+        delta = event["delta"] - sum(delta for user_id, delta in event["users"] if user_id == user.pk)
+        if not delta:
+            return None
+        data = {"tweet": event["tweet"], "delta": delta}
+    elif event["type"] == "tweet":
+        if event["user"] not in followee_ids:
+            return None
+        data = {"tweet": event["tweet"]}
+    else:
+        return None
+    return f"event: {event['type']}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def stream_events(scope, receive, send):
+    cookies = parse_cookie(dict(scope["headers"]).get(b"cookie", b"").decode("latin-1"))
+    user, followee_ids = await _get_viewer(cookies.get(settings.SESSION_COOKIE_NAME))
+    if user is None:
+        await send({"type": "http.response.start", "status": 403, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"login required"})
+        return
+    tweet_ids = _parse_tweet_ids(scope["query_string"].decode("latin-1"))
+
+    # レスポンスを返し始めるまでに起きたイベントも取りこぼさないよう、先に購読する
+    subscription = get_broker().subscribe()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        while not disconnected.done():
+            getter = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait(
+                {getter, disconnected}, timeout=settings.EVENT_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+                if not disconnected.done():
+                    # プロキシに切断されないよう、何も起きなくても定期的にコメント行を送る
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                continue
+            message = format_event(getter.result(), user, tweet_ids, followee_ids)
+            if message:
+                await send({"type": "http.response.body", "body": message, "more_body": True})
+    finally:
+        disconnected.cancel()
+        subscription.close()
+
+
+class EventStreamMiddleware:
+    # Django 4.1のASGIハンドラーはストリーミングレスポンスを同期的に回すので、SSEだけは手前で受ける
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == reverse("tweets:events"):
+            await stream_events(scope, receive, send)
+        else:
+            await self.application(scope, receive, send)
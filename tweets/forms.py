@@ -1,4 +1,5 @@
 from django import forms
+from django.db import router, transaction
 
 from .models import Tweet
 
@@ -7,3 +8,10 @@ class TweetForm(forms.ModelForm):
     class Meta:
         model = Tweet
         fields = ("content",)
+
+    def save(self, commit=True):
+        # post_saveのシグナルで作るハッシュタグ・メンション・検索の索引を、ツイートと同じトランザクションで保存する
+        if not commit:
+            return super().save(commit=False)
+        with transaction.atomic(using=router.db_for_write(Tweet, instance=self.instance)):
+            return super().save()
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from mysite import cache
+
+
+def attach_fragments(tweets, variant):
+    # 閲覧者によらない部分のHTMLをツイートごとにキャッシュし、tweet.fragmentに付ける
+    if not tweets:
+        return tweets
+    versions = cache.get_versions("tweet", [tweet.pk for tweet in tweets])
+    keys = {cache.make_key("tweet", tweet.pk, versions[tweet.pk], "fragment", variant): tweet for tweet in tweets}
+    found = cache.get_cache().get_many(keys)
+    cache.record("tweet_fragment", hit=True, count=len(found))
+    cache.record("tweet_fragment", hit=False, count=len(keys) - len(found))
+    rendered = {}
+    for key, tweet in keys.items():
+        if key not in found:
+            rendered[key] = render_to_string("tweets/tweet_fragment.html", {"tweet": tweet, "variant": variant})
+        tweet.fragment = mark_safe(found.get(key) or rendered[key])
+    if rendered:
+        cache.get_cache().set_many(rendered, settings.VIEW_CACHE_TIMEOUT)
+    return tweets
+
+
+class TweetFragmentMixin:
+    fragment_variant = None
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        attach_fragments(context["object_list"], self.fragment_variant)
+        return context
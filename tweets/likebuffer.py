@@ -0,0 +1,154 @@
+import atexit
+import fcntl
+import logging
+import os
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+from . import trending
+from .models import Like
+
+logger = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    # いいね・いいね解除を (user, tweet) ごとに最後の1件へまとめておき、Like.objects.applyで一括して書き込む
+    # pathを指定すると追記専用のファイルに貯め、他のプロセスや管理コマンドからも書き込めるようにする
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        self._intents = {}
+        self._deltas = Counter()
+        self._flushing = Counter()
+        self._journal_inode = None
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def add(self, user_id, tweet, liked):
+        return self.add_many(user_id, [(tweet, liked)])[tweet.pk]
+
+    def add_many(self, user_id, intents):
+        # intents は (tweet, liked) の列。ツイートごとの見込みのいいね数を返す
+        # DBの状態との差分を楽観的ないいね数の計算に使う。書き込みロックは取らない
+        tweet_ids = defaultdict(list)
+        for tweet, _ in intents:
+            tweet_ids[Like.objects.db_for_tweet(tweet)].append(tweet.pk)
+        was_liked = set()
+        for using, pks in tweet_ids.items():
+            was_liked.update(
+                Like.objects.using(using).filter(user_id=user_id, tweet_id__in=pks).values_list("tweet_id", flat=True)
+            )
+        like_counts = {}
+        with self._lock:
+            if self.path:
+                self._append(f"{user_id} {tweet.pk} {int(liked)}\n" for tweet, liked in intents)
+            for tweet, liked in intents:
+                delta = int(liked) - int(tweet.pk in was_liked)
+                _, previous = self._intents.get((user_id, tweet.pk), (None, 0))
+                self._intents[(user_id, tweet.pk)] = (liked, delta)
+                self._deltas[tweet.pk] += delta - previous
+                like_count = tweet.like_count + self._deltas[tweet.pk] + self._flushing[tweet.pk]
+                like_counts[tweet.pk] = max(like_count, 0)
+            if len(self._intents) >= settings.LIKE_BUFFER_MAX_SIZE:
+                self._wakeup.set()
+        return like_counts
+
+    def __len__(self):
+        return len(self._intents)
+
+    def _append(self, lines):
+        data = "".join(lines).encode()
+        while True:
+            with open(self.path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # ロックを待つ間にflushでファイルが差し替えられていたら開き直す
+                inode = os.fstat(f.fileno()).st_ino
+                try:
+                    if os.stat(self.path).st_ino != inode:
+                        continue
+                except FileNotFoundError:
+                    continue
+                f.write(data)
+            break
+        if inode != self._journal_inode:
+            # 別のプロセスがflushしてファイルが新しくなったので、それまでの楽観的な差分は反映済みとみなす
+            if self._journal_inode is not None:
+                self._intents.clear()
+                self._deltas.clear()
+            self._journal_inode = inode
+
+    def flush(self):
+        with self._lock:
+            pending, self._intents = self._intents, {}
+            self._flushing, self._deltas = self._deltas, Counter()
+        intents = {key: liked for key, (liked, _) in pending.items()}
+        try:
+            if self.path:
+                intents = self._take_journal()
+            deltas = Like.objects.apply((user_id, tweet_id, liked) for (user_id, tweet_id), liked in intents.items())
+            trending.record("tweet", Counter({pk: delta for pk, delta in deltas.items() if delta > 0}).elements())
+            if self.path:
+                self.path.with_suffix(".flushing").unlink(missing_ok=True)
+        except Exception:
+            if not self.path:
+                # 書き込めなかった分は、その後に届いた同じ (user, tweet) の操作を優先して戻す
+                with self._lock:
+                    for key, intent in pending.items():
+                        self._intents.setdefault(key, intent)
+                    self._deltas.update(self._flushing)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = Counter()
+        return len(intents), deltas
+
+    def _take_journal(self):
+        flushing = self.path.with_suffix(".flushing")
+        with open(self.path.with_suffix(".lock"), "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # 前回のflushが途中で止まっていたら、その分から反映する (applyは同じ内容を何度反映しても結果が変わらない)
+            if not flushing.exists():
+                try:
+                    os.replace(self.path, flushing)
+                except FileNotFoundError:
+                    return {}
+            intents = {}
+            with open(flushing, "rb") as f:
+                # 差し替える前にファイルを開いていた書き込みが終わるのを待つ
+                fcntl.flock(f, fcntl.LOCK_EX)
+                for line in f:
+                    user_id, tweet_id, liked = line.split()
+                    intents[(int(user_id), int(tweet_id))] = liked == b"1"
+        return intents
+
+    def start(self, interval):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, args=(interval,), name="like-buffer", daemon=True)
+            self._worker.start()
+            atexit.register(self.flush)
+
+    def _run(self, interval):
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            try:
+                if len(self) or self.path:
+                    self.flush()
+            except Exception:
+                logger.exception("failed to flush like buffer")
+            finally:
+                # このスレッドの接続はリクエストの終了で閉じられないので、自分で閉じる
+                connections.close_all()
+
+
+@lru_cache(maxsize=None)
+def get_like_buffer():
+    buffer = LikeBuffer(settings.LIKE_BUFFER_PATH)
+    if settings.LIKE_BUFFER_FLUSH_INTERVAL:
+        buffer.start(settings.LIKE_BUFFER_FLUSH_INTERVAL)
+    return buffer
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tweets import trending
+
+
+class Command(BaseCommand):
+    help = "1時間より前の分単位のトレンドのバケットを1時間単位にまとめ、TRENDING_WINDOWより前のバケットを削除します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0, help="指定した秒数ごとに実行し続けます")
+
+    def handle(self, *args, **options):
+        while True:
+            merged, expired = trending.compact()
+            self.stdout.write(
+                self.style.SUCCESS(f"{merged}件のバケットを1時間単位にまとめ、{expired}件の古いバケットを削除しました")
+            )
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
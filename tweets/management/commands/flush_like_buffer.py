@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tweets import trending
+from tweets.likebuffer import LikeBuffer
+
+
+class Command(BaseCommand):
+    help = "LIKE_BUFFER_PATHに貯まったいいね・いいね解除をまとめてDBに書き込みます"
+
+    def handle(self, *args, **options):
+        if not settings.LIKE_BUFFER_PATH:
+            raise CommandError("LIKE_BUFFER_PATHが設定されていません (メモリ上のバッファは各プロセスが書き込みます)")
+        count, deltas = LikeBuffer(settings.LIKE_BUFFER_PATH).flush()
+        trending.get_counter().flush()
+        self.stdout.write(
+            self.style.SUCCESS(f"{count}件の操作を反映し、{len(deltas)}件のツイートのいいね数を更新しました")
+        )
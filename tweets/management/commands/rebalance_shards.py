@@ -0,0 +1,81 @@
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mysite import sharding
+from tweets import search, tags
+from tweets.models import Like, Tweet
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "シャードを作成し、ツイートといいねを投稿者のユーザーidに対応するシャードへ移します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError("DJANGO_TWEET_SHARDS でシャードの数を指定してください")
+        batch_size = options["batch_size"]
+        for db in sharding.get_shards():
+            call_command("migrate", database=db, verbosity=0)
+        users = self.copy_users(batch_size)
+        tweets = likes = 0
+        # シャーディング前のデータ (default) と、シャードを増やして移動先が変わったデータを移す
+        for source in ["default", *sharding.get_shards()]:
+            moved_tweets, moved_likes = self.move_tweets(source, batch_size)
+            tweets += moved_tweets
+            likes += moved_likes
+        self.stdout.write(
+            self.style.SUCCESS(f"{users}人のユーザーを複製し、{tweets}件のツイートと{likes}件のいいねを移しました")
+        )
+
+    def copy_users(self, batch_size):
+        copied = 0
+        last_pk = 0
+        while True:
+            batch = list(User.objects.using("default").filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+            if not batch:
+                return copied
+            sharding.replicate_users(batch)
+            copied += len(batch)
+            last_pk = batch[-1].pk
+
+    def move_tweets(self, source, batch_size):
+        fields = [field.attname for field in Tweet._meta.concrete_fields]
+        moved_tweets = moved_likes = 0
+        last_pk = 0
+        while True:
+            batch = list(Tweet.objects.using(source).filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+            if not batch:
+                return moved_tweets, moved_likes
+            last_pk = batch[-1].pk
+            by_target = defaultdict(list)
+            for tweet in batch:
+                target = sharding.shard_for_user(tweet.user_id)
+                if target != source:
+                    by_target[target].append(tweet)
+            for target, tweets in by_target.items():
+                pks = [tweet.pk for tweet in tweets]
+                likes = list(Like.objects.using(source).filter(tweet_id__in=pks).values_list("user_id", "tweet_id"))
+                # 移動先に書き込んでから元を消す。途中で止まってもやり直せば、移動先に入れ済みの行は無視される
+                with transaction.atomic(using=target):
+                    Tweet.objects.using(target).bulk_create(
+                        [Tweet(**{name: getattr(tweet, name) for name in fields}) for tweet in tweets],
+                        ignore_conflicts=True,
+                    )
+                    Like.objects.using(target).bulk_create(
+                        [Like(user_id=user_id, tweet_id=tweet_id) for user_id, tweet_id in likes],
+                        ignore_conflicts=True,
+                    )
+                    search.index_tweets(tweets, target)
+                    tags.index_tweets(tweets, target)
+                with transaction.atomic(using=source):
+                    Tweet.objects.using(source).filter(pk__in=pks).delete()
+                moved_tweets += len(tweets)
+                moved_likes += len(likes)
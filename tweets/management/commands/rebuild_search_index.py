@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from mysite import sharding
+from tweets import search
+
+
+class Command(BaseCommand):
+    help = "ツイートの全文検索インデックスを作り直します"
+
+    def handle(self, *args, **options):
+        indexed = 0
+        for using in sharding.get_databases():
+            indexed += search.rebuild(using)
+        self.stdout.write(self.style.SUCCESS(f"{indexed}件のツイートを検索インデックスに登録しました"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mysite import sharding
+from tweets import tags
+
+
+class Command(BaseCommand):
+    help = "ツイートの本文からハッシュタグ・メンションを抽出し直します"
+
+    def handle(self, *args, **options):
+        hashtags = mentions = 0
+        for using in sharding.get_databases():
+            created_hashtags, created_mentions = tags.rebuild(using)
+            hashtags += created_hashtags
+            mentions += created_mentions
+        self.stdout.write(self.style.SUCCESS(f"{hashtags}件のハッシュタグと{mentions}件のメンションを登録しました"))
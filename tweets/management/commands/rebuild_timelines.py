@@ -0,0 +1,17 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from tweets import timeline
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "フォロー関係から全ユーザーのホームタイムラインを作り直します"
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+        for user_id in User.objects.order_by("pk").values_list("pk", flat=True).iterator():
+            timeline.rebuild(user_id)
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f"{rebuilt}人のタイムラインを作り直しました"))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from mysite import cache, sharding
+from tweets.models import Like, Tweet
+
+
+class Command(BaseCommand):
+    help = "Tweet.like_count をLikeの実件数と突き合わせて修正します"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        counts = (
+            Like.objects.filter(tweet=OuterRef("pk")).order_by().values("tweet").annotate(n=Count("pk")).values("n")
+        )
+        checked = fixed = 0
+        # シャーディングしているときは、いいねがツイートと同じシャードにあるのでシャードごとに突き合わせる
+        for db in sharding.get_databases():
+            tweets = Tweet.objects.using(db)
+            last_pk = 0
+            while True:
+                batch = (
+                    tweets.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .annotate(actual_count=Coalesce(Subquery(counts), 0))
+                    .values_list("pk", "like_count", "actual_count")[:batch_size]
+                )
+                rows = list(batch)
+                if not rows:
+                    break
+                stale = [(pk, actual - like_count) for pk, like_count, actual in rows if like_count != actual]
+                with transaction.atomic(using=db):
+                    # 集計中に増減した分を上書きしないよう、差分だけをF()で反映する
+                    for pk, diff in stale:
+                        tweets.filter(pk=pk).update(like_count=F("like_count") + diff)
+                        cache.invalidate("tweet", pk)
+                checked += len(rows)
+                fixed += len(stale)
+                last_pk = rows[-1][0]
+        self.stdout.write(self.style.SUCCESS(f"{checked}件のツイートを確認し、{fixed}件のいいね数を修正しました"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from tweets import timeline
+from tweets.models import TimelineEntry
+
+
+class Command(BaseCommand):
+    help = "TIMELINE_MAX_LENGTHを超えた古いタイムラインのエントリーを削除します"
+
+    def handle(self, *args, **options):
+        user_ids = TimelineEntry.objects.order_by("user_id").values_list("user_id", flat=True).distinct()
+        deleted = sum(timeline.trim(user_id) for user_id in user_ids.iterator())
+        self.stdout.write(self.style.SUCCESS(f"{deleted}件のエントリーを削除しました"))
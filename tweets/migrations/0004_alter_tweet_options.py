@@ -0,0 +1,16 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:53
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tweets", "0003_alter_like_tweet"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="tweet",
+            options={"ordering": ["-created_at", "-id"]},
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tweets", "0007_tweet_created_indexes"),
+    ]
+
+    # 本文をbigramに区切ったトークンの全文検索インデックス (tweets/search.py)。既存のツイートは rebuild_search_index で登録する
+    operations = [
+        migrations.RunSQL(
+            sql="CREATE VIRTUAL TABLE tweets_tweet_search USING fts5(tokens, tokenize = 'unicode61 remove_diacritics 0')",
+            reverse_sql="DROP TABLE tweets_tweet_search",
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.13 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0009_tweet_tags"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TrendBucket",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("kind", models.CharField(max_length=10)),
+                ("name", models.CharField(max_length=50)),
+                ("start", models.DateTimeField()),
+                ("width", models.PositiveIntegerField()),
+                ("count", models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="trendbucket",
+            index=models.Index(fields=["kind", "start"], name="trend_kind_start_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="trendbucket",
+            constraint=models.UniqueConstraint(fields=("kind", "width", "start", "name"), name="unique_trend_bucket"),
+        ),
+    ]
@@ -1,27 +1,215 @@
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import or_
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Exists, F, OuterRef, Q
 from django.utils import timezone
 
-from mysite import settings
+from mysite import cache, settings, sharding
+
+from . import events
 
 User = get_user_model()
 
+BULK_DELETE_SIZE = 500
+
+
+class TweetQuerySet(models.QuerySet):
+    def with_like_state(self, user):
+        # 表示するツイートについてだけ、閲覧者がいいね済みかを調べる
+        return self.annotate(is_liked=Exists(Like.objects.filter(user=user, tweet=OuterRef("pk"))))
+
+    def create(self, **kwargs):
+        # シャーディングしているときは、DBを指定されていなければ投稿者のシャードに作る
+        if self._db is None and sharding.is_enabled():
+            user_id = kwargs["user"].pk if "user" in kwargs else kwargs["user_id"]
+            return self.using(sharding.shard_for_user(user_id)).create(**kwargs)
+        return super().create(**kwargs)
+
 
 class Tweet(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.CharField(max_length=50)
     created_at = models.DateTimeField(default=timezone.now)
+    like_count = models.PositiveIntegerField(default=0)
+
+    objects = TweetQuerySet.as_manager()
 
     def __str__(self):
         return self.content
 
     class Meta:
-        ordering = ["-created_at"]
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            models.Index(fields=["user", "-created_at", "-id"], name="tweet_user_created_idx"),
+            models.Index(fields=["-created_at", "-id"], name="tweet_created_idx"),
+        ]
+
+
+class LikeManager(models.Manager):
+    # いいね数はLikeの追加・削除と同じトランザクションで更新する
+    # Likeにシグナルをつなぐと削除が一括削除にならないので、キャッシュの無効化もここで行う
+    def db_for_tweet(self, tweet):
+        # シャーディングしているときは、いいねをツイートと同じシャードに書き込む
+        return router.db_for_write(Tweet, instance=tweet)
+
+    def like(self, user, tweet):
+        using = self.db_for_tweet(tweet)
+        if self.using(using).filter(user=user, tweet=tweet).exists():
+            return False
+        # SQLiteは読み込みから始まったトランザクションを書き込みに昇格できずロックエラーになるので、INSERTから始める
+        try:
+            with transaction.atomic(using=using):
+                self.db_manager(using).create(user=user, tweet=tweet)
+                Tweet.objects.using(using).filter(pk=tweet.pk).update(like_count=F("like_count") + 1)
+                cache.invalidate("tweet", tweet.pk)
+                events.publish({"type": "like", "tweet": tweet.pk, "delta": 1, "users": [[user.pk, 1]]}, using=using)
+        except IntegrityError:
+            return False
+        return True
+
+    def unlike(self, user, tweet):
+        using = self.db_for_tweet(tweet)
+        with transaction.atomic(using=using):
+            deleted, _ = self.using(using).filter(user=user, tweet=tweet).delete()
+            if deleted:
+                Tweet.objects.using(using).filter(pk=tweet.pk).update(like_count=F("like_count") - 1)
+                cache.invalidate("tweet", tweet.pk)
+                events.publish({"type": "like", "tweet": tweet.pk, "delta": -1, "users": [[user.pk, -1]]}, using=using)
+        return bool(deleted)
+
+    # トランザクションはasyncに対応していないので、いいね数の更新ごとスレッドで実行する
+    async def alike(self, user, tweet):
+        return await sync_to_async(self.like)(user, tweet)
+
+    async def aunlike(self, user, tweet):
+        return await sync_to_async(self.unlike)(user, tweet)
+
+    def apply(self, actions):
+        # (user_id, tweet_id, liked) の列をまとめて反映し、ツイートごとのいいね数の増減を返す
+        intents = {}
+        for user_id, tweet_id, liked in actions:
+            intents[(user_id, tweet_id)] = liked
+        if not intents:
+            return {}
+        if not sharding.is_enabled():
+            return self._apply(intents, router.db_for_write(Like))
+        # ツイートのあるシャードごとに分けて反映する。どこにもないツイートへの操作は捨てる
+        tweets = sharding.find(Tweet.objects.only("pk"), {tweet_id for _, tweet_id in intents})
+        by_db = defaultdict(dict)
+        for (user_id, tweet_id), liked in intents.items():
+            if tweet_id in tweets:
+                by_db[tweets[tweet_id]._state.db][(user_id, tweet_id)] = liked
+        deltas = {}
+        for using, shard_intents in by_db.items():
+            deltas.update(self._apply(shard_intents, using))
+        return deltas
+
+    def _apply(self, intents, using):
+        user_ids = {user_id for user_id, _ in intents}
+        tweet_ids = {tweet_id for _, tweet_id in intents}
+        likes = self.db_manager(using)
+        with transaction.atomic(using=using):
+            existing = set(
+                likes.filter(user_id__in=user_ids, tweet_id__in=tweet_ids).values_list("user_id", "tweet_id")
+            )
+            valid_tweet_ids = set(Tweet.objects.using(using).filter(pk__in=tweet_ids).values_list("pk", flat=True))
+            to_create = [
+                key for key, liked in intents.items() if liked and key not in existing and key[1] in valid_tweet_ids
+            ]
+            to_delete = [key for key, liked in intents.items() if not liked and key in existing]
+            likes.bulk_create(
+                [Like(user_id=user_id, tweet_id=tweet_id) for user_id, tweet_id in to_create], ignore_conflicts=True
+            )
+            for start in range(0, len(to_delete), BULK_DELETE_SIZE):
+                pairs = to_delete[start : start + BULK_DELETE_SIZE]
+                likes.filter(
+                    reduce(or_, (Q(user_id=user_id, tweet_id=tweet_id) for user_id, tweet_id in pairs))
+                ).delete()
+
+            deltas = Counter(tweet_id for _, tweet_id in to_create)
+            deltas.subtract(tweet_id for _, tweet_id in to_delete)
+            deltas = {tweet_id: delta for tweet_id, delta in deltas.items() if delta}
+            by_delta = defaultdict(list)
+            for tweet_id, delta in deltas.items():
+                by_delta[delta].append(tweet_id)
+            for delta, pks in by_delta.items():
+                Tweet.objects.using(using).filter(pk__in=pks).update(like_count=F("like_count") + delta)
+            # 操作したユーザーごとの増減も配り、各ユーザーには自分の分を除いた増減を送る
+            users = defaultdict(list)
+            for user_id, tweet_id in to_create:
+                users[tweet_id].append([user_id, 1])
+            for user_id, tweet_id in to_delete:
+                users[tweet_id].append([user_id, -1])
+            # 増減の合計が0でも、操作したユーザーの画面には他のユーザーの分の増減を送る
+            for tweet_id, tweet_users in users.items():
+                cache.invalidate("tweet", tweet_id)
+                events.publish(
+                    {"type": "like", "tweet": tweet_id, "delta": deltas.get(tweet_id, 0), "users": tweet_users},
+                    using=using,
+                )
+        return deltas
 
 
 class Like(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="like_tweet")
 
+    objects = LikeManager()
+
     class Meta:
         constraints = [models.UniqueConstraint(fields=["user", "tweet"], name="unique_like")]
+
+
+class TimelineEntry(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="timeline_entries")
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="timeline_entries")
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "tweet"], name="unique_timeline_entry")]
+        indexes = [models.Index(fields=["user", "-created_at", "-tweet"], name="timeline_user_created_idx")]
+
+
+class Hashtag(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class TweetHashtag(models.Model):
+    # ハッシュタグごとのタイムラインをインデックスだけで新しい順に読めるよう、ツイートの投稿日時を持たせる
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="hashtags")
+    hashtag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name="tweets")
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["hashtag", "tweet"], name="unique_tweet_hashtag")]
+        indexes = [models.Index(fields=["hashtag", "-created_at", "-tweet"], name="hashtag_created_idx")]
+
+
+class Mention(models.Model):
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="mentions")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="mentions")
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "tweet"], name="unique_mention")]
+        indexes = [models.Index(fields=["user", "-created_at", "-tweet"], name="mention_user_created_idx")]
+
+
+class TrendBucket(models.Model):
+    # トレンドの集計。start から width 秒の間に kind (hashtag・tweet) の name が数えられた件数
+    kind = models.CharField(max_length=10)
+    name = models.CharField(max_length=50)
+    start = models.DateTimeField()
+    width = models.PositiveIntegerField()
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["kind", "width", "start", "name"], name="unique_trend_bucket")]
+        indexes = [models.Index(fields=["kind", "start"], name="trend_kind_start_idx")]
@@ -0,0 +1,99 @@
+import re
+import unicodedata
+
+from django.db import connections, router, transaction
+
+from mysite import sharding
+
+from .models import Tweet
+
+TABLE = "tweets_tweet_search"
+BATCH_SIZE = 1000
+MAX_RESULTS = 1000
+MAX_QUERY_TERMS = 16
+
+# ひらがな・カタカナ・漢字の並びは2文字ずつ (bigram)、それ以外は単語ごとに区切る
+_CJK = "ぁ-ゖゝ-ゟァ-ヺー-ヿ㐀-䶿一-鿿豈-﫿々〆"
+_TOKEN_RE = re.compile(f"([{_CJK}]+)|([^\\W{_CJK}]+)")
+
+
+def _runs(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    for match in _TOKEN_RE.finditer(text):
+        cjk, word = match.groups()
+        if cjk:
+            yield [cjk[i : i + 2] for i in range(max(len(cjk) - 1, 1))], True
+        else:
+            yield [word], False
+
+
+def tokenize(text):
+    return [token for tokens, _ in _runs(text) for token in tokens]
+
+
+def build_match(query):
+    # 日本語の並びはbigramを連続したフレーズとして探す。1文字だけのときは、その文字で始まるbigramを前方一致で探す
+    # トークンは英数字と日本語の文字だけなので、引用符で囲めばFTS5の構文として解釈されない
+    phrases = []
+    for tokens, is_cjk in _runs(query):
+        phrase = '"' + " ".join(tokens) + '"'
+        if is_cjk and len(tokens[0]) == 1:
+            phrase += "*"
+        phrases.append(phrase)
+    return " ".join(phrases[:MAX_QUERY_TERMS])
+
+
+def index_tweets(tweets, using, replace=True):
+    rows = [(tweet.pk, " ".join(tokenize(tweet.content))) for tweet in tweets]
+    with connections[using].cursor() as cursor:
+        if replace:
+            cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk, _ in rows])
+        cursor.executemany(f"INSERT INTO {TABLE} (rowid, tokens) VALUES (%s, %s)", rows)
+
+
+def unindex_tweets(pks, using):
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk in pks])
+
+
+def rebuild(using):
+    indexed = 0
+    last_pk = 0
+    tweets = Tweet.objects.using(using).order_by("pk").only("content")
+    # 作り直している間も検索できるよう、入れ替えは1つのトランザクションで行う
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+        while True:
+            batch = list(tweets.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                break
+            index_tweets(batch, using, replace=False)
+            indexed += len(batch)
+            last_pk = batch[-1].pk
+    with connections[using].cursor() as cursor:
+        # 削除・追加を繰り返して断片化したセグメントをまとめる
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def search(query, offset=0, limit=20):
+    # bm25の昇順 (関連度の高い順)、同点なら新しい順に (tweet_id, rank) を返す
+    match = build_match(query)
+    if not match or offset >= MAX_RESULTS:
+        return []
+    limit = min(limit, MAX_RESULTS - offset)
+    hits = []
+    # シャーディングしているときは各シャードから上位を集めてマージする。bm25の統計はシャードごとなので近似になる
+    for using in sharding.get_shards() or [router.db_for_read(Tweet)]:
+        with connections[using].cursor() as cursor:
+            # よく使われる語は全件のbm25を計算すると遅いので、新しい方から MAX_RESULTS 件に絞ってから順位を付ける
+            # FTS5はrowidの降順なら並べ替えずに読めるので、候補を取る部分はLIMITで打ち切れる
+            cursor.execute(
+                f"SELECT rowid, rank FROM (SELECT rowid, rank FROM {TABLE} WHERE {TABLE} MATCH %s"
+                " ORDER BY rowid DESC LIMIT %s) ORDER BY rank, rowid DESC LIMIT %s",
+                [match, MAX_RESULTS, offset + limit],
+            )
+            hits.extend(cursor.fetchall())
+    hits.sort(key=lambda hit: (hit[1], -hit[0]))
+    return hits[offset : offset + limit]
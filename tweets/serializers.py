@@ -0,0 +1,19 @@
+from mysite import cache
+
+
+def serialize_tweet(tweet):
+    # with_like_state() で取得したツイートをAPI用のdictにする
+    return {
+        "pk": tweet.pk,
+        "username": tweet.user.username,
+        "content": tweet.content,
+        "created_at": tweet.created_at,
+        "like_count": tweet.like_count,
+        "is_liked": tweet.is_liked,
+    }
+
+
+def get_tweet_versions(tweet_ids):
+    # ツイートの更新・削除・いいねで上がるキャッシュのバージョンを、一覧のETagに入れるために並べて返す
+    versions = cache.get_versions("tweet", tweet_ids)
+    return [(pk, versions[pk]) for pk in tweet_ids]
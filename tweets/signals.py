@@ -0,0 +1,97 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from accounts.models import FriendShip
+from mysite import cache, sharding
+
+from . import events, search, tags, timeline
+from .models import Like, Tweet
+
+User = get_user_model()
+
+
+@receiver(pre_save, sender=Tweet)
+def assign_tweet_id(sender, instance, **kwargs):
+    # シャードごとの連番ではidが重なるので、保存前にどのシャードでも一意なidを振る
+    if sharding.is_enabled() and instance.pk is None:
+        instance.pk = sharding.next_id()
+
+
+@receiver(post_save, sender=Tweet)
+def fan_out_tweet(sender, instance, created, **kwargs):
+    if created:
+        # シャーディングしているときのホームは読み込み時に各シャードから集めるので、配信しない
+        if not sharding.is_enabled():
+            timeline.fan_out(instance)
+        events.publish({"type": "tweet", "tweet": instance.pk, "user": instance.user_id}, using=kwargs["using"])
+
+
+@receiver(post_save, sender=FriendShip)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created and not sharding.is_enabled():
+        timeline.backfill(instance.follower_id, instance.followee_id)
+
+
+@receiver(post_delete, sender=FriendShip)
+def remove_from_timeline(sender, instance, **kwargs):
+    if not sharding.is_enabled():
+        timeline.remove(instance.follower_id, instance.followee_id)
+
+
+@receiver(post_save, sender=Tweet)
+def index_tweet(sender, instance, created, using, **kwargs):
+    search.index_tweets([instance], using, replace=not created)
+
+
+@receiver(post_save, sender=Tweet)
+def index_tags(sender, instance, created, using, update_fields, **kwargs):
+    # フォーム以外 (Tweet.objects.create など) で作ったツイートのハッシュタグ・メンションもここで作る
+    # ツイートを消したときは外部キーのCASCADEで消える
+    if not created:
+        if update_fields is not None and "content" not in update_fields:
+            return
+        tags.unindex_tweets([instance.pk], using)
+    tags.index_tweets([instance], using)
+
+
+@receiver(post_delete, sender=Tweet)
+def unindex_tweet(sender, instance, using, **kwargs):
+    search.unindex_tweets([instance.pk], using)
+
+
+@receiver(post_save, sender=Tweet)
+@receiver(post_delete, sender=Tweet)
+def invalidate_tweet(sender, instance, **kwargs):
+    cache.invalidate("tweet", instance.pk)
+
+
+@receiver(post_save, sender=User)
+def replicate_user(sender, instance, using, **kwargs):
+    if using == "default":
+        sharding.replicate_users([instance])
+
+
+@receiver(pre_delete, sender=User)
+def decrement_like_counts(sender, instance, using, **kwargs):
+    # ユーザーの削除でCASCADEされるいいねはLikeManagerを通らないので、いいねしていたツイートのいいね数をここで減らす
+    # シャーディングしているときは、いいねのあるシャードから複製を消すときに減らす
+    if using not in sharding.get_databases():
+        return
+    tweet_ids = list(Like.objects.using(using).filter(user=instance).values_list("tweet_id", flat=True))
+    if not tweet_ids:
+        return
+    Tweet.objects.using(using).filter(pk__in=Like.objects.filter(user=instance).values("tweet_id")).update(
+        like_count=F("like_count") - 1
+    )
+    for tweet_id in tweet_ids:
+        cache.invalidate("tweet", tweet_id)
+
+
+@receiver(post_delete, sender=User)
+def delete_replicated_user(sender, instance, using, **kwargs):
+    if using == "default" and sharding.is_enabled():
+        for db in sharding.get_shards():
+            # シャードのツイート・いいねも外部キーのCASCADEで消える
+            User.objects.using(db).filter(pk=instance.pk).delete()
@@ -0,0 +1,131 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from mysite import sharding
+from mysite.pagination import keyset_slice
+
+from .models import Hashtag, Mention, Tweet, TweetHashtag
+
+User = get_user_model()
+
+BATCH_SIZE = 1000
+
+# 単語の途中の # や、メールアドレスの @ は拾わない
+# ユーザー名には . @ + - も使えるが、文末の「@tester.」のような句読点は含めない
+HASHTAG_RE = re.compile(r"(?<![\w&#])#(\w+)")
+MENTION_RE = re.compile(r"(?<![\w.@+-])@([\w.@+-]*\w)")
+TAG_RE = re.compile(f"{HASHTAG_RE.pattern}|{MENTION_RE.pattern}")
+
+
+def normalize_hashtag(name):
+    return unicodedata.normalize("NFKC", name).lower()
+
+
+def normalize(content):
+    # NFKCで正規化した本文と、正規化後の1文字ごとの元の本文での (開始位置, 終了位置) を返す
+    # 位置を元に戻せるよう、結合文字をつなげた1文字ずつ正規化する
+    if unicodedata.is_normalized("NFKC", content):
+        return content, [(i, i + 1) for i in range(len(content))]
+    pieces, spans = [], []
+    start = 0
+    while start < len(content):
+        end = start + 1
+        while end < len(content) and unicodedata.combining(content[end]):
+            end += 1
+        piece = unicodedata.normalize("NFKC", content[start:end])
+        pieces.append(piece)
+        spans += [(start, end)] * len(piece)
+        start = end
+    return "".join(pieces), spans
+
+
+def find_tags(content):
+    # 本文のハッシュタグ・メンションを (元の本文での開始位置, 終了位置, ハッシュタグ, ユーザー名) で返す
+    # 全角の＃・＠などはNFKCでそろえてから探す。リンクにするときも同じ位置になるよう、ここだけで探す
+    normalized, spans = normalize(content)
+    for match in TAG_RE.finditer(normalized):
+        hashtag, username = match.groups()
+        yield spans[match.start()][0], spans[match.end() - 1][1], hashtag, username
+
+
+def parse(content):
+    # 英字の大文字小文字の違いは小文字化でそろえる
+    tags = list(find_tags(content))
+    hashtags = list(dict.fromkeys(normalize_hashtag(hashtag) for _, _, hashtag, _ in tags if hashtag))
+    usernames = list(dict.fromkeys(username for _, _, _, username in tags if username))
+    return hashtags, usernames
+
+
+def index_tweets(tweets, using):
+    # ツイートと同じDB (シャード) にハッシュタグ・メンションを作る。メンション先のユーザーは1回のクエリでまとめて引く
+    parsed = {tweet.pk: parse(tweet.content) for tweet in tweets}
+    names = {name for hashtags, _ in parsed.values() for name in hashtags}
+    usernames = {username for _, usernames in parsed.values() for username in usernames}
+    hashtag_ids = {}
+    if names:
+        hashtags = Hashtag.objects.using(using)
+        hashtags.bulk_create([Hashtag(name=name) for name in names], ignore_conflicts=True)
+        hashtag_ids = dict(hashtags.filter(name__in=names).values_list("name", "pk"))
+    user_ids = {}
+    if usernames:
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list("username", "pk"))
+
+    entries, mentions = [], []
+    for tweet in tweets:
+        hashtags, usernames = parsed[tweet.pk]
+        entries += [
+            TweetHashtag(tweet_id=tweet.pk, hashtag_id=hashtag_ids[name], created_at=tweet.created_at)
+            for name in hashtags
+        ]
+        mentions += [
+            Mention(tweet_id=tweet.pk, user_id=user_ids[username], created_at=tweet.created_at)
+            for username in usernames
+            if username in user_ids
+        ]
+    TweetHashtag.objects.using(using).bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    Mention.objects.using(using).bulk_create(mentions, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    return len(entries), len(mentions)
+
+
+def unindex_tweets(pks, using):
+    TweetHashtag.objects.using(using).filter(tweet_id__in=pks).delete()
+    Mention.objects.using(using).filter(tweet_id__in=pks).delete()
+
+
+def rebuild(using):
+    hashtags = mentions = 0
+    last_pk = 0
+    tweets = Tweet.objects.using(using).order_by("pk").only("content", "created_at")
+    with transaction.atomic(using=using):
+        TweetHashtag.objects.using(using).all().delete()
+        Mention.objects.using(using).all().delete()
+        while True:
+            batch = list(tweets.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                return hashtags, mentions
+            created_hashtags, created_mentions = index_tweets(batch, using)
+            hashtags += created_hashtags
+            mentions += created_mentions
+            last_pk = batch[-1].pk
+
+
+def get_tagged_tweets(queryset, entries, position, limit):
+    # ハッシュタグ・メンションの行から (created_at, tweet_id) の順に位置を決め、ツイートはまとめて取得する
+    # シャーディングしているときは各シャードから集めてマージする
+    rows = []
+    for using in sharding.get_shards() or [None]:
+        shard_entries = entries.using(using) if using else entries
+        slice_ = keyset_slice(shard_entries, position, limit, pk_field="tweet_id")
+        rows += [(created_at, pk, using) for created_at, pk in slice_.values_list("created_at", "tweet_id")]
+    rows = sorted(rows, key=lambda row: row[:2], reverse=True)[:limit]
+    pks_by_db = defaultdict(list)
+    for _, pk, using in rows:
+        pks_by_db[using].append(pk)
+    tweets = {}
+    for using, pks in pks_by_db.items():
+        tweets.update((queryset.using(using) if using else queryset).in_bulk(pks))
+    return [tweets[pk] for _, pk, _ in rows if pk in tweets]
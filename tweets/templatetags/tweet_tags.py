@@ -0,0 +1,25 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import conditional_escape, format_html
+from django.utils.safestring import mark_safe
+
+from ..tags import find_tags
+
+register = template.Library()
+
+
+@register.filter
+def linkify_tags(content):
+    # 本文の #ハッシュタグ と @ユーザー名 を、それぞれのページへのリンクにする
+    parts = []
+    end = 0
+    for start, tag_end, hashtag, username in find_tags(content):
+        parts.append(conditional_escape(content[end:start]))
+        if hashtag:
+            url = reverse("tweets:hashtag", kwargs=dict(name=hashtag))
+        else:
+            url = reverse("accounts:user_profile", kwargs=dict(username=username))
+        parts.append(format_html('<a href="{}">{}</a>', url, content[start:tag_end]))
+        end = tag_end
+    parts.append(conditional_escape(content[end:]))
+    return mark_safe("".join(parts))
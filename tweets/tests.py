@@ -1,8 +1,32 @@
+import asyncio
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import FriendShip
+from mysite import cache, sharding
+from mysite.pagination import encode_cursor
 
-from .models import Like, Tweet
+from .events import EventStreamMiddleware, FileBroker, format_event
+from .likebuffer import get_like_buffer
+from .models import Hashtag, Like, Mention, TimelineEntry, TrendBucket, Tweet, TweetHashtag
+from .search import tokenize
+from .tags import parse
+from .templatetags.tweet_tags import linkify_tags
+from .trending import SpaceSaving, get_counter, get_top
 
 User = get_user_model()
 
@@ -21,6 +45,225 @@ class TestHomeView(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertQuerysetEqual(test_list, Tweet.objects.all(), ordered=False)
 
+    def test_success_get_with_cursor(self):
+        created_at = timezone.now()
+        for i in range(25):
+            Tweet.objects.create(user=self.user, content=f"paged{i}", created_at=created_at)
+        response = self.client.get(self.url)
+        first_page = response.context["tweet_list"]
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(first_page), 20)
+        self.assertTrue(page_obj.has_next())
+
+        response = self.client.get(reverse("tweets:home_more"), {"before": page_obj.next_cursor})
+        second_page = response.context["tweet_list"]
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "tweets/tweet_list.html")
+        self.assertTemplateNotUsed(response, "base.html")
+        self.assertEqual(len(second_page), 7)
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertQuerysetEqual([*first_page, *second_page], Tweet.objects.all())
+
+    def test_success_get_with_like_state(self):
+        liked, unliked = Tweet.objects.all()
+        Like.objects.like(self.user, liked)
+        response = self.client.get(self.url)
+        like_state = {tweet: tweet.is_liked for tweet in response.context["tweet_list"]}
+        self.assertEqual(like_state, {liked: True, unliked: False})
+        self.assertNotIn("like_list", response.context)
+
+    def test_success_get_with_cached_fragments(self):
+        tweet = Tweet.objects.first()
+        self.client.get(self.url)
+        before = cache.get_stats()["tweet_fragment"]
+        self.client.get(self.url)
+        after = cache.get_stats()["tweet_fragment"]
+        self.assertEqual(after["hits"] - before["hits"], 2)
+        self.assertEqual(after["misses"], before["misses"])
+
+        Like.objects.like(self.user, tweet)
+        response = self.client.get(self.url)
+        self.assertEqual(cache.get_stats()["tweet_fragment"]["misses"] - after["misses"], 1)
+        self.assertContains(response, "いいね数: 1")
+
+    def test_failure_get_with_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "invalid"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_failure_get_with_out_of_range_cursor(self):
+        response = self.client.get(self.url, {"before": encode_cursor(timezone.now(), 2**63)})
+        self.assertEqual(response.status_code, 404)
+
+
+class TestHomeTimeline(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.user3 = User.objects.create_user(username="tester3", password="testpassword3")
+        self.client.force_login(self.user1)
+        self.url = reverse("tweets:home")
+
+    def test_success_get_followee_tweets(self):
+        FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        own_tweet = Tweet.objects.create(user=self.user1, content="owncontent")
+        followee_tweet = Tweet.objects.create(user=self.user2, content="followeecontent")
+        Tweet.objects.create(user=self.user3, content="strangercontent")
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context["tweet_list"], [followee_tweet, own_tweet])
+
+    def test_success_follow_and_unfollow(self):
+        tweet = Tweet.objects.create(user=self.user2, content="followeecontent")
+        friendship = FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user1, tweet=tweet).exists())
+        friendship.delete()
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user1).exists())
+
+    @override_settings(TIMELINE_FANOUT_THRESHOLD=1)
+    def test_success_get_crowded_followee_tweets(self):
+        FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        FriendShip.objects.create(followee=self.user2, follower=self.user3)
+        own_tweet = Tweet.objects.create(user=self.user1, content="owncontent")
+        crowded_tweet = Tweet.objects.create(user=self.user2, content="crowdedcontent")
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user1, tweet=crowded_tweet).exists())
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context["tweet_list"], [crowded_tweet, own_tweet])
+
+    @override_settings(TIMELINE_MAX_LENGTH=2)
+    def test_success_trim_timelines(self):
+        tweets = [Tweet.objects.create(user=self.user1, content=f"content{i}") for i in range(4)]
+        call_command("trim_timelines", stdout=StringIO())
+        entries = TimelineEntry.objects.filter(user=self.user1).values_list("tweet", flat=True)
+        self.assertQuerysetEqual(entries, [tweets[3].pk, tweets[2].pk], ordered=False)
+
+    def test_success_rebuild_timelines(self):
+        FriendShip.objects.create(followee=self.user2, follower=self.user1)
+        tweet = Tweet.objects.create(user=self.user2, content="followeecontent")
+        TimelineEntry.objects.all().delete()
+        call_command("rebuild_timelines", stdout=StringIO())
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user1, tweet=tweet).exists())
+
+
+def explain_query_plan(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        return [row[-1] for row in cursor.fetchall()]
+
+
+class TestTweetAPI(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+        self.url = reverse("tweets:api_home")
+        created_at = timezone.now()
+        for i in range(25):
+            Tweet.objects.create(user=self.user, content=f"paged{i}", created_at=created_at)
+
+    def test_success_get_home(self):
+        response = self.client.get(self.url)
+        first_page = response.json()
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertEqual(len(first_page["tweets"]), 20)
+        self.assertEqual(
+            set(first_page["tweets"][0]), {"pk", "username", "content", "created_at", "like_count", "is_liked"}
+        )
+        second_page = self.client.get(self.url, {"before": first_page["next"]}).json()
+        self.assertIsNone(second_page["next"])
+        self.assertEqual(
+            [tweet["pk"] for tweet in [*first_page["tweets"], *second_page["tweets"]]],
+            list(Tweet.objects.values_list("pk", flat=True)),
+        )
+
+    def test_success_get_home_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header("Last-Modified"))
+        # セッション・ユーザー・タイムラインのページのid
+        with self.assertNumQueries(3):
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+
+        Tweet.objects.create(user=self.user, content="new", created_at=timezone.now() + timedelta(seconds=1))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["tweets"][0]["content"], "new")
+
+    def test_success_get_home_modified_by_delete_and_like(self):
+        etag = self.client.get(self.url)["ETag"]
+        Tweet.objects.order_by("-created_at", "-pk")[5].delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        other = User.objects.create_user(username="other", password="testpassword")
+        Like.objects.like(other, Tweet.objects.order_by("-created_at", "-pk")[3])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["tweets"][3]["like_count"], 1)
+
+    def test_success_get_detail(self):
+        tweet = Tweet.objects.first()
+        url = reverse("tweets:api_detail", kwargs=dict(pk=tweet.pk))
+        response = self.client.get(url)
+        self.assertEqual(response.json()["is_liked"], False)
+        Like.objects.like(self.user, tweet)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()["like_count"], response.json()["is_liked"]), (1, True))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.has_header("Last-Modified"))
+
+    def test_success_get_detail_modified_by_own_like(self):
+        # 自分のいいねと他の人の取り消しでいいね数が変わらなくても、304にしない
+        tweet = Tweet.objects.first()
+        other = User.objects.create_user(username="other", password="testpassword")
+        Like.objects.like(other, tweet)
+        url = reverse("tweets:api_detail", kwargs=dict(pk=tweet.pk))
+        etag = self.client.get(url)["ETag"]
+        Like.objects.like(self.user, tweet)
+        Like.objects.unlike(other, tweet)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()["like_count"], response.json()["is_liked"]), (1, True))
+
+    def test_failure_get_detail_with_nonexistent_tweet(self):
+        response = self.client.get(reverse("tweets:api_detail", kwargs=dict(pk=100)))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestQueryPlan(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+        for i in range(3):
+            tweet = Tweet.objects.create(user=self.user, content=f"testcontent{i}")
+            Like.objects.like(self.user, tweet)
+
+    def assertQueryUsesIndex(self, url, table, index_name):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        queries = [q["sql"] for q in context.captured_queries if q["sql"].startswith(f'SELECT "{table}"')]
+        self.assertTrue(queries, f"no query on {table}")
+        plan = explain_query_plan(queries[0])
+        self.assertTrue(any(index_name in detail for detail in plan), plan)
+        self.assertFalse(any("TEMP B-TREE" in detail for detail in plan), plan)
+
+    def test_home_uses_timeline_index(self):
+        self.assertQueryUsesIndex(reverse("tweets:home"), "tweets_timelineentry", "timeline_user_created_idx")
+
+    def test_user_profile_uses_tweet_user_index(self):
+        url = reverse("accounts:user_profile", kwargs=dict(username=self.user))
+        self.assertQueryUsesIndex(url, "tweets_tweet", "tweet_user_created_idx")
+
+    def test_like_state_uses_unique_like_index(self):
+        # UniqueConstraint(user, tweet) はSQLiteではsqlite_autoindexとして作られる
+        plan = explain_query_plan(str(Tweet.objects.with_like_state(self.user)[:20].query))
+        self.assertIn("SEARCH U0 USING COVERING INDEX sqlite_autoindex_tweets_like_1 (user_id=? AND tweet_id=?)", plan)
+
+    def test_global_ordering_uses_tweet_created_index(self):
+        plan = explain_query_plan(str(Tweet.objects.all()[:20].query))
+        self.assertTrue(any("tweet_created_idx" in detail for detail in plan), plan)
+        self.assertFalse(any("TEMP B-TREE" in detail for detail in plan), plan)
+
 
 class TestTweetCreateView(TestCase):
     def setUp(self):
@@ -130,6 +373,22 @@ class TestLikeView(TestCase):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(Like.objects.count(), 1)
+        self.assertEqual(response.json()["like_count"], 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
+
+    async def test_success_post_with_async_client(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.post(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["like_count"], 1)
+        self.assertEqual(await Like.objects.acount(), 1)
+
+    def test_failure_post_with_anonymous_user(self):
+        self.client.logout()
+        response = self.client.post(self.url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}")
+        self.assertEqual(Like.objects.count(), 0)
 
     def test_failure_post_with_not_exist_tweet(self):
         self.url = reverse("tweets:like", kwargs=dict(pk=self.tweet.pk + 1))
@@ -138,10 +397,20 @@ class TestLikeView(TestCase):
         self.assertEqual(Like.objects.count(), 0)
 
     def test_failure_post_with_liked_tweet(self):
-        Like.objects.create(user=self.user, tweet=self.tweet)
+        Like.objects.like(self.user, self.tweet)
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(Like.objects.count(), 1)
+        self.assertEqual(response.json()["like_count"], 1)
+
+    def test_success_delete_liking_user(self):
+        other = User.objects.create_user(username="other", password="testpassword")
+        Like.objects.like(other, self.tweet)
+        Like.objects.like(self.user, self.tweet)
+        other.delete()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
+        self.assertEqual(Like.objects.count(), 1)
 
 
 class TestUnLikeView(TestCase):
@@ -149,13 +418,16 @@ class TestUnLikeView(TestCase):
         self.user = User.objects.create_user(username="tester", password="testpassword")
         self.client.force_login(self.user)
         self.tweet = Tweet.objects.create(user=self.user, content="testcontent")
-        Like.objects.create(user=self.user, tweet=self.tweet)
+        Like.objects.like(self.user, self.tweet)
         self.url = reverse("tweets:unlike", kwargs=dict(pk=self.tweet.pk))
 
     def test_success_post(self):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(Like.objects.count(), 0)
+        self.assertEqual(response.json()["like_count"], 0)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 0)
 
     def test_failure_post_with_not_exist_tweet(self):
         self.url = reverse("tweets:unlike", kwargs=dict(pk=self.tweet.pk + 1))
@@ -164,6 +436,580 @@ class TestUnLikeView(TestCase):
         self.assertEqual(Like.objects.count(), 1)
 
     def test_failure_post_with_unliked_tweet(self):
-        Like.objects.filter(user=self.user, tweet=self.tweet).delete()
+        Like.objects.unlike(self.user, self.tweet)
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["like_count"], 0)
+
+
+class TestBulkLikeView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+        self.tweet1 = Tweet.objects.create(user=self.user, content="testcontent1")
+        self.tweet2 = Tweet.objects.create(user=self.user, content="testcontent2")
+        self.tweet3 = Tweet.objects.create(user=self.user, content="testcontent3")
+        Like.objects.like(self.user, self.tweet2)
+        self.url = reverse("tweets:bulk_like")
+
+    def post_actions(self, actions):
+        return self.client.post(self.url, json.dumps({"actions": actions}), content_type="application/json")
+
+    def test_success_post(self):
+        actions = [
+            {"pk": self.tweet1.pk, "action": "like"},
+            {"pk": self.tweet2.pk, "action": "unlike"},
+            {"pk": self.tweet3.pk, "action": "like"},
+            {"pk": self.tweet3.pk, "action": "unlike"},
+        ]
+        response = self.post_actions(actions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["tweets"],
+            {
+                str(self.tweet1.pk): {"like_count": 1, "is_liked": True},
+                str(self.tweet2.pk): {"like_count": 0, "is_liked": False},
+                str(self.tweet3.pk): {"like_count": 0, "is_liked": False},
+            },
+        )
+        self.assertQuerysetEqual(Like.objects.values_list("tweet", flat=True), [self.tweet1.pk])
+
+    def test_success_post_with_liked_tweet(self):
+        response = self.post_actions([{"pk": self.tweet2.pk, "action": "like"}])
+        self.assertEqual(response.json()["tweets"][str(self.tweet2.pk)]["like_count"], 1)
+        self.assertEqual(Like.objects.count(), 1)
+
+    def test_failure_post_with_not_exist_tweet(self):
+        response = self.post_actions([{"pk": self.tweet3.pk + 1, "action": "like"}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["tweets"], {})
+        self.assertEqual(Like.objects.count(), 1)
+
+    def test_failure_post_with_invalid_action(self):
+        response = self.post_actions([{"pk": self.tweet1.pk, "action": "retweet"}])
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, "not json", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_failure_post_with_out_of_range_pk(self):
+        response = self.post_actions([{"pk": 2**63, "action": "like"}])
+        self.assertEqual(response.status_code, 400)
+        response = self.post_actions([{"pk": -1, "action": "like"}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_failure_post_with_too_many_actions(self):
+        response = self.post_actions([{"pk": pk, "action": "like"} for pk in range(1, 102)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Like.objects.count(), 1)
+
+
+@override_settings(LIKE_WRITE_BEHIND=True, LIKE_BUFFER_FLUSH_INTERVAL=None, TRENDING_FLUSH_INTERVAL=None)
+class TestLikeWriteBehind(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.tweet = Tweet.objects.create(user=self.user1, content="testcontent")
+        self.like_url = reverse("tweets:like", kwargs=dict(pk=self.tweet.pk))
+        self.unlike_url = reverse("tweets:unlike", kwargs=dict(pk=self.tweet.pk))
+        get_like_buffer.cache_clear()
+        self.addCleanup(get_like_buffer.cache_clear)
+        get_counter.cache_clear()
+        self.addCleanup(get_counter.cache_clear)
+
+    def post_as(self, user, url):
+        self.client.force_login(user)
+        return self.client.post(url).json()["like_count"]
+
+    def test_success_post(self):
+        self.assertEqual(self.post_as(self.user1, self.like_url), 1)
+        self.assertEqual(self.post_as(self.user2, self.like_url), 2)
+        self.assertEqual(Like.objects.count(), 0)
+        self.assertEqual(get_like_buffer().flush(), (2, {self.tweet.pk: 2}))
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 2)
+        self.assertEqual(Like.objects.count(), 2)
+
+    def test_success_post_coalesced(self):
+        self.assertEqual(self.post_as(self.user1, self.like_url), 1)
+        self.assertEqual(self.post_as(self.user1, self.unlike_url), 0)
+        self.assertEqual(self.post_as(self.user1, self.like_url), 1)
+        with CaptureQueriesContext(connection) as context:
+            get_like_buffer().flush()
+        self.assertEqual(Like.objects.filter(user=self.user1).count(), 1)
+        self.assertEqual(self.post_as(self.user1, self.unlike_url), 0)
+        self.assertEqual(self.post_as(self.user1, self.like_url), 1)
+        get_like_buffer().flush()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
+        self.assertLessEqual(len(context.captured_queries), 6)
+
+    def test_success_bulk_post(self):
+        self.client.force_login(self.user1)
+        other = Tweet.objects.create(user=self.user2, content="othercontent")
+        actions = [{"pk": self.tweet.pk, "action": "like"}, {"pk": other.pk, "action": "unlike"}]
+        response = self.client.post(
+            reverse("tweets:bulk_like"), json.dumps({"actions": actions}), content_type="application/json"
+        )
+        self.assertEqual(
+            response.json()["tweets"],
+            {
+                str(self.tweet.pk): {"like_count": 1, "is_liked": True},
+                str(other.pk): {"like_count": 0, "is_liked": False},
+            },
+        )
+        self.assertEqual(Like.objects.count(), 0)
+        self.assertEqual(len(get_like_buffer()), 2)
+        get_like_buffer().flush()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
+        self.assertTrue(Like.objects.filter(user=self.user1, tweet=self.tweet).exists())
+
+    def test_success_flush_command(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with override_settings(LIKE_BUFFER_PATH=Path(tmpdir) / "likes.buffer"):
+                self.post_as(self.user1, self.like_url)
+                self.post_as(self.user2, self.like_url)
+                self.post_as(self.user2, self.unlike_url)
+                out = StringIO()
+                call_command("flush_like_buffer", stdout=out)
+        self.assertIn("2件の操作を反映し、1件のツイートのいいね数を更新しました", out.getvalue())
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
+        self.assertTrue(Like.objects.filter(user=self.user1, tweet=self.tweet).exists())
+
+
+class TestReconcileLikeCountsCommand(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.tweet = Tweet.objects.create(user=self.user1, content="testcontent")
+        Like.objects.create(user=self.user1, tweet=self.tweet)
+        Like.objects.create(user=self.user2, tweet=self.tweet)
+
+    def test_success_reconcile(self):
+        out = StringIO()
+        call_command("reconcile_like_counts", stdout=out)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 2)
+        self.assertIn("1件のいいね数を修正しました", out.getvalue())
+
+    def test_success_reconcile_invalidates_cache(self):
+        version = cache.get_version("tweet", self.tweet.pk)
+        call_command("reconcile_like_counts", stdout=StringIO())
+        self.assertNotEqual(cache.get_version("tweet", self.tweet.pk), version)
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+        self.ramen = Tweet.objects.create(user=self.user, content="東京でラーメンを食べた")
+        self.takoyaki = Tweet.objects.create(user=self.user, content="大阪でたこ焼きを食べた")
+        self.django = Tweet.objects.create(user=self.user, content="Djangoの全文検索")
+        self.url = reverse("tweets:search")
+        self.json_url = reverse("tweets:search_json")
+
+    def search(self, query, **params):
+        return self.client.get(self.json_url, {"q": query, **params}).json()
+
+    def test_success_tokenize(self):
+        self.assertEqual(tokenize("東京都 Django4.1"), ["東京", "京都", "django4", "1"])
+        self.assertEqual(tokenize("ｶﾀｶﾅ・猫"), ["カタ", "タカ", "カナ", "猫"])
+
+    def test_success_get(self):
+        response = self.client.get(self.url, {"q": "ラーメン"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["tweet_list"]), [self.ramen])
+        self.assertContains(response, "東京でラーメンを食べた")
+
+    def test_success_get_json(self):
+        results = self.search("食べた")["results"]
+        self.assertEqual({result["pk"] for result in results}, {self.ramen.pk, self.takoyaki.pk})
+        self.assertEqual([result["pk"] for result in self.search("django")["results"]], [self.django.pk])
+        self.assertEqual([result["pk"] for result in self.search("東京 食べた")["results"]], [self.ramen.pk])
+        self.assertEqual([result["pk"] for result in self.search("阪")["results"]], [self.takoyaki.pk])
+        self.assertEqual(self.search("京ラ")["results"], [])
+
+    def test_success_get_json_with_pages(self):
+        for i in range(25):
+            Tweet.objects.create(user=self.user, content=f"ページ送り{i}")
+        first_page = self.search("ページ")
+        self.assertEqual(len(first_page["results"]), 20)
+        self.assertEqual(first_page["next_page"], 2)
+        second_page = self.search("ページ", page=2)
+        self.assertEqual(len(second_page["results"]), 5)
+        self.assertIsNone(second_page["next_page"])
+        pks = [result["pk"] for result in first_page["results"] + second_page["results"]]
+        self.assertEqual(len(set(pks)), 25)
+
+    def test_success_delete_tweet(self):
+        self.ramen.delete()
+        self.assertEqual(self.search("ラーメン")["results"], [])
+
+    def test_success_rebuild_command(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user, content="一括で作ったツイート")])
+        self.assertEqual(self.search("一括")["results"], [])
+        out = StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertEqual(len(self.search("一括")["results"]), 1)
+        self.assertIn("4件のツイートを検索インデックスに登録しました", out.getvalue())
+
+    def test_failure_get_with_invalid_page(self):
+        response = self.client.get(self.json_url, {"q": "ラーメン", "page": "0"})
+        self.assertEqual(response.status_code, 404)
+
+
+class TestTweetTags(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.client.force_login(self.user1)
+
+    def post(self, content):
+        self.client.post(reverse("tweets:create"), {"content": content})
+        return Tweet.objects.latest("pk")
+
+    def test_success_parse(self):
+        self.assertEqual(
+            parse("#Django と ＃日本語 @tester1 a@b.com x#y #django @tester1"),
+            (["django", "日本語"], ["tester1"]),
+        )
+
+    def test_success_linkify_full_width(self):
+        hashtag_url = reverse("tweets:hashtag", kwargs=dict(name="Django"))
+        profile_url = reverse("accounts:user_profile", kwargs=dict(username="tester1"))
+        self.assertEqual(
+            linkify_tags("＃Ｄｊａｎｇｏ と ＠tester1 <b>"),
+            f'<a href="{hashtag_url}">＃Ｄｊａｎｇｏ</a> と <a href="{profile_url}">＠tester1</a> &lt;b&gt;',
+        )
+        self.assertEqual(parse("＃Ｄｊａｎｇｏ と ＠tester1 <b>"), (["django"], ["tester1"]))
+
+    def test_success_parse_username_characters(self):
+        self.assertEqual(
+            parse("@tester1. (@test.user-1) @first.last- と @a+b@c a@b.com"),
+            ([], ["tester1", "test.user-1", "first.last", "a+b@c"]),
+        )
+        profile_url = reverse("accounts:user_profile", kwargs=dict(username="tester1"))
+        self.assertEqual(linkify_tags("@tester1."), f'<a href="{profile_url}">@tester1</a>.')
+
+    def test_success_post(self):
+        with CaptureQueriesContext(connection) as context:
+            tweet = self.post("#Django を @tester2 と @tester1 と @nobody に")
+        self.assertEqual(list(TweetHashtag.objects.values_list("tweet", "hashtag__name")), [(tweet.pk, "django")])
+        self.assertEqual(
+            set(Mention.objects.values_list("tweet", "user")), {(tweet.pk, self.user1.pk), (tweet.pk, self.user2.pk)}
+        )
+        mention_queries = [query for query in context.captured_queries if '"username" IN' in query["sql"]]
+        self.assertEqual(len(mention_queries), 1)
+
+    def test_success_get_hashtag(self):
+        created_at = timezone.now()
+        for i in range(25):
+            Tweet.objects.create(user=self.user2, content=f"paged{i}", created_at=created_at)
+            self.post(f"#Paged {i}")
+        response = self.client.get(reverse("tweets:hashtag", kwargs=dict(name="paged")))
+        first_page = response.context["tweet_list"]
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(first_page), 20)
+        self.assertContains(response, f'<a href="{reverse("tweets:hashtag", kwargs=dict(name="Paged"))}">#Paged</a>')
+        response = self.client.get(
+            reverse("tweets:hashtag_more", kwargs=dict(name="PAGED")), {"before": page_obj.next_cursor}
+        )
+        second_page = response.context["tweet_list"]
+        self.assertTemplateNotUsed(response, "base.html")
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual([*first_page, *second_page], list(Tweet.objects.filter(content__startswith="#Paged")))
+
+    def test_success_get_mentions(self):
+        tweet = self.post("@tester2 こんにちは")
+        self.post("@tester1 自分宛て")
+        self.client.force_login(self.user2)
+        response = self.client.get(reverse("tweets:mentions"))
+        self.assertEqual(list(response.context["tweet_list"]), [tweet])
+
+    def test_success_create_without_form(self):
+        tweet = Tweet.objects.create(user=self.user1, content="#Django を @tester2 に")
+        self.assertEqual(list(TweetHashtag.objects.values_list("tweet", "hashtag__name")), [(tweet.pk, "django")])
+        self.assertEqual(list(Mention.objects.values_list("tweet", "user")), [(tweet.pk, self.user2.pk)])
+        tweet.content = "#Python だけ"
+        tweet.save()
+        self.assertEqual(list(TweetHashtag.objects.values_list("tweet", "hashtag__name")), [(tweet.pk, "python")])
+        self.assertFalse(Mention.objects.exists())
+
+    def test_success_delete_tweet(self):
+        tweet = self.post("#消える @tester2")
+        tweet.delete()
+        self.assertFalse(TweetHashtag.objects.exists())
+        self.assertFalse(Mention.objects.exists())
+        self.assertTrue(Hashtag.objects.filter(name="消える").exists())
+
+    def test_success_rebuild_command(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user1, content="#一括 @tester2")])
+        out = StringIO()
+        call_command("rebuild_tags", stdout=out)
+        self.assertEqual(TweetHashtag.objects.get().hashtag.name, "一括")
+        self.assertIn("1件のハッシュタグと1件のメンションを登録しました", out.getvalue())
+
+
+@override_settings(TRENDING_FLUSH_INTERVAL=None)
+class TestTrending(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(username="tester2", password="testpassword2")
+        self.client.force_login(self.user1)
+        get_counter.cache_clear()
+        self.addCleanup(get_counter.cache_clear)
+        cache.get_cache().clear()
+
+    def test_success_space_saving(self):
+        counter = SpaceSaving(10)
+        for i in range(1000):
+            counter.add("heavy" if i % 3 == 0 else f"name{i}")
+        self.assertEqual(len(counter), 10)
+        self.assertEqual(max(counter.counts, key=counter.counts.get), "heavy")
+        self.assertGreaterEqual(counter.counts["heavy"], 334)
+
+    def test_success_record(self):
+        self.client.post(reverse("tweets:create"), {"content": "#Django と #python"})
+        self.client.post(reverse("tweets:create"), {"content": "#django"})
+        tweet = Tweet.objects.create(user=self.user2, content="testcontent")
+        self.client.post(reverse("tweets:like", kwargs=dict(pk=tweet.pk)))
+        self.client.post(reverse("tweets:like", kwargs=dict(pk=tweet.pk)))
+        self.assertFalse(TrendBucket.objects.exists())
+        self.assertEqual(get_counter().flush(), 3)
+        self.assertEqual([name for name, _ in get_top("hashtag")], ["django", "python"])
+        self.assertEqual([name for name, _ in get_top("tweet")], [str(tweet.pk)])
+
+    def test_success_decay(self):
+        now = timezone.now().timestamp()
+        counter = get_counter()
+        for _ in range(3):
+            counter.add("hashtag", "old", now=now - 3 * 3600)
+        counter.add("hashtag", "new", now=now)
+        counter.flush()
+        self.assertEqual([name for name, _ in get_top("hashtag", now=now)], ["new", "old"])
+
+    def test_success_compact(self):
+        now = timezone.now().timestamp()
+        counter = get_counter()
+        for minutes in [0, 90, 91, 92, 25 * 60]:
+            counter.add("hashtag", "django", now=now - minutes * 60)
+        counter.flush()
+        out = StringIO()
+        with self.settings(TRENDING_CAPACITY=1):
+            call_command("compact_trends", stdout=out)
+        self.assertIn("件の古いバケットを削除しました", out.getvalue())
+        widths = TrendBucket.objects.values_list("width", flat=True)
+        self.assertEqual(sorted(widths), [60] + [3600] * (len(widths) - 1))
+        self.assertEqual(sum(TrendBucket.objects.values_list("count", flat=True)), 4)
+        self.assertLessEqual(len(widths), 3)
+
+    def test_success_get_trending(self):
+        tweet = Tweet.objects.create(user=self.user2, content="trending tweet")
+        Tweet.objects.create(user=self.user2, content="deleted").delete()
+        counter = get_counter()
+        counter.add("hashtag", "django")
+        counter.add("tweet", tweet.pk)
+        counter.add("tweet", tweet.pk + 1000)
+        counter.flush()
+        response = self.client.get(reverse("tweets:trending"))
+        self.assertEqual([hashtag["name"] for hashtag in response.json()["hashtags"]], ["django"])
+        self.assertEqual([tweet["pk"] for tweet in response.json()["tweets"]], [tweet.pk])
+        counter.add("hashtag", "python")
+        counter.flush()
+        # セッションとユーザーの分だけ
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("tweets:trending"))
+        self.assertEqual(len(response.json()["hashtags"]), 1)
+
+
+class TestEventStream(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.other = User.objects.create_user(username="other", password="testpassword")
+        self.stranger = User.objects.create_user(username="stranger", password="testpassword")
+        FriendShip.objects.create(follower=self.user, followee=self.other)
+        self.tweet = Tweet.objects.create(user=self.other, content="testcontent")
+        self.client.force_login(self.user)
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    def get_communicator(self, cookie):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": reverse("tweets:events"),
+            "query_string": f"tweets={self.tweet.pk}".encode(),
+            "headers": [(b"cookie", cookie.encode())],
+        }
+        return ApplicationCommunicator(EventStreamMiddleware(None), scope)
+
+    def publish(self, func):
+        # on_commitはDBの接続があるスレッドで実行させる
+        with self.captureOnCommitCallbacks(execute=True):
+            return func()
+
+    async def test_success_stream(self):
+        communicator = self.get_communicator(self.cookie)
+        await communicator.send_input({"type": "http.request"})
+        response = await communicator.receive_output(timeout=5)
+        self.assertEqual(response["status"], 200)
+
+        # 自分のいいねとフォローしていないユーザーのツイートは届かない
+        await sync_to_async(self.publish)(lambda: Like.objects.like(self.user, self.tweet))
+        await sync_to_async(self.publish)(lambda: Tweet.objects.create(user=self.stranger, content="stranger"))
+        await sync_to_async(self.publish)(lambda: Like.objects.like(self.other, self.tweet))
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message["body"], f'event: like\ndata: {{"tweet": {self.tweet.pk}, "delta": 1}}\n\n'.encode())
+
+        tweet = await sync_to_async(self.publish)(lambda: Tweet.objects.create(user=self.other, content="new"))
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message["body"], f'event: tweet\ndata: {{"tweet": {tweet.pk}}}\n\n'.encode())
+
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(timeout=5)
+
+    async def test_success_stream_applied_likes(self):
+        communicator = self.get_communicator(self.cookie)
+        await communicator.send_input({"type": "http.request"})
+        await communicator.receive_output(timeout=5)
+
+        # まとめて書き込んだいいねでは、自分の分を除いた増減だけが届く
+        actions = [(self.user.pk, self.tweet.pk, True), (self.other.pk, self.tweet.pk, True)]
+        await sync_to_async(self.publish)(lambda: Like.objects.apply(actions))
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message["body"], f'event: like\ndata: {{"tweet": {self.tweet.pk}, "delta": 1}}\n\n'.encode())
+
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(timeout=5)
+
+    def test_success_format_event_without_own_delta(self):
+        event = {"type": "like", "tweet": self.tweet.pk, "delta": 0, "users": [[self.user.pk, 1], [self.other.pk, -1]]}
+        self.assertEqual(
+            format_event(event, self.user, {self.tweet.pk}, set()),
+            f'event: like\ndata: {{"tweet": {self.tweet.pk}, "delta": -1}}\n\n'.encode(),
+        )
+        self.assertIsNone(
+            format_event({**event, "users": [[self.user.pk, 1]], "delta": 1}, self.user, {self.tweet.pk}, set())
+        )
+
+    async def test_failure_stream_with_anonymous_user(self):
+        communicator = self.get_communicator("")
+        await communicator.send_input({"type": "http.request"})
+        response = await communicator.receive_output(timeout=5)
+        self.assertEqual(response["status"], 403)
+
+    async def test_success_file_broker(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            broker = FileBroker(Path(tmpdir) / "events.jsonl")
+            subscription = broker.subscribe()
+            broker.publish({"type": "tweet", "tweet": 1, "user": 2})
+            event = await asyncio.wait_for(subscription.get(), timeout=5)
+            subscription.close()
+        self.assertEqual(event, {"type": "tweet", "tweet": 1, "user": 2})
+
+    def test_success_get_without_asgi(self):
+        response = self.client.get(reverse("tweets:events"))
+        self.assertEqual(response.status_code, 204)
+
+
+@override_settings(TWEET_SHARDS=["shard0", "shard1"])
+class TestSharding(TestCase):
+    databases = {"default", "shard0", "shard1"}
+
+    def setUp(self):
+        # 別々のシャードに入るユーザーidを選ぶ
+        user_ids = {}
+        for user_id in range(1, 100):
+            user_ids.setdefault(sharding.shard_for_user(user_id), user_id)
+        self.user1 = User.objects.create_user(id=user_ids["shard0"], username="tester1", password="testpassword1")
+        self.user2 = User.objects.create_user(id=user_ids["shard1"], username="tester2", password="testpassword2")
+        FriendShip.objects.create(follower=self.user1, followee=self.user2)
+        self.client.force_login(self.user1)
+
+    def test_success_create_tweet(self):
+        self.client.post(reverse("tweets:create"), {"content": "testcontent"})
+        self.assertEqual(Tweet.objects.using("default").count(), 0)
+        self.assertEqual(Tweet.objects.using("shard0").get().content, "testcontent")
+        self.assertEqual(User.objects.using("shard1").count(), 2)
+
+    def test_success_get_home(self):
+        created_at = timezone.now()
+        for i in range(25):
+            user = self.user1 if i % 3 else self.user2
+            Tweet.objects.create(user=user, content=f"paged{i}", created_at=created_at - timezone.timedelta(seconds=i))
+        response = self.client.get(reverse("tweets:home"))
+        first_page = response.context["tweet_list"]
+        self.assertEqual(len(first_page), 20)
+        response = self.client.get(reverse("tweets:home_more"), {"before": response.context["page_obj"].next_cursor})
+        second_page = response.context["tweet_list"]
+        self.assertEqual([tweet.content for tweet in [*first_page, *second_page]], [f"paged{i}" for i in range(25)])
+
+    def test_success_get_profile_and_detail(self):
+        tweet = Tweet.objects.create(user=self.user2, content="testcontent")
+        response = self.client.get(reverse("accounts:user_profile", kwargs=dict(username="tester2")))
+        self.assertEqual(list(response.context["tweet_list"]), [tweet])
+        response = self.client.get(reverse("tweets:detail", kwargs=dict(pk=tweet.pk)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_success_get_api(self):
+        tweet = Tweet.objects.create(user=self.user2, content="testcontent")
+        response = self.client.get(reverse("tweets:api_home"))
+        self.assertEqual([tweet["pk"] for tweet in response.json()["tweets"]], [tweet.pk])
+        response = self.client.get(reverse("tweets:api_home"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse("tweets:api_detail", kwargs=dict(pk=tweet.pk)))
+        self.assertEqual(response.json()["username"], "tester2")
+        response = self.client.get(reverse("accounts:api_user", kwargs=dict(username="tester2")))
+        self.assertEqual(len(response.json()["tweets"]), 1)
+
+    def test_success_like(self):
+        tweet = Tweet.objects.create(user=self.user2, content="testcontent")
+        response = self.client.post(reverse("tweets:like", kwargs=dict(pk=tweet.pk)))
+        self.assertEqual(response.json()["like_count"], 1)
+        self.assertTrue(Like.objects.using("shard1").filter(user=self.user1, tweet_id=tweet.pk).exists())
+        response = self.client.post(
+            reverse("tweets:bulk_like"), {"actions": [{"pk": tweet.pk, "action": "unlike"}]}, "application/json"
+        )
+        self.assertEqual(response.json()["tweets"][str(tweet.pk)]["like_count"], 0)
+        self.assertFalse(Like.objects.using("shard1").exists())
+
+    def test_success_delete_liking_user(self):
+        tweet = Tweet.objects.create(user=self.user2, content="testcontent")
+        Like.objects.like(self.user1, tweet)
+        self.user1.delete()
+        self.assertEqual(Tweet.objects.using("shard1").get(pk=tweet.pk).like_count, 0)
+        self.assertFalse(Like.objects.using("shard1").exists())
+
+    def test_success_search(self):
+        tweet1 = Tweet.objects.create(user=self.user1, content="シャードをまたいで検索")
+        tweet2 = Tweet.objects.create(user=self.user2, content="シャードに分けて保存")
+        response = self.client.get(reverse("tweets:search_json"), {"q": "シャード"})
+        self.assertEqual({result["pk"] for result in response.json()["results"]}, {tweet1.pk, tweet2.pk})
+
+    def test_success_get_hashtag(self):
+        self.client.post(reverse("tweets:create"), {"content": "#shard one"})
+        self.client.force_login(self.user2)
+        self.client.post(reverse("tweets:create"), {"content": "#shard two @tester1"})
+        self.assertTrue(TweetHashtag.objects.using("shard0").exists())
+        self.assertTrue(Mention.objects.using("shard1").filter(user=self.user1).exists())
+        response = self.client.get(reverse("tweets:hashtag", kwargs=dict(name="shard")))
+        self.assertEqual(
+            [tweet.content for tweet in response.context["tweet_list"]], ["#shard two @tester1", "#shard one"]
+        )
+
+    def test_failure_get_detail_with_nonexistent_tweet(self):
+        response = self.client.get(reverse("tweets:detail", kwargs=dict(pk=100)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_success_rebalance(self):
+        with override_settings(TWEET_SHARDS=[]):
+            tweet1 = Tweet.objects.create(user=self.user1, content="testcontent1")
+            tweet2 = Tweet.objects.create(user=self.user2, content="testcontent2")
+            Like.objects.like(self.user1, tweet2)
+        out = StringIO()
+        call_command("rebalance_shards", stdout=out)
+        self.assertEqual(Tweet.objects.using("default").count(), 0)
+        self.assertTrue(Tweet.objects.using("shard0").filter(pk=tweet1.pk).exists())
+        self.assertEqual(Tweet.objects.using("shard1").get(pk=tweet2.pk).like_count, 1)
+        self.assertTrue(Like.objects.using("shard1").filter(user=self.user1, tweet_id=tweet2.pk).exists())
+        self.assertIn("2件のツイートと1件のいいねを移しました", out.getvalue())
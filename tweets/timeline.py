@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+
+from accounts.models import FriendShip
+from mysite import cache, sharding
+from mysite.pagination import keyset_slice
+
+from .models import TimelineEntry, Tweet
+
+User = get_user_model()
+
+BATCH_SIZE = 1000
+
+
+def _create_entries(entries):
+    TimelineEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def is_crowded(user_id):
+    return User.objects.filter(pk=user_id, follower_count__gt=settings.TIMELINE_FANOUT_THRESHOLD).exists()
+
+
+def get_fanout_targets(author_id):
+    if is_crowded(author_id):
+        # フォロワーが多すぎるユーザーは読み込み時に合流させる
+        return [author_id]
+    follower_ids = FriendShip.objects.filter(followee_id=author_id).values_list("follower_id", flat=True)
+    return [author_id, *follower_ids]
+
+
+def fan_out(tweet):
+    _create_entries(
+        TimelineEntry(user_id=user_id, tweet_id=tweet.pk, created_at=tweet.created_at)
+        for user_id in get_fanout_targets(tweet.user_id)
+    )
+
+
+def backfill(follower_id, followee_id):
+    if is_crowded(followee_id):
+        return
+    recent = Tweet.objects.filter(user_id=followee_id).values_list("pk", "created_at")
+    _create_entries(
+        TimelineEntry(user_id=follower_id, tweet_id=pk, created_at=created_at)
+        for pk, created_at in recent[: settings.TIMELINE_BACKFILL_SIZE]
+    )
+
+
+def remove(follower_id, followee_id):
+    TimelineEntry.objects.filter(user_id=follower_id, tweet__user_id=followee_id).delete()
+
+
+def trim(user_id):
+    entries = TimelineEntry.objects.filter(user_id=user_id)
+    max_length = settings.TIMELINE_MAX_LENGTH
+    cutoff = list(
+        entries.order_by("-created_at", "-tweet_id").values_list("created_at", "tweet_id")[max_length : max_length + 1]
+    )
+    if not cutoff:
+        return 0
+    created_at, tweet_id = cutoff[0]
+    # cutoff自身も含めて、それより古いエントリーを削除する
+    stale = keyset_slice(entries, (created_at, tweet_id + 1), None, pk_field="tweet_id")
+    deleted, _ = TimelineEntry.objects.filter(pk__in=stale.values("pk")).delete()
+    return deleted
+
+
+def rebuild(user_id):
+    followee_ids = (
+        FriendShip.objects.filter(follower_id=user_id)
+        .exclude(followee_id__in=get_crowded_followee_ids(user_id))
+        .values("followee_id")
+    )
+    recent = Tweet.objects.filter(Q(user_id=user_id) | Q(user_id__in=followee_ids)).values_list("pk", "created_at")
+    with transaction.atomic():
+        TimelineEntry.objects.filter(user_id=user_id).delete()
+        _create_entries(
+            TimelineEntry(user_id=user_id, tweet_id=pk, created_at=created_at)
+            for pk, created_at in recent[: settings.TIMELINE_MAX_LENGTH]
+        )
+
+
+def get_crowded_followee_ids(user):
+    threshold = settings.TIMELINE_FANOUT_THRESHOLD
+    crowded = FriendShip.objects.filter(follower=user, followee__follower_count__gt=threshold)
+    return crowded.values_list("followee_id", flat=True)
+
+
+def get_cached_crowded_followee_ids(user):
+    return cache.cached("following", user.pk, lambda: list(get_crowded_followee_ids(user)), timeout=60)
+
+
+def get_home_tweet_ids(user, position, limit):
+    entries = TimelineEntry.objects.filter(user=user)
+    rows = list(keyset_slice(entries, position, limit, pk_field="tweet_id").values_list("created_at", "tweet_id"))
+    crowded_ids = get_cached_crowded_followee_ids(user)
+    if crowded_ids:
+        pulled = Tweet.objects.filter(user_id__in=crowded_ids)
+        rows += keyset_slice(pulled, position, limit).values_list("created_at", "pk")
+        rows = sorted(set(rows), reverse=True)[:limit]
+    return [pk for _, pk in rows]
+
+
+def get_home_page_ids(user, position, limit):
+    # 条件付きGET用に、ホームのページに出るツイートのidだけを返す
+    if sharding.is_enabled():
+        return [tweet.pk for tweet in get_sharded_home_tweets(user, Tweet.objects.only("created_at"), position, limit)]
+    return get_home_tweet_ids(user, position, limit)
+
+
+def get_sharded_home_tweets(user, queryset, position, limit):
+    # 自分とフォロー中のユーザーをシャードごとに分け、各シャードから新しい順に集めてマージする
+    author_ids = [user.pk, *FriendShip.objects.filter(follower=user).values_list("followee_id", flat=True)]
+    querysets = [
+        queryset.using(db).filter(user_id__in=user_ids) for db, user_ids in sharding.group_by_shard(author_ids).items()
+    ]
+    return sharding.scatter_gather(querysets, position, limit)
@@ -0,0 +1,141 @@
+import heapq
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from functools import lru_cache
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import TrendBucket
+
+HOUR = 3600
+KINDS = ("hashtag", "tweet")
+
+
+class SpaceSaving:
+    # 件数の多いものだけを最大 capacity 個まで数える (Space-Saving)
+    # あふれたら最小の件数のものを追い出し、その件数を引き継ぐので、上位の件数は多めに見積もられるが取りこぼさない
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        # (件数, name) の最小ヒープ。件数が増えた古い要素は追い出すときに読み飛ばす
+        self._heap = []
+
+    def add(self, name, weight=1):
+        if name not in self.counts and len(self.counts) >= self.capacity:
+            while True:
+                count, victim = heapq.heappop(self._heap)
+                if self.counts.get(victim) == count:
+                    break
+            del self.counts[victim]
+            self.counts[name] = count
+        count = self.counts.get(name, 0) + weight
+        self.counts[name] = count
+        heapq.heappush(self._heap, (count, name))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, name) for name, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self.counts)
+
+
+def _bucket_start(timestamp, width):
+    return datetime.fromtimestamp(timestamp - timestamp % width, tz=dt_timezone.utc)
+
+
+def _upsert(rows):
+    # 複数のプロセスが同じバケットに書き込むので、既存の件数に足し込む
+    table = connection.ops.quote_name(TrendBucket._meta.db_table)
+    sql = (
+        f"INSERT INTO {table} (kind, name, start, width, count) VALUES (%s, %s, %s, %s, %s)"
+        f" ON CONFLICT (kind, width, start, name) DO UPDATE SET count = {table}.count + excluded.count"
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(kind, name, adapt(start), width, count) for kind, name, start, width, count in rows])
+
+
+class TrendCounter:
+    # いいね・投稿のたびにDBへ書かないよう、プロセス内で1分ごとのバケットに数え、TRENDING_FLUSH_INTERVAL 秒ごとにまとめて書き込む
+    def __init__(self, capacity, bucket_seconds, flush_interval):
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._flushed_at = time.monotonic()
+
+    def add(self, kind, name, weight=1, now=None):
+        start = _bucket_start(time.time() if now is None else now, self.bucket_seconds)
+        with self._lock:
+            bucket = self._buckets.get((kind, start))
+            if bucket is None:
+                bucket = self._buckets[(kind, start)] = SpaceSaving(self.capacity)
+            bucket.add(str(name), weight)
+            # flush_interval が None のときは flush() を呼ぶまで書き込まない
+            due = self.flush_interval is not None and time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+            self._flushed_at = time.monotonic()
+        rows = [
+            (kind, name, start, self.bucket_seconds, count)
+            for (kind, start), bucket in buckets.items()
+            for name, count in bucket.counts.items()
+        ]
+        if rows:
+            _upsert(rows)
+        return len(rows)
+
+
+@lru_cache(maxsize=None)
+def get_counter():
+    # 書き込みはリクエストの中で行うので、プロセスの終了時に書き込めていない分 (最大 TRENDING_FLUSH_INTERVAL 秒) は捨てる
+    return TrendCounter(settings.TRENDING_CAPACITY, settings.TRENDING_BUCKET_SECONDS, settings.TRENDING_FLUSH_INTERVAL)
+
+
+def record(kind, names):
+    counter = get_counter()
+    for name in names:
+        counter.add(kind, name)
+
+
+def compact(now=None):
+    # 1時間より前の分単位のバケットは1時間単位にまとめ、TRENDING_WINDOW より前のバケットは消す
+    now = time.time() if now is None else now
+    cutoff = _bucket_start(now, HOUR)
+    hourly = defaultdict(lambda: defaultdict(int))
+    minutes = TrendBucket.objects.filter(width__lt=HOUR, start__lt=cutoff)
+    with transaction.atomic():
+        for kind, name, start, count in minutes.values_list("kind", "name", "start", "count"):
+            hourly[(kind, _bucket_start(start.timestamp(), HOUR))][name] += count
+        merged, _ = minutes.delete()
+        # まとめたあとも1時間あたり TRENDING_CAPACITY 件までに抑える
+        _upsert(
+            (kind, name, start, HOUR, count)
+            for (kind, start), counts in hourly.items()
+            for name, count in heapq.nlargest(settings.TRENDING_CAPACITY, counts.items(), key=itemgetter(1))
+        )
+        expired, _ = TrendBucket.objects.filter(start__lt=_bucket_start(now - settings.TRENDING_WINDOW, HOUR)).delete()
+    return merged, expired
+
+
+def get_top(kind, size=None, now=None):
+    # 新しいバケットほど重く (TRENDING_HALF_LIFE 秒で半分)、減衰させた件数の合計が多い順に返す
+    now = time.time() if now is None else now
+    size = size or settings.TRENDING_SIZE
+    since = datetime.fromtimestamp(now - settings.TRENDING_WINDOW, tz=dt_timezone.utc)
+    scores = defaultdict(float)
+    buckets = TrendBucket.objects.filter(kind=kind, start__gte=since - timedelta(seconds=HOUR))
+    for name, start, width, count in buckets.values_list("name", "start", "width", "count"):
+        age = max(now - start.timestamp() - width / 2, 0)
+        scores[name] += count * 0.5 ** (age / settings.TRENDING_HALF_LIFE)
+    return heapq.nlargest(size, scores.items(), key=itemgetter(1))
@@ -6,9 +6,22 @@ app_name = "tweets"
 
 urlpatterns = [
     path("home/", views.HomeView.as_view(), name="home"),
+    path("home/more/", views.HomeMoreView.as_view(), name="home_more"),
+    path("tags/<str:name>/", views.HashtagView.as_view(), name="hashtag"),
+    path("tags/<str:name>/more/", views.HashtagMoreView.as_view(), name="hashtag_more"),
+    path("mentions/", views.MentionListView.as_view(), name="mentions"),
+    path("mentions/more/", views.MentionListMoreView.as_view(), name="mentions_more"),
+    path("api/home/", views.TimelineAPIView.as_view(), name="api_home"),
+    path("api/<int:pk>/", views.TweetAPIView.as_view(), name="api_detail"),
     path("create/", views.TweetCreateView.as_view(), name="create"),
     path("<int:pk>/", views.TweetDetailView.as_view(), name="detail"),
     path("<int:pk>/delete/", views.TweetDeleteView.as_view(), name="delete"),
-    path("<int:pk>/like/", views.LikeView.as_view(), name="like"),
-    path("<int:pk>/unlike/", views.UnlikeView.as_view(), name="unlike"),
+    path("<int:pk>/like/", views.AsyncLikeView.as_view(), name="like"),
+    path("<int:pk>/unlike/", views.AsyncUnlikeView.as_view(), name="unlike"),
+    path("like/bulk/", views.BulkLikeView.as_view(), name="bulk_like"),
+    path("search/", views.SearchView.as_view(), name="search"),
+    path("search/more/", views.SearchMoreView.as_view(), name="search_more"),
+    path("search/json/", views.SearchJSONView.as_view(), name="search_json"),
+    path("trending/", views.TrendingView.as_view(), name="trending"),
+    path("events/", views.EventStreamUnavailableView.as_view(), name="events"),
 ]
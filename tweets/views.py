@@ -1,26 +1,122 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.views import View
 from django.views.generic import CreateView, DeleteView, DetailView, ListView
 
+from mysite import cache, sharding
+from mysite.mixins import AsyncLoginRequiredMixin, ConditionalGetMixin, JSONResponseMixin, ReplicaReadMixin
+from mysite.pagination import MAX_ID, KeysetPage, KeysetPaginationMixin
+
+from . import search, tags, timeline, trending
 from .forms import TweetForm
-from .models import Like, Tweet
+from .fragments import TweetFragmentMixin
+from .likebuffer import get_like_buffer
+from .models import Like, Mention, Tweet, TweetHashtag
+from .serializers import get_tweet_versions, serialize_tweet
+
 
+class HomeTimelineMixin(KeysetPaginationMixin):
+    def get_queryset(self):
+        return Tweet.objects.select_related("user").with_like_state(self.request.user)
 
-class HomeView(LoginRequiredMixin, ListView):
+    def get_page_rows(self, queryset, position, limit):
+        if sharding.is_enabled():
+            return timeline.get_sharded_home_tweets(self.request.user, queryset, position, limit)
+        # タイムラインはフォロー中のユーザーの投稿を書き込み時に配信したTimelineEntryから読む
+        tweet_ids = timeline.get_home_tweet_ids(self.request.user, position, limit)
+        tweets = queryset.in_bulk(tweet_ids)
+        return [tweets[pk] for pk in tweet_ids if pk in tweets]
+
+
+class HomeView(LoginRequiredMixin, ReplicaReadMixin, TweetFragmentMixin, HomeTimelineMixin, ListView):
     template_name = "tweets/home.html"
+    fragment_variant = "home"
+    model = Tweet
+    context_object_name = "tweet_list"
+
+
+class HomeMoreView(HomeView):
+    template_name = "tweets/tweet_list.html"
+
+
+class TaggedTweetListMixin(LoginRequiredMixin, ReplicaReadMixin, TweetFragmentMixin, KeysetPaginationMixin):
+    fragment_variant = "home"
     model = Tweet
-    queryset = Tweet.objects.select_related("user").prefetch_related("like_tweet")
+    queryset = Tweet.objects.select_related("user")
     context_object_name = "tweet_list"
+    more_url_name = None
+
+    def get_queryset(self):
+        return super().get_queryset().with_like_state(self.request.user)
+
+    def get_entries(self):
+        raise NotImplementedError
+
+    def get_page_rows(self, queryset, position, limit):
+        return tags.get_tagged_tweets(queryset, self.get_entries(), position, limit)
+
+    def get_more_url(self):
+        return reverse(self.more_url_name, kwargs=self.kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["more_url"] = self.get_more_url()
+        return context
+
+
+class HashtagView(TaggedTweetListMixin, ListView):
+    template_name = "tweets/hashtag.html"
+    more_url_name = "tweets:hashtag_more"
+
+    def get_entries(self):
+        return TweetHashtag.objects.filter(hashtag__name=tags.normalize_hashtag(self.kwargs["name"]))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["like_list"] = Like.objects.filter(user=self.request.user).values_list("tweet__pk", flat=True)
+        context["hashtag"] = self.kwargs["name"]
         return context
 
 
+class HashtagMoreView(HashtagView):
+    template_name = "tweets/tagged_tweet_list.html"
+
+
+class MentionListView(TaggedTweetListMixin, ListView):
+    template_name = "tweets/mention_list.html"
+    more_url_name = "tweets:mentions_more"
+
+    def get_entries(self):
+        return Mention.objects.filter(user=self.request.user)
+
+
+class MentionListMoreView(MentionListView):
+    template_name = "tweets/tagged_tweet_list.html"
+
+
+class TweetListAPIMixin(JSONResponseMixin):
+    def get(self, request, *args, **kwargs):
+        _, page, tweets, _ = self.paginate_queryset(self.get_queryset(), self.paginate_by)
+        context = {"tweets": [serialize_tweet(tweet) for tweet in tweets], "next": page.next_cursor}
+        return self.render_to_json_response(context)
+
+
+class TimelineAPIView(
+    LoginRequiredMixin, ReplicaReadMixin, ConditionalGetMixin, TweetListAPIMixin, HomeTimelineMixin, View
+):
+    def get_validators(self):
+        # 古いツイートの削除やいいねでも変わるよう、ページに出るツイートのキャッシュのバージョンをETagに入れる
+        # 作成日時では削除・いいねを表せないので、Last-Modifiedは付けない
+        user = self.request.user
+        tweet_ids = timeline.get_home_page_ids(user, self.get_position(), self.paginate_by + 1)
+        return (user.following_count, get_tweet_versions(tweet_ids)), None
+
+
 class TweetCreateView(LoginRequiredMixin, CreateView):
     form_class = TweetForm
     template_name = "tweets/tweet_create.html"
@@ -28,21 +124,54 @@ class TweetCreateView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        trending.record("hashtag", tags.parse(self.object.content)[0])
+        return response
+
+
+def get_tweet_or_404(pk, queryset=None):
+    queryset = Tweet.objects.all() if queryset is None else queryset
+    if not sharding.is_enabled():
+        return get_object_or_404(queryset, pk=pk)
+    # どのシャードにあるかはidからはわからないので、全シャードを探す
+    tweet = sharding.find(queryset, [pk]).get(pk)
+    if tweet is None:
+        raise Http404("No Tweet matches the given query.")
+    return tweet
 
 
-class TweetDetailView(LoginRequiredMixin, DetailView):
+class ShardedObjectMixin:
+    def get_object(self, queryset=None):
+        if not sharding.is_enabled():
+            return super().get_object(queryset)
+        queryset = self.get_queryset() if queryset is None else queryset
+        return get_tweet_or_404(self.kwargs["pk"], queryset)
+
+
+class TweetDetailView(LoginRequiredMixin, ReplicaReadMixin, ShardedObjectMixin, DetailView):
     template_name = "tweets/tweet_detail.html"
     model = Tweet
-    queryset = Tweet.objects.select_related("user").prefetch_related("like_tweet")
+    queryset = Tweet.objects.select_related("user")
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context["like_list"] = Like.objects.filter(user=self.request.user).values_list("tweet__pk", flat=True)
-        return context
+    def get_queryset(self):
+        return super().get_queryset().with_like_state(self.request.user)
 
 
-class TweetDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class TweetAPIView(LoginRequiredMixin, ReplicaReadMixin, ConditionalGetMixin, JSONResponseMixin, View):
+    def get_validators(self):
+        queryset = Tweet.objects.only("pk").with_like_state(self.request.user)
+        self.object = get_tweet_or_404(self.kwargs["pk"], queryset)
+        # 作成日時はいいね・更新で変わらないので、Last-Modifiedは付けない
+        # いいね数が同じでも閲覧者のいいねの有無が変わることがあるので、ETagに入れる
+        return (get_tweet_versions([self.object.pk]), self.object.is_liked), None
+
+    def get(self, request, *args, **kwargs):
+        queryset = Tweet.objects.select_related("user").with_like_state(request.user)
+        tweet = queryset.using(self.object._state.db).get(pk=self.object.pk)
+        return self.render_to_json_response(serialize_tweet(tweet))
+
+
+class TweetDeleteView(LoginRequiredMixin, UserPassesTestMixin, ShardedObjectMixin, DeleteView):
     template_name = "tweets/tweet_delete.html"
     model = Tweet
     queryset = Tweet.objects.select_related("user")
@@ -58,19 +187,191 @@ class TweetDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         return self.object.user == self.request.user
 
 
+def get_like_count(tweet):
+    return Tweet.objects.using(tweet._state.db).filter(pk=tweet.pk).values_list("like_count", flat=True).get()
+
+
+# 同期版は benchmarks の sync/ で非同期版と比べるためのもの。比べられるよう、非同期版と同じ処理にそろえる
 class LikeView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
-        user = self.request.user
-        tweet = get_object_or_404(Tweet, pk=self.kwargs["pk"])
-        Like.objects.get_or_create(user=user, tweet=tweet)
-        context = {"like_count": tweet.like_tweet.count()}
+        tweet = get_tweet_or_404(self.kwargs["pk"])
+        if settings.LIKE_WRITE_BEHIND:
+            context = {"like_count": get_like_buffer().add(request.user.pk, tweet, True)}
+            return JsonResponse(context)
+        if Like.objects.like(request.user, tweet):
+            trending.record("tweet", [tweet.pk])
+        context = {"like_count": get_like_count(tweet)}
         return JsonResponse(context)
 
 
 class UnlikeView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
+        tweet = get_tweet_or_404(self.kwargs["pk"])
+        if settings.LIKE_WRITE_BEHIND:
+            context = {"like_count": get_like_buffer().add(request.user.pk, tweet, False)}
+            return JsonResponse(context)
+        Like.objects.unlike(request.user, tweet)
+        context = {"like_count": get_like_count(tweet)}
+        return JsonResponse(context)
+
+
+async def aget_tweet_or_404(pk):
+    if sharding.is_enabled():
+        return await sync_to_async(get_tweet_or_404)(pk)
+    try:
+        return await Tweet.objects.aget(pk=pk)
+    except Tweet.DoesNotExist:
+        raise Http404("No Tweet matches the given query.")
+
+
+class AsyncLikeView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
+        tweet = await aget_tweet_or_404(self.kwargs["pk"])
+        if settings.LIKE_WRITE_BEHIND:
+            context = {"like_count": await sync_to_async(get_like_buffer().add)(request.user.pk, tweet, True)}
+            return JsonResponse(context)
+        if await Like.objects.alike(request.user, tweet):
+            await sync_to_async(trending.record)("tweet", [tweet.pk])
+        like_count = (
+            await Tweet.objects.using(tweet._state.db).filter(pk=tweet.pk).values_list("like_count", flat=True).aget()
+        )
+        context = {"like_count": like_count}
+        return JsonResponse(context)
+
+
+class AsyncUnlikeView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
+        tweet = await aget_tweet_or_404(self.kwargs["pk"])
+        if settings.LIKE_WRITE_BEHIND:
+            context = {"like_count": await sync_to_async(get_like_buffer().add)(request.user.pk, tweet, False)}
+            return JsonResponse(context)
+        await Like.objects.aunlike(request.user, tweet)
+        like_count = (
+            await Tweet.objects.using(tweet._state.db).filter(pk=tweet.pk).values_list("like_count", flat=True).aget()
+        )
+        context = {"like_count": like_count}
+        return JsonResponse(context)
+
+
+class BulkLikeView(LoginRequiredMixin, View):
+    max_actions = 100
+
+    def post(self, request, *args, **kwargs):
+        try:
+            actions = json.loads(request.body)["actions"]
+            intents = {int(action["pk"]): {"like": True, "unlike": False}[action["action"]] for action in actions}
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest("invalid actions")
+        if not all(0 < pk <= MAX_ID for pk in intents):
+            return HttpResponseBadRequest("invalid actions")
+        if len(intents) > self.max_actions:
+            return HttpResponseBadRequest(f"too many actions (max {self.max_actions})")
         user = self.request.user
-        tweet = get_object_or_404(Tweet, pk=self.kwargs["pk"])
-        Like.objects.filter(user=user, tweet=tweet).delete()
-        context = {"like_count": tweet.like_tweet.count()}
+        if settings.LIKE_WRITE_BEHIND:
+            tweets = sharding.find(Tweet.objects.only("like_count"), list(intents))
+            like_counts = get_like_buffer().add_many(user.pk, [(tweet, intents[pk]) for pk, tweet in tweets.items()])
+        else:
+            deltas = Like.objects.apply((user.pk, pk, liked) for pk, liked in intents.items())
+            trending.record("tweet", [pk for pk, delta in deltas.items() if delta > 0])
+            tweets = sharding.find(Tweet.objects.only("like_count"), list(intents))
+            like_counts = {pk: tweet.like_count for pk, tweet in tweets.items()}
+        context = {
+            "tweets": {
+                pk: {"like_count": like_count, "is_liked": intents[pk]} for pk, like_count in like_counts.items()
+            },
+        }
         return JsonResponse(context)
+
+
+class TrendingView(LoginRequiredMixin, View):
+    # ホームのトレンド欄がJSで取得する。全員に同じ内容なのでまとめて TRENDING_CACHE_TIMEOUT 秒キャッシュする
+    def get(self, request, *args, **kwargs):
+        context = cache.cached("trending", "top", self.get_trends, timeout=settings.TRENDING_CACHE_TIMEOUT)
+        return JsonResponse(context)
+
+    def get_trends(self):
+        # 削除済みのツイートは飛ばす
+        top_tweets = [(int(pk), score) for pk, score in trending.get_top("tweet")]
+        tweets = sharding.find(Tweet.objects.select_related("user"), [pk for pk, _ in top_tweets])
+        return {
+            "hashtags": [
+                {"name": name, "score": round(score, 2), "url": reverse("tweets:hashtag", kwargs={"name": name})}
+                for name, score in trending.get_top("hashtag")
+            ],
+            "tweets": [
+                {
+                    "pk": tweet.pk,
+                    "username": tweet.user.username,
+                    "content": tweet.content,
+                    "score": round(score, 2),
+                    "url": reverse("tweets:detail", kwargs={"pk": tweet.pk}),
+                }
+                for tweet, score in ((tweets[pk], score) for pk, score in top_tweets if pk in tweets)
+            ],
+        }
+
+
+class SearchMixin:
+    paginate_by = 20
+    page_kwarg = "page"
+
+    def get_search_page(self, queryset, page_size):
+        # 関連度順なのでカーソルではなくページ番号で続きを取得する (search.MAX_RESULTS 件まで)
+        self.query = self.request.GET.get("q", "").strip()
+        try:
+            page_number = int(self.request.GET.get(self.page_kwarg, 1))
+        except ValueError:
+            raise Http404("invalid page")
+        if page_number < 1:
+            raise Http404("invalid page")
+        hits = search.search(self.query, (page_number - 1) * page_size, page_size + 1)
+        ranks = dict(hits[:page_size])
+        tweets = sharding.find(queryset, list(ranks))
+        rows = []
+        for pk, rank in ranks.items():
+            if pk in tweets:
+                tweets[pk].search_rank = rank
+                rows.append(tweets[pk])
+        return KeysetPage(rows, page_number + 1 if len(hits) > page_size else None)
+
+    def get_search_queryset(self):
+        return Tweet.objects.select_related("user").with_like_state(self.request.user)
+
+
+class SearchView(LoginRequiredMixin, ReplicaReadMixin, TweetFragmentMixin, SearchMixin, ListView):
+    template_name = "tweets/search.html"
+    fragment_variant = "home"
+    context_object_name = "tweet_list"
+
+    def get_queryset(self):
+        return self.get_search_queryset()
+
+    def paginate_queryset(self, queryset, page_size):
+        page = self.get_search_page(queryset, page_size)
+        return (None, page, page.object_list, page.has_next())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        return context
+
+
+class SearchMoreView(SearchView):
+    template_name = "tweets/search_results.html"
+
+
+class SearchJSONView(LoginRequiredMixin, ReplicaReadMixin, SearchMixin, View):
+    def get(self, request, *args, **kwargs):
+        page = self.get_search_page(self.get_search_queryset(), self.paginate_by)
+        context = {
+            "query": self.query,
+            "results": [{**serialize_tweet(tweet), "rank": tweet.search_rank} for tweet in page.object_list],
+            "next_page": page.next_cursor,
+        }
+        return JsonResponse(context)
+
+
+class EventStreamUnavailableView(View):
+    # SSEはmysite/asgi.pyで配信する。WSGIで動かしているときは204を返してEventSourceの再接続を止める
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(status=204)